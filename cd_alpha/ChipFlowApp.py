@@ -3,37 +3,66 @@
 # To execute remotely use:
 # DISPLAY=:0.0 python3 ChipFlowApp.py
 
-import contextlib
 from collections import OrderedDict
-import json
 from pathlib import Path
+import logging
 import os
 from functools import partial
 import serial
+import threading
 import time
 from datetime import datetime
-from cd_alpha.Device import Device, get_updates
+from cd_alpha import LogPipeline, Metrics
+from cd_alpha.Device import Device, create_updater, device_config_path
+from cd_alpha.FrameWatchdog import DEFAULT_REPORT_DIR, FrameWatchdog
+from cd_alpha.Homing import Homing, HomingState, SyringeGrab
+# Registers DigitLabel for the kv files
+from cd_alpha.GlyphAtlas import DigitLabel
+from cd_alpha.RenderThrottle import ThrottledProperties
+from cd_alpha.RunRecording import (
+    DEFAULT_RECORDING_DIR,
+    RecordingNano,
+    RecordingSerial,
+    RunRecorder,
+)
+from cd_alpha.SafetyWatchdog import HEARTBEAT_INTERVAL, SafetyLink
+from cd_alpha.Updater import UpdateThread, UpdateError
+from cd_alpha.StepScheduler import StepScheduler, KivyClockWaker, ThreadWaker
+from cd_alpha.Telemetry import DEFAULT_TELEMETRY_PATH, TelemetryRecorder
 import kivy
 from kivy.app import App
 from kivy.lang import Builder
 from kivy.uix.widget import Widget
 from kivy.uix.button import Button
-from kivy.uix.label import Label
+from kivy.uix.togglebutton import ToggleButton
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.popup import Popup
 from kivy.clock import Clock
-from kivy.properties import ObjectProperty, StringProperty, NumericProperty
+from kivy.properties import (
+    BooleanProperty,
+    ListProperty,
+    NumericProperty,
+    ObjectProperty,
+    StringProperty,
+)
 from kivy.core.window import Window
 from kivy.logger import Logger
 from pkg_resources import resource_filename
-from cd_alpha.protocols.protocol_tools import ProcessProtocol
+from cd_alpha.protocols.protocol_compiler import (
+    DEFAULT_CACHE_DIR,
+    Action,
+    compile_file,
+)
+from cd_alpha.protocols.protocol_index import DEFAULT_INDEX_PATH, IndexThread
+from cd_alpha.protocols.protocol_tools import format_duration
 kivy.require("2.0.0")
 
 Builder.load_file(resource_filename("cd_alpha", "gui-elements/widget.kv"))
 Builder.load_file(resource_filename("cd_alpha", "gui-elements/roundedbutton.kv"))
 Builder.load_file(resource_filename("cd_alpha", "gui-elements/abortbutton.kv"))
+Builder.load_file(resource_filename("cd_alpha", "gui-elements/refreshbutton.kv"))
 Builder.load_file(resource_filename("cd_alpha", "gui-elements/useractionscreen.kv"))
 Builder.load_file(resource_filename("cd_alpha", "gui-elements/machineactionscreen.kv"))
 Builder.load_file(resource_filename("cd_alpha", "gui-elements/actiondonescreen.kv"))
@@ -46,7 +75,9 @@ Builder.load_file(resource_filename("cd_alpha", "gui-elements/homescreen.kv"))
 Builder.load_file(resource_filename("cd_alpha", "gui-elements/summaryscreen.kv"))
 Builder.load_file(resource_filename("cd_alpha", "gui-elements/protocolchooser.kv"))
 
-device = Device(resource_filename("cd_alpha", "device_config.json"))
+switch_log = LogPipeline.get_logger("switches")
+
+device = Device(device_config_path())
 
 # Change the value in the config file to change which protocol is in use
 # device.DEFAULT_PROTOCOL
@@ -88,10 +119,17 @@ else:
 # Establish serial connection to the pump controllers
 # TODO should be handled in an object not in a top level namespace
 if not LOCAL_TESTING:
-    ser = serial.Serial("/dev/ttyUSB0", 19200, timeout=2)
+    ser = serial.Serial(SERIAL_PATH, 19200, timeout=2)
+elif device.DEV_SERIAL_PUMPS:
+    # The real pump code on e.g. the pump emulator, the switches stay stubbed
+    from cd_alpha.NewEraPumps import PumpNetwork
+
+    ser = serial.Serial(SERIAL_PATH, 19200, timeout=2)
 else:
     ser = SerialStub()
-pumps = PumpNetwork(ser)
+# Operator input, pump replies and switch reads of every run, see RunRecording
+recorder = RunRecorder()
+pumps = PumpNetwork(RecordingSerial(ser, recorder))
 
 # TODO move out of __main__ namespace
 if DEBUG_MODE:
@@ -104,29 +142,94 @@ Logger.info(f"CDA: Using protocol: '{device.DEFAULT_PROTOCOL}''")
 if device.DEVICE_TYPE == "R0":
     WASTE_ADDR = device.PUMP_ADDR[0]
     WASTE_DIAMETER_mm = device.PUMP_DIAMETER[0]
+    PUMP_TARGET_ADDR = {"waste": WASTE_ADDR}
 else:
     WASTE_ADDR = device.PUMP_ADDR[0]
     LYSATE_ADDR = device.PUMP_ADDR[1]
     WASTE_DIAMETER_mm = device.PUMP_DIAMETER[0]
     LYSATE_DIAMETER_mm = device.PUMP_DIAMETER[1]
-
-scheduled_events = []
+    PUMP_TARGET_ADDR = {"waste": WASTE_ADDR, "lysate": LYSATE_ADDR}
+
+# Every step timer is owned by the scheduler, grouped by the name of the step
+scheduler = StepScheduler(name="gui")
+KivyClockWaker(scheduler)
+# Step boundaries are absolute deadlines fired from a timing thread, so they do
+# not depend on the Kivy frame rate
+boundary_scheduler = StepScheduler(name="boundary")
+ThreadWaker(boundary_scheduler)
 list_of_pumps = device.PUMP_ADDR
+# Planned vs actual step times and pump latencies of every run, see Telemetry.
+# Opened by ChipFlowApp.build, not on import
+telemetry_path = DEFAULT_TELEMETRY_PATH
+telemetry = None
+# Compiled protocols are cached here, see protocol_compiler
+protocol_cache_dir = DEFAULT_CACHE_DIR
+# Metadata of the protocol library shown by the ProtocolChooser
+protocol_index_path = DEFAULT_INDEX_PATH
+# The metrics and UI stalls of every run are written here
+metrics_dir = Metrics.DEFAULT_METRICS_DIR
+stall_report_dir = DEFAULT_REPORT_DIR
+recording_dir = DEFAULT_RECORDING_DIR
+# Stops the pumps from its own process when the app dies or hangs, only where
+# the pumps are on a serial port
+if device.SAFETY_WATCHDOG and (not LOCAL_TESTING or device.DEV_SERIAL_PUMPS):
+    safety = SafetyLink(
+        SERIAL_PATH, list_of_pumps, heartbeat_timeout=device.SAFETY_HEARTBEAT_TIMEOUT
+    )
+else:
+    safety = None
 
 ### UTIL FUNCTIONS ###
 
 
 def cleanup():
     Logger.debug("CDA: Cleaning upp")
-    global scheduled_events
-    Logger.debug("CDA: Unscheduling events")
-    for se in scheduled_events:
-        with contextlib.suppress(AttributeError):
-            se.cancel()
-    scheduled_events = []
+    Logger.debug(f"CDA: Unscheduling events: {scheduler.queue()}")
+    scheduler.cancel_all()
+    boundary_scheduler.cancel_all()
     pumps.stop_all_pumps(list_of_pumps)
 
 
+def arm_safety(addrs, seconds):
+    """Pumps that should be done within ``seconds``, see SafetyWatchdog."""
+    if safety is not None:
+        for addr in addrs:
+            safety.arm(addr, seconds)
+
+
+def disarm_stopped(addrs=None):
+    """Disarm the armed pumps, or those of ``addrs``, that report they stopped.
+    A pump still running stays armed and is stopped by the watchdog."""
+    if safety is None or not safety.alive:
+        return
+    for addr in list(safety.planned if addrs is None else addrs):
+        if addr in safety.planned and pumps.status(addr=addr) == "S":
+            safety.disarm(addr)
+
+
+def finish_run(outcome, cause=None):
+    """Close the telemetry of the run and dump its metrics."""
+    # Armed pumps stay guarded from step to step until the run is over
+    if safety is not None:
+        safety.disarm()
+    if not telemetry.active:
+        return
+    run_id = telemetry.run_id
+    telemetry.finish(outcome, cause)
+    recording = recorder.finish(outcome, cause)
+    if recording is not None:
+        Logger.info(f"CDA: Recording of the run written to {recording}")
+    name = f"{datetime.now():%Y-%m-%d_%H%M%S}-run{run_id}"
+    try:
+        path = Metrics.REGISTRY.dump(metrics_dir / f"{name}.prom")
+        Logger.info(f"CDA: Metrics of the run written to {path}")
+        if frame_watchdog.sites:
+            Logger.info(f"CDA: UI stalls of the run:\n{frame_watchdog.format_report()}")
+            frame_watchdog.dump(stall_report_dir / f"{name}.json")
+    except OSError as err:
+        Logger.warning(f"CDA: Could not write the metrics of the run: {err}")
+
+
 def shutdown():
     Logger.info("Shutting down...")
     cleanup()
@@ -158,31 +261,95 @@ Logger.info("CDA: Starting main script.")
 
 
 if device.DEVICE_TYPE == "V0":
-    nano = Nano(8, 7)
+    nano = RecordingNano(Nano(8, 7), recorder)
 else:
     nano = None
 
 
 # TODO why are magic numbers being defined mid initialization?
 progressbar_update_interval = 0.5
+# Shortest time between two renders of the step timer, and the progress
+# percentage it is rounded to, about a pixel of the bar
+render_interval = 1.0
+progress_resolution = 0.2
 switch_update_interval = 0.1
 grab_overrun_check_interval = 20
+frame_stall_threshold = 0.25
+screen_cache_size = 4
+# Long frames of the main loop, attributed to what blocked them
+frame_watchdog = FrameWatchdog(frame_stall_threshold)
+
+
+class StepDescriptor:
+    """Lightweight description of a screen in the protocol sequence, the
+    screen itself is only built when it is about to be shown."""
+
+    __slots__ = ("name", "kind", "step")
+
+    def __init__(self, name, kind, step):
+        self.name = name
+        self.kind = kind
+        self.step = step
+
+    def __repr__(self):
+        return f"StepDescriptor({self.name!r}, {self.kind!r})"
 
 
 class ProcessScreenManager(ScreenManager):
+    """Screen manager that builds protocol screens on demand from their
+    StepDescriptor and only keeps the most recently shown ones alive."""
+
     def __init__(self, *args, **kwargs):
         self.main_window = kwargs.pop("main_window")
+        self.screen_factory = kwargs.pop("screen_factory")
+        self.cache_size = kwargs.pop("cache_size", screen_cache_size)
         super().__init__(*args, **kwargs)
+        self.sequence = []
+        self.descriptors = {}
+        self.built_screens = OrderedDict()
+
+    def load_sequence(self, descriptors):
+        """Replace the protocol screens, dropping every screen built so far."""
+        for screen in self.built_screens.values():
+            self.remove_widget(screen)
+        self.built_screens = OrderedDict()
+        self.sequence = [d.name for d in descriptors]
+        self.descriptors = {d.name: d for d in descriptors}
+
+    def show(self, name):
+        """Build the screen if needed and make it the current one."""
+        if name in self.descriptors:
+            screen = self.built_screens.pop(name, None)
+            if screen is None:
+                screen = self.screen_factory(self.descriptors[name])
+            self.built_screens[name] = screen
+            if not self.has_screen(name):
+                self.add_widget(screen)
+        self.current = name
+        self._evict()
+
+    def _evict(self):
+        for name in list(self.built_screens):
+            if len(self.built_screens) <= self.cache_size:
+                break
+            if name == self.current:
+                continue
+            self.remove_widget(self.built_screens.pop(name))
 
     def next_screen(self):
         current = self.current
-        next_screen = self.next()
+        if current in self.sequence:
+            index = self.sequence.index(current) + 1
+        else:
+            index = 0
 
-        # Don't go to protocol_chooser as a next step, go home instead
-        if self.next() == "protocol_chooser":
-            next_screen = "home"
+        # At the end of the protocol go home instead
+        if index < len(self.sequence):
+            next_screen = self.sequence[index]
+        else:
+            next_screen = "home" if "home" in self.descriptors else self.sequence[0]
         Logger.debug(f"CDA: Next screen, going from {current} to {next_screen}")
-        self.current = next_screen
+        self.show(next_screen)
 
     def next_step(self):
         """Propagate this command one level up."""
@@ -228,90 +395,52 @@ class HomeScreen(ChipFlowScreen):
 
     def load_protocol(self, *args, **kwargs):
         Logger.info("Load button pressed!")
-        self.manager.current = "protocol_chooser"
+        self.manager.show("protocol_chooser")
 
 
 class MachineActionScreen(ChipFlowScreen):
-    time_remaining_min = NumericProperty(0)
-    time_remaining_sec = NumericProperty(0)
+    countdown_text = StringProperty("00:00")
+    protocol_remaining_text = StringProperty("")
     progress = NumericProperty(0.0)
 
     def __init__(self, *args, **kwargs):
         self.action = kwargs.pop("action")
+        self.timeline = kwargs.pop("timeline")
         self.name = kwargs.get("name")
         self.time_total = 0
-        self.time_elapsed = 0
+        self.step_deadline = None
+        # Homing or syringe grab cycle of a RESET or GRAB step
+        self.homing = None
         super().__init__(*args, **kwargs)
+        # A render still due is cancelled with the other timers of the step
+        self.render = ThrottledProperties(
+            self,
+            render_interval,
+            partial(scheduler.call_later, group=self.name),
+            scheduler.clock,
+        )
 
     # TODO this code is re-written multiple times and tied directly to GUI logic,
     # desperately needs re-factor
     def start(self):
-        for action, params in self.action.items():
-            if action == "PUMP":
-                if params["target"] == "waste":
-                    addr = WASTE_ADDR
-                if params["target"] == "lysate":
-                    addr = LYSATE_ADDR
-                rate_mh = params["rate_mh"]
-                vol_ml = params["vol_ml"]
-                eq_time = params.get("eq_time", 0)
-                self.time_total = abs(vol_ml / rate_mh) * 3600 + eq_time
-                self.time_elapsed = 0
+        # Actions are compiled, addresses and switches are already resolved
+        for record in self.action:
+            action = record.action
+            if action == Action.PUMP:
+                addr = record.addr
                 Logger.info(f"Addr = {addr}")
-                pumps.set_rate(rate_mh, "MH", addr)
-                pumps.set_volume(vol_ml, "ML", addr)
+                pumps.set_rate(record.rate, "MH", addr)
+                pumps.set_volume(record.vol_ml, "ML", addr)
                 pumps.run(addr)
+                arm_safety(record.addrs, record.duration)
                 Logger.info(f"Pump step {self.name} started at: {time.time()}")
-                scheduled_events.append(
-                    Clock.schedule_interval(
-                        self.set_progress, progressbar_update_interval
-                    )
-                )
+                self.start_timed_step(record.duration)
 
-            if action == "INCUBATE":
-                self.time_total = params["time"]
-                self.time_elapsed = 0
-                scheduled_events.append(
-                    Clock.schedule_interval(
-                        self.set_progress, progressbar_update_interval
-                    )
-                )
+            elif action == Action.INCUBATE:
+                self.start_timed_step(record.duration)
                 Logger.info(f"Incubate step {self.name} started at: {time.time()}")
 
-            if action == "RESET":
-                # TODO: set progress bar to be invisible
-                # Go down for a little while, in case forks are already in position
-                if device.DEVICE_TYPE == "R0":
-                    Logger.info(
-                        "No RESET work to be done on the R0, passing to end of program"
-                    )
-                    return
-                for addr in [WASTE_ADDR, LYSATE_ADDR]:
-                    pumps.purge(1, addr)
-                time.sleep(1)
-                for addr in [WASTE_ADDR, LYSATE_ADDR]:
-                    pumps.stop(addr)
-                    pumps.purge(-1, addr)
-                self.reset_stop_counter = 0
-                scheduled_events.append(
-                    Clock.schedule_interval(
-                        partial(
-                            self.switched_reset, "d2", WASTE_ADDR, 2, self.next_step
-                        ),
-                        switch_update_interval,
-                    )
-                )
-
-                scheduled_events.append(
-                    Clock.schedule_interval(
-                        partial(
-                            self.switched_reset, "d3", LYSATE_ADDR, 2, self.next_step
-                        ),
-                        switch_update_interval,
-                    )
-                )
-
-            if action == "RESET_WASTE":
+            elif action in (Action.RESET, Action.RESET_WASTE):
                 # TODO: set progress bar to be invisible
                 # Go down for a little while, in case forks are already in position
                 if device.DEVICE_TYPE == "R0":
@@ -319,206 +448,159 @@ class MachineActionScreen(ChipFlowScreen):
                         "No RESET work to be done on the R0, passing to end of program"
                     )
                     return
-                for addr in [WASTE_ADDR]:
-                    pumps.purge(1, addr)
-                time.sleep(1)
-                for addr in [WASTE_ADDR]:
-                    pumps.stop(addr)
-                    pumps.purge(-1, addr)
-                self.reset_stop_counter = 0
-                scheduled_events.append(
-                    Clock.schedule_interval(
-                        partial(
-                            self.switched_reset, "d2", WASTE_ADDR, 1, self.next_step
-                        ),
-                        switch_update_interval,
-                    )
-                )
+                self.homing = Homing(
+                    pumps,
+                    nano,
+                    scheduler,
+                    record.switches,
+                    record.addrs,
+                    poll_interval=switch_update_interval,
+                    group=self.name,
+                    on_switch=self.switch_reached,
+                    on_done=self.homing_done,
+                ).start()
+                arm_safety(record.addrs, self.homing.clear_time + self.homing.timeout)
 
             # TODO: make this work on r0
-            if action == "GRAB":
-                if POST_RUN_RATE_MM_CALIBRATION:
-                    Logger.debug("Using calibration post run rate values")
-                    post_run_rate_mm = POST_RUN_RATE_MM_CALIBRATION
-                else:
-                    post_run_rate_mm = params["post_run_rate_mm"]
-                if POST_RUN_VOL_ML_CALIBRATION:
-                    Logger.debug("Using calibration post run volume values")
-                    post_run_vol_ml = POST_RUN_VOL_ML_CALIBRATION
-                else:
-                    post_run_vol_ml = params["post_run_vol_ml"]
+            elif action in (Action.GRAB, Action.GRAB_WASTE):
+                post_run_rate_mm = record.rate
+                post_run_vol_ml = record.vol_ml
+                if action == Action.GRAB:
+                    if POST_RUN_RATE_MM_CALIBRATION:
+                        Logger.debug("Using calibration post run rate values")
+                        post_run_rate_mm = POST_RUN_RATE_MM_CALIBRATION
+                    if POST_RUN_VOL_ML_CALIBRATION:
+                        Logger.debug("Using calibration post run volume values")
+                        post_run_vol_ml = POST_RUN_VOL_ML_CALIBRATION
 
                 Logger.debug(
                     f"Using Post Run Rate MM: {post_run_rate_mm}, ML : {post_run_vol_ml}"
                 )
-                for addr in [WASTE_ADDR, LYSATE_ADDR]:
-                    Logger.debug(f"CDA: Grabbing pump {addr}")
-                    pumps.purge(1, addr)
-                self.grab_stop_counter = 0
-                swg1 = Clock.schedule_interval(
-                    partial(
-                        self.switched_grab,
-                        "d4",
-                        WASTE_ADDR,
-                        2,
-                        self.next_step,
-                        post_run_rate_mm,
-                        post_run_vol_ml,
-                    ),
-                    switch_update_interval,
-                )
-                scheduled_events.append(swg1)
-                swg2 = Clock.schedule_interval(
-                    partial(
-                        self.switched_grab,
-                        "d5",
-                        LYSATE_ADDR,
-                        2,
-                        self.next_step,
-                        post_run_rate_mm,
-                        post_run_vol_ml,
-                    ),
-                    switch_update_interval,
-                )
-                scheduled_events.append(swg2)
-                self.grab_overrun_check_schedule = Clock.schedule_once(
-                    partial(self.grab_overrun_check, [swg1, swg2]),
-                    grab_overrun_check_interval,
-                )
-                scheduled_events.append(self.grab_overrun_check_schedule)
-
-            if action == "GRAB_WASTE":
-                post_run_rate_mm = params["post_run_rate_mm"]
-                post_run_vol_ml = params["post_run_vol_ml"]
-                for addr in [WASTE_ADDR]:
-                    Logger.debug(f"CDA: Grabbing pump {addr}")
-                    pumps.purge(1, addr)
-                self.grab_stop_counter = 0
-                swg1 = Clock.schedule_interval(
-                    partial(
-                        self.switched_grab,
-                        "d4",
-                        WASTE_ADDR,
-                        1,
-                        self.next_step,
-                        post_run_rate_mm,
-                        post_run_vol_ml,
-                    ),
-                    switch_update_interval,
+                self.homing = SyringeGrab(
+                    pumps,
+                    nano,
+                    scheduler,
+                    record.switches,
+                    record.addrs,
+                    rate_mm=post_run_rate_mm,
+                    vol_ml=post_run_vol_ml,
+                    poll_interval=switch_update_interval,
+                    timeout=grab_overrun_check_interval,
+                    group=self.name,
+                    on_switch=self.switch_reached,
+                    on_done=self.homing_done,
+                ).start()
+                # Seeking, then grasping
+                arm_safety(
+                    record.addrs,
+                    self.homing.timeout + post_run_vol_ml / post_run_rate_mm * 60,
                 )
-                scheduled_events.append(swg1)
-                self.grab_overrun_check_schedule = Clock.schedule_once(
-                    partial(self.grab_overrun_check, [swg1]),
-                    grab_overrun_check_interval,
-                )
-                scheduled_events.append(self.grab_overrun_check_schedule)
 
             # Use this if you're changing the size of the syringe mid protocol
-            if action == "CHANGE_SYRINGE":
-                diameter = params["diam"]
-                pump_addr = params["pump_addr"]
-                pumps.set_diameter(diameter, pump_addr)
+            elif action == Action.CHANGE_SYRINGE:
+                pumps.set_diameter(record.diameter_mm, record.addr)
                 Logger.debug(
-                    f"Switching current loaded syringe to {diameter} diam on pump {pump_addr}"
+                    f"Switching current loaded syringe to {record.diameter_mm} diam on pump {record.addr}"
                 )
 
-            if action == "RELEASE":
+            elif action == Action.RELEASE:
                 # make a delay work
-                if params["target"] == "waste":
-                    addr = WASTE_ADDR
-                if params["target"] == "lysate":
-                    addr = LYSATE_ADDR
-                rate_mh = params["rate_mh"]
-                vol_ml = params["vol_ml"]
-                eq_time = params.get("eq_time", 0)
+                addr = record.addr
                 Logger.info(f"SENDING RELEASE COMMAND TO: Addr = {addr}")
-                pumps.set_rate(rate_mh, "MH", addr)
-                pumps.set_volume(vol_ml, "ML", addr)
+                pumps.set_rate(record.rate, "MH", addr)
+                pumps.set_volume(record.vol_ml, "ML", addr)
                 pumps.run(addr)
+                arm_safety(record.addrs, record.duration)
 
-    def switched_reset(self, switch, addr, max_count, final_action, dt):
-        if nano is None:
-            raise IOError("No switches on the R0 should not be calling a switch reset!")
-        nano.update()
-        if not getattr(nano, switch):
-            Logger.info(f"CDA: Switch {switch} actived, stopping pump {addr}")
-            pumps.stop(addr)
-            self.reset_stop_counter += 1
-            if self.reset_stop_counter == max_count:
-                Logger.debug("CDA: Both pumps homed")
-                final_action()
-            return False
-
-    def switched_grab(
-        self,
-        switch,
-        addr,
-        max_count,
-        final_action,
-        post_run_rate_mm,
-        post_run_vol_ml,
-        dt,
-    ):
-        if nano is None:
-            raise IOError("No switches on the R0 should not be calling switch grab!")
-        nano.update()
-        if not getattr(nano, switch):
-            Logger.info(f"CDA: Pump {addr} has grabbed syringe (switch {switch}).")
-            Logger.debug(
-                f"CDA: Running extra {post_run_vol_ml} ml @ {post_run_rate_mm} ml/min to grasp firmly."
-            )
-            pumps.stop(addr)
-            pumps.set_rate(post_run_rate_mm, "MM", addr)
-            pumps.set_volume(post_run_vol_ml, "ML", addr)
-            pumps.run(addr)
-            self.grab_stop_counter += 1
-            if self.grab_stop_counter == max_count:
-                Logger.debug("CDA: Both syringes grabbed")
-                self.grab_overrun_check_schedule.cancel()
-                final_action()
-            return False
-
-    def grab_overrun_check(self, swgs, dt):
-        if nano is None:
-            raise IOError(
-                "No switches on the R0, should not be calling grab_overrrun_check!"
-            )
-        nano.update()
-        overruns = []
-        if getattr(nano, "d4"):
-            overruns.append("1 (waste)")
-            swgs[0].cancel()
-        if getattr(nano, "d5"):
-            overruns.append("2 (lysate)")
-            swgs[1].cancel()
-        if overruns:
-            pumps.stop_all_pumps(list_of_pumps)
-            overruns_str = " and ".join(overruns)
-            plural = "s" if len(overruns) > 1 else ""
-            Logger.warning(f"CDA: Grab overrun in position{plural} {overruns_str}.")
-            self.show_fatal_error(
-                title=f"Syringe{plural} not detected",
-                description=f"Syringe{plural} not inserted correctly in positions{plural}{overruns_str}.\nPlease start the test over.",
-                confirm_text="Start over",
-                confirm_action="abort",
-                primary_color=(1, 0.33, 0.33, 1),
-            )
+    def switch_reached(self, axis):
+        telemetry.switch_triggered(axis.switch, axis.addr)
 
-    def set_progress(self, dt):
-        self.time_elapsed += dt
-        time_remaining = max(self.time_total - self.time_elapsed, 0)
-        self.time_remaining_min = int(time_remaining / 60)
-        self.time_remaining_sec = int(time_remaining % 60)
-        self.progress = self.time_elapsed / self.time_total * 100
-        if self.progress >= 100:
-            self.progress = 100
+    def homing_done(self, cycle):
+        if cycle.state == HomingState.DONE:
+            switch_log.debug("CDA: %s done in %.2f s", type(cycle).__name__, cycle.elapsed)
+            # A grab is still grasping, its pumps are confirmed once overdue
+            disarm_stopped([axis.addr for axis in cycle.axes])
             self.next_step()
-            return False
+            return
+        # The cycle stopped its own pumps, stop the others as well
+        pumps.stop_all_pumps(list_of_pumps)
+        targets = {addr: target for target, addr in PUMP_TARGET_ADDR.items()}
+        failed = [f"{axis.addr} ({targets[axis.addr]})" for axis in cycle.failed_axes]
+        failed_str = " and ".join(failed)
+        plural = "s" if len(failed) > 1 else ""
+        if cycle.state == HomingState.OVERRUN:
+            Logger.warning(f"CDA: Grab overrun in position{plural} {failed_str}.")
+            title = f"Syringe{plural} not detected"
+            description = f"Syringe{plural} not inserted correctly in position{plural} {failed_str}.\nPlease start the test over."
+        else:
+            Logger.warning(f"CDA: Homing timed out in position{plural} {failed_str}.")
+            title = f"Pump{plural} not homed"
+            description = f"Home switch{'es' if plural else ''} not reached in position{plural} {failed_str}.\nPlease start the test over."
+        self.show_fatal_error(
+            title=title,
+            description=description,
+            confirm_text="Start over",
+            confirm_action="abort",
+            primary_color=(1, 0.33, 0.33, 1),
+        )
+
+    def start_timed_step(self, time_total):
+        """Fix the end of the step as an absolute deadline, the GUI only
+        renders the time remaining until then."""
+        self.time_total = time_total
+        self.step_deadline = boundary_scheduler.clock() + time_total
+        boundary_scheduler.call_at(
+            self.step_deadline,
+            partial(self.boundary_reached, self.step_deadline),
+            group=self.name,
+        )
+        scheduler.call_every(
+            progressbar_update_interval, self.set_progress, group=self.name
+        )
+
+    def boundary_reached(self, deadline, dt):
+        # Runs on the timing thread, hand the step change over to the GUI
+        overrun = boundary_scheduler.clock() - deadline
+        Logger.info(f"CDA: Step {self.name} ended {overrun * 1000:.1f} ms after deadline")
+        Clock.schedule_once(partial(self.finish_timed_step, deadline))
+
+    def finish_timed_step(self, deadline, dt):
+        # Skipped, aborted or restarted while the boundary was in flight
+        if deadline != self.step_deadline or self.manager.current != self.name:
+            return
+        scheduler.cancel_group(self.name)
+        disarm_stopped()
+        self.render.update(countdown_text="00:00", progress=100)
+        self.render.flush()
+        self.next_step()
+
+    def set_progress(self, dt):
+        # Only what changed on the display is pushed, see RenderThrottle
+        time_remaining = max(self.step_deadline - scheduler.clock(), 0)
+        minutes, seconds = divmod(int(time_remaining), 60)
+        protocol_remaining = time_remaining + self.timeline.remaining_after(self.name)
+        if self.time_total > 0:
+            progress = min(100 - time_remaining / self.time_total * 100, 100)
+            progress = round(progress / progress_resolution) * progress_resolution
+        else:
+            progress = 100
+        self.render.update(
+            countdown_text=f"{minutes:02d}:{seconds:02d}",
+            protocol_remaining_text=f"{format_duration(protocol_remaining)} left",
+            progress=progress,
+        )
 
     def on_enter(self):
         self.start()
 
+    def on_leave(self):
+        # Nothing a step scheduled may outlive it
+        scheduler.cancel_group(self.name)
+        boundary_scheduler.cancel_group(self.name)
+        self.step_deadline = None
+
     def skip(self):
+        recorder.operator("skip", self.name)
         # Check that the motor is not moving
         # TODO make this work for pressure drive by checking if we've finished a step
         number_of_stopped_pumps = 0
@@ -530,7 +612,11 @@ class MachineActionScreen(ChipFlowScreen):
 
         if number_of_stopped_pumps == len(list_of_pumps):
             Logger.info("Skip button pressed. Moving to next step. ")
-            Clock.unschedule(self.set_progress)
+            if safety is not None:
+                # Every pump was read as stopped
+                safety.disarm()
+            scheduler.cancel_group(self.name)
+            boundary_scheduler.cancel_group(self.name)
             self.next_step()
         else:
             Logger.warning(
@@ -541,12 +627,12 @@ class MachineActionScreen(ChipFlowScreen):
 class ActionDoneScreen(ChipFlowScreen):
     def on_enter(self):
         pumps.buzz(repetitions=3, addr=WASTE_ADDR)
-        scheduled_events.append(Clock.schedule_once(self.next_step, 1))
+        scheduler.call_later(1, self.next_step, group=self.name)
 
 
 class FinishedScreen(ChipFlowScreen):
     def on_enter(self):
-        scheduled_events.append(Clock.schedule_once(self.start_over, 3))
+        scheduler.call_later(3, self.start_over, group=self.name)
 
 
 class ProgressDot(Widget):
@@ -575,6 +661,8 @@ class SteppedProgressBar(GridLayout):
         self.steps = [ProgressDot() for _ in range(noof_steps)]
         for s in self.steps:
             self.add_widget(s)
+        # Position the dots show, None before the first update
+        self._shown = None
         self.position = 0
         self._update()
 
@@ -582,20 +670,41 @@ class SteppedProgressBar(GridLayout):
         self.position = pos
         self._update()
 
+    def set_steps(self, noof_steps):
+        """Show ``noof_steps`` dots from the first one, only the dots that
+        are missing or too many are added or removed."""
+        while len(self.steps) > noof_steps:
+            self.remove_widget(self.steps.pop())
+        while len(self.steps) < noof_steps:
+            self.steps.append(ProgressDot())
+            self.add_widget(self.steps[-1])
+        self.cols = noof_steps
+        if self._shown is not None and self._shown >= noof_steps:
+            # Shown on a dot that was removed, every dot is updated
+            self._shown = None
+        self.set_position(0)
+
     def _update(self):
         # Check limits
         if self.position < 0:
             self.position = 0
         elif self.position > len(self.steps) - 1:
             self.position = len(self.steps) - 1
-        # Set all steps to correct status
-        for n, s in enumerate(self.steps):
+        # Only the dots between the old and the new position change
+        if self._shown is None:
+            changed = range(len(self.steps))
+        else:
+            low, high = sorted((self._shown, self.position))
+            changed = range(low, high + 1)
+        for n in changed:
+            s = self.steps[n]
             if self.position > n:
                 s.set_status("past")
             elif self.position == n:
                 s.set_status("present")
             elif self.position < n:
                 s.set_status("future")
+        self._shown = self.position
 
 
 class ErrorPopup(Popup):
@@ -613,6 +722,8 @@ class ErrorPopup(Popup):
 
     def confirm(self):
         Logger.debug("CDA: Error acknowledged by user")
+        screen = App.get_running_app().root.process_sm.current
+        recorder.operator("confirm", screen, popup=self.title)
         self.disabled = True
         self.confirm_action()
         self.dismiss()
@@ -635,12 +746,64 @@ class AbortPopup(Popup):
 
     def confirm(self):
         Logger.debug("CDA: Error acknowledged by user")
+        screen = App.get_running_app().root.process_sm.current
+        recorder.operator("confirm", screen, popup=self.title)
         self.disabled = True
         self.confirm_action()
         self.dismiss()
 
 
+class ProtocolEntryButton(ToggleButton):
+    """One protocol of the library with its indexed metadata."""
+
+    def __init__(self, *args, **kwargs):
+        self.entry = kwargs.pop("entry")
+        super().__init__(*args, **kwargs)
+        entry = self.entry
+        if entry.valid:
+            details = (
+                f"{format_duration(entry.duration_s)}   {entry.step_count} steps   "
+                f"waste {entry.waste_ml:g} mL   lysate {entry.lysate_ml:g} mL"
+            )
+        else:
+            details = f"[color=ff5555]{entry.error}[/color]"
+            self.disabled = True
+        self.text = f"[b]{entry.name}[/b]\n{details}"
+
+
 class ProtocolChooser(Screen):
+    selection = ListProperty([])
+    status_text = StringProperty("")
+
+    def on_pre_enter(self):
+        self.refresh()
+
+    def refresh(self):
+        # Indexing reads and compiles files, keep it off the GUI thread
+        self.status_text = "Updating protocol library..."
+        self.index_thread = IndexThread(
+            self.get_file_path(),
+            on_entries=lambda entries: Clock.schedule_once(
+                partial(self.show_entries, entries)
+            ),
+            db_path=protocol_index_path,
+        )
+        self.index_thread.start()
+
+    def show_entries(self, entries, dt=None):
+        protocol_list = self.ids.protocol_list
+        protocol_list.clear_widgets()
+        self.selection = []
+        for entry in entries:
+            protocol_list.add_widget(
+                ProtocolEntryButton(entry=entry, on_release=self.select)
+            )
+        invalid = sum(not entry.valid for entry in entries)
+        self.status_text = f"{invalid} invalid protocol(s)" if invalid else ""
+
+    def select(self, btn):
+        self.selection = [btn.entry.path] if btn.state == "down" else []
+
     def load(self, path, filename):
         try:
             filename = filename[0]
@@ -662,27 +825,63 @@ class ProtocolChooser(Screen):
 
     def cancel(self):
         Logger.info("Cancel")
-        self.manager.current = "home"
+        self.manager.show("home")
+
+
+class SummaryRow(BoxLayout):
+    """One row of the summary table, recycled by the RecycleView."""
+
+    step = StringProperty("")
+    material = StringProperty("")
+    flowrate = StringProperty("")
+    volume = StringProperty("")
+    duration = StringProperty("")
+    bold = BooleanProperty(False)
+
+
+def summary_table(timeline):
+    """RecycleView data of the summary table, one row per machine step and
+    the totals at the end."""
+    columns = ("step", "material", "flowrate", "volume", "duration")
+    data = [
+        dict(zip(columns, map(str, line)), bold=False)
+        for line in timeline.summary_rows()
+    ]
+    volumes = timeline.volume_totals()
+    total_row = [
+        "",
+        "Total",
+        "",
+        f"W {volumes['waste']:g} / L {volumes['lysate']:g}",
+        format_duration(timeline.total),
+    ]
+    data.append(dict(zip(columns, total_row), bold=True))
+    return data
 
 
 class SummaryScreen(Screen):
     def __init__(self, *args, **kwargs):
-        # on windows this is the entire path
-        self.protocol = App.get_running_app().protocol_name
-        self.path = App.get_running_app().protocol_path
-        Logger.info(f"Summary screen path {self.path} and protocol {self.protocol}")
         self.next_text = kwargs.pop("next_text", "Next")
+        self.timeline = kwargs.pop("timeline")
         self.header_text = App.get_running_app().protocol_name.stem
-        self.protocol_process = ProcessProtocol(self.path / self.protocol)
         super().__init__(*args, **kwargs)
-        self.add_rows()
+        # Only the visible rows get widgets, the table is computed off the
+        # GUI thread and filled in when it is ready
+        self.table_thread = threading.Thread(
+            target=self.compute_table, name="SummaryTable", daemon=True
+        )
+        self.table_thread.start()
 
-    def add_rows(self):
-        """Return content of rows as one formatted string, roughly table shape."""
-        summary_layout = self.ids.summary_layout
-        for line in self.protocol_process.list_steps():
-            for entry in line:
-                summary_layout.add_widget(Label(text=str(entry)))
+    def compute_table(self):
+        try:
+            data = summary_table(self.timeline)
+        except Exception:
+            Logger.exception("CDA: Computing the summary table failed")
+            return
+        Clock.schedule_once(partial(self.show_table, data))
+
+    def show_table(self, data, dt=None):
+        self.ids.summary_view.data = data
 
 
 class CircleButton(Widget):
@@ -714,7 +913,9 @@ class ProcessWindow(BoxLayout):
         self.protocol_file_name = kwargs.pop("protocol_file_name")
         super().__init__(*args, **kwargs)
 
-        self.process_sm = ProcessScreenManager(main_window=self)
+        self.process_sm = ProcessScreenManager(
+            main_window=self, screen_factory=self.build_screen
+        )
         self.progress_screen_names = []
 
         # TODO: break protocol loading into its own method
@@ -722,20 +923,21 @@ class ProcessWindow(BoxLayout):
         app_copy = App.get_running_app()
         file_path = app_copy.protocol_path / app_copy.protocol_name
 
+        self.overall_progress_bar = None
         self.load_protocol(file_path)
-        self.overall_progress_bar = SteppedProgressBar(
-            steps=len(self.progress_screen_names)
-        )  # , size_hint_y = 0.15)
 
         self.abort_btn = AbortButton(
             disabled=False, size_hint_x=None, on_release=self.show_abort_popup
         )
 
         self.refresh_btn = RefreshButton(disabled=False, on_release=self.get_updates)
+        self.updating = False
 
         protocol_chooser = ProtocolChooser(name="protocol_chooser")
         self.process_sm.add_widget(protocol_chooser)  # add screen for protocol chooser
-        # self.ids.top_bar.add_widget(self.refresh_btn)
+        self.ids.top_bar.add_widget(self.refresh_btn)
+        self.process_sm.bind(current=self.enable_updates)
+        self.enable_updates(self.process_sm, self.process_sm.current)
         self.ids.top_bar.add_widget(self.overall_progress_bar)
         self.ids.top_bar.add_widget(self.abort_btn)
         self.ids.main.add_widget(self.process_sm)
@@ -747,11 +949,75 @@ class ProcessWindow(BoxLayout):
     def _keydown(self, *args):
         Logger.debug("Key pressed: {args}")
   
+    def enable_updates(self, manager, name):
+        # Updates are only installed between runs, one at a time
+        self.refresh_btn.disabled = self.updating or name not in (
+            "home",
+            "protocol_chooser",
+        )
+
     def get_updates(self, btn):
         Logger.info("Update button pressed")
-        get_updates()
+        try:
+            updater = create_updater(device)
+        except UpdateError as err:
+            self.show_update_result(None, err)
+            return
+        self.updating = True
+        btn.disabled = True
+        self.update_thread = UpdateThread(
+            updater,
+            on_progress=lambda *args: Clock.schedule_once(
+                partial(self.show_update_progress, btn, *args)
+            ),
+            on_done=lambda *args: Clock.schedule_once(
+                partial(self.show_update_result, *args)
+            ),
+        )
+        self.update_thread.start()
+
+    def show_update_progress(self, btn, stage, done, total, dt=None):
+        btn.text = f"{int(100 * done / total) if total else 100}%"
+        Logger.debug(f"CDA: Update {stage} {done}/{total}")
+
+    def show_update_result(self, version, error, dt=None):
+        self.updating = False
+        self.enable_updates(self.process_sm, self.process_sm.current)
+        self.refresh_btn.text = "U"
+        popup_outside_padding = 60
+        if error is not None:
+            popup = ErrorPopup(
+                title="Update failed",
+                description=f"The update could not be installed: {error}",
+                confirm_text="OK",
+                confirm_action=lambda: None,
+                size_hint=(None, None),
+                size=(800 - popup_outside_padding, 480 - popup_outside_padding),
+            )
+        elif version is None:
+            popup = ErrorPopup(
+                title="Up to date",
+                description="The device is already running the latest software.",
+                confirm_text="OK",
+                confirm_action=lambda: None,
+                size_hint=(None, None),
+                size=(800 - popup_outside_padding, 480 - popup_outside_padding),
+            )
+        else:
+            popup = AbortPopup(
+                title="Update installed",
+                description=f"Release {version} was installed. Reboot to start using it.",
+                dismiss_text="Later",
+                confirm_text="Reboot now",
+                confirm_action=self.reboot,
+                primary_color=(0.33, 0.66, 1, 1),
+                size_hint=(None, None),
+                size=(800 - popup_outside_padding, 480 - popup_outside_padding),
+            )
+        popup.open()
 
     def show_abort_popup(self, btn):
+        recorder.operator("abort_popup", self.process_sm.current)
         popup_outside_padding = 60
         if self.process_sm.current == "home":
             abort_poup = AbortPopup(
@@ -796,10 +1062,32 @@ class ProcessWindow(BoxLayout):
         abort_poup.open()
 
     def abort(self):
+        recorder.operator("abort", self.process_sm.current)
+        # The run ends once its pumps are stopped
         self.cleanup()
-        self.process_sm.current = self.progress_screen_names[0]
+        finish_run("aborted", cause="operator")
+        self.process_sm.show(self.progress_screen_names[0])
         self.overall_progress_bar.set_position(0)
 
+    def safety_tripped(self, trip):
+        """The SafetyWatchdog stopped pumps, the run cannot go on."""
+        stopped = " and ".join(str(addr) for addr in trip["trip"])
+        Logger.error(f"CDA: Safety watchdog stopped pump {stopped}: {trip['reason']}")
+        if not telemetry.active:
+            return
+        # No step may keep counting down with its pumps stopped
+        self.cleanup()
+        self.show_fatal_error(
+            header="Pumps stopped",
+            description=(
+                f"The safety watchdog stopped pump {stopped}, {trip['reason']}.\n"
+                "Discard all used kit equipment and start the test over."
+            ),
+            confirm_text="Start over",
+            confirm_action="abort",
+            primary_color=(1, 0.33, 0.33, 1),
+        )
+
     def shutdown(self):
         self.cleanup()
         shutdown()
@@ -814,6 +1102,7 @@ class ProcessWindow(BoxLayout):
 
     def show_fatal_error(self, *args, **kwargs):
         Logger.debug("CDA: Showing fatal error popup")
+        cause = kwargs.get("title") or kwargs.get("header", "Fatal Error")
         popup_outside_padding = 60
         confirm_action = kwargs.pop("confirm_action", self.reboot)
         if confirm_action == "shutdown":
@@ -836,134 +1125,138 @@ class ProcessWindow(BoxLayout):
         )
         error_window.open()
         pumps.buzz(addr=WASTE_ADDR, repetitions=5)
+        finish_run("failed", cause=cause)
 
     def start_over(self):
         Logger.info("Sending Program to home screen")
-        self.process_sm.current = "home"
+        finish_run("finished")
+        self.process_sm.show("home")
+
+    def press_next(self):
+        """The next button of the home, user action and summary screens."""
+        recorder.operator("next", self.process_sm.current)
+        self.next_step()
 
     def next_step(self):
+        previous = self.process_sm.current
         self.process_sm.next_screen()
+        self.record_transition(previous, self.process_sm.current)
         if self.process_sm.current in self.progress_screen_names:
             pos = self.progress_screen_names.index(self.process_sm.current)
             self.overall_progress_bar.set_position(pos)
 
+    def record_transition(self, previous, current):
+        # A run starts when the operator leaves the home screen and ends when
+        # the protocol wraps around to it
+        if current == self.progress_screen_names[0]:
+            finish_run("finished")
+            return
+        if not telemetry.active and previous == self.progress_screen_names[0]:
+            # Metrics and stalls are reported per run
+            Metrics.REGISTRY.reset()
+            frame_watchdog.reset()
+            telemetry.start_run(self.protocol, self.protocol_name, device.DEVICE_TYPE)
+            recorder.start(
+                recording_dir
+                / f"{datetime.now():%Y-%m-%d_%H%M%S}-run{telemetry.run_id}.jsonl",
+                protocol_file=self.protocol_file.name,
+                protocol_source=self.protocol_file.read_text(),
+                start_step=START_STEP,
+                start_screen=previous,
+                device=device.DEVICE_TYPE,
+            )
+        telemetry.step_started(current)
+
     def cleanup(self):
         # Global cleanup
         cleanup()
         # TODO: Any local cleanup?
 
     def load_protocol(self, path_to_protocol):
-        # Load protocol and add screens accordingly
-        with open(path_to_protocol, "r") as f:
-            protocol = json.loads(f.read(), object_pairs_hook=OrderedDict)
-
-        if START_STEP not in protocol.keys():
-            raise KeyError(f"{START_STEP} not a valid step in the protocol.")
-
-        # if we're supposed to start at a step other than 'home' remove other steps from the protocol
-        protocol_copy = OrderedDict()
-        keep_steps = False
-        for name, step in protocol.items():
-            if name == START_STEP:
-                keep_steps = True
-            if keep_steps:
-                protocol_copy[name] = step
-
-        protocol = protocol_copy
-
-        if self.process_sm.has_screen("protocol_chooser"):
-            protocol_chooser = self.process_sm.get_screen("protocol_chooser")
-            self.process_sm.clear_widgets()
-            self.process_sm.add_widget(
-                protocol_chooser
-            )  # add screen for protocol chooser
-
-        if len(self.process_sm.screens) > 1:
-            Logger.warning(
-                "Screen Removal was not sucessful, remaining screens should be 1"
-            )
-        Logger.info(
-            f"Number of screens in screen manager after Removal: {len(self.process_sm.screens)}"
-        )
-        Logger.info(
-            f"Screens in screen manager after Removal: {self.process_sm.screen_names}"
+        # Compile the protocol (or reuse its cached compilation) and describe
+        # its screens, they are built when shown
+        protocol = compile_file(
+            path_to_protocol, PUMP_TARGET_ADDR, cache_dir=protocol_cache_dir
         )
+        # if we're supposed to start at a step other than 'home' remove other steps from the protocol
+        protocol = protocol.start_at(START_STEP)
 
-        for name, step in protocol.items():
-
-            screen_type = step.get("type", None)
-            if screen_type == "UserActionScreen":
-                if name == "home":
-                    this_screen = HomeScreen(
-                        name,
-                        header=step.get("header", "NO HEADER"),
-                        description=step.get("description", "NO DESCRIPTION"),
-                        next_text=step.get("next_text", "Next"),
-                    )
-                elif name == "summary":
-                    this_screen = SummaryScreen(next_text=step.get("next_text", "Next"))
-
-                else:
-                    this_screen = UserActionScreen(
-                        name=name,
-                        header=step.get("header", "NO HEADER"),
-                        description=step.get("description", "NO DESCRIPTION"),
-                        next_text=step.get("next_text", "Next"),
-                    )
-            elif screen_type == "MachineActionScreen":
-                this_screen = MachineActionScreen(
-                    name=name,
-                    header=step["header"],
-                    description=step.get("description", ""),
-                    action=step["action"],
-                )
-                # TODO: clean up how this works
-                if step.get("remove_progress_bar", False):
-                    this_screen.children[0].remove_widget(
-                        this_screen.ids.progress_bar_layout
-                    )
-                    this_screen.children[0].remove_widget(
-                        this_screen.ids.skip_button_layout
-                    )
-
-                # Don't offer skip button in production
-                if not DEBUG_MODE:
-                    this_screen.children[0].remove_widget(
-                        this_screen.ids.skip_button_layout
-                    )
-            else:
-                if screen_type is None:
-                    raise TypeError(
-                        "Corrupt protocol. Every protocol step must contain a 'type' key."
-                    )
-                else:
-                    raise TypeError(
-                        "Corrupt protocol. Unrecognized 'type' key: {}".format(
-                            screen_type
-                        )
-                    )
-            self.progress_screen_names.append(this_screen.name)
-            self.process_sm.add_widget(this_screen)
-
-            completion_msg = step.get("completion_msg", None)
-            if completion_msg:
-                self.process_sm.add_widget(
-                    ActionDoneScreen(
-                        name=this_screen.name + "_done", header=completion_msg
-                    )
-                )
-
-        Logger.debug(f"Screens in manager after load: {self.process_sm.screen_names} ")
-        Logger.debug(
-            f"Number of screens after load: {len(self.process_sm.screen_names)}"
-        )
+        descriptors = []
+        progress_screen_names = []
+        for step in protocol:
+            descriptors.append(StepDescriptor(step.name, step.kind.name.lower(), step))
+            progress_screen_names.append(step.name)
+            if step.completion_msg:
+                descriptors.append(StepDescriptor(step.name + "_done", "done", step))
 
-        check_dups = self.screenduplicates(self.process_sm.screen_names)
+        check_dups = self.screenduplicates(d.name for d in descriptors)
         Logger.info(f"Number of duplicates after load: {check_dups}")
         dups = any(val > 1 for val in check_dups.values())
         if dups:
             Logger.error("Found duplicate screens in load!")
-        self.process_sm.current = "home"
+
+        self.protocol = protocol
+        self.protocol_name = Path(path_to_protocol).stem
+        self.protocol_file = Path(path_to_protocol)
+        self.timeline = protocol.timeline
+        self.progress_screen_names = progress_screen_names
+        self.build_progress_bar()
+        self.process_sm.load_sequence(descriptors)
+        Logger.debug(f"Screens in protocol after load: {self.process_sm.sequence} ")
+        self.process_sm.show(self.process_sm.sequence[0])
+
+    def build_progress_bar(self):
+        # One dot per step of the loaded protocol, the bar of the protocol
+        # loaded before is reused
+        steps = len(self.progress_screen_names)
+        if self.overall_progress_bar is None:
+            self.overall_progress_bar = SteppedProgressBar(steps=steps)
+        else:
+            self.overall_progress_bar.set_steps(steps)
+
+    def build_screen(self, descriptor):
+        """Screen factory for the process screen manager."""
+        name, step = descriptor.name, descriptor.step
+        Logger.debug(f"CDA: Building screen {name}")
+        if descriptor.kind == "home":
+            return HomeScreen(
+                name,
+                header=step.header,
+                description=step.description,
+                next_text=step.next_text,
+            )
+        if descriptor.kind == "summary":
+            return SummaryScreen(
+                name=name,
+                next_text=step.next_text,
+                timeline=self.timeline,
+            )
+        if descriptor.kind == "user":
+            return UserActionScreen(
+                name=name,
+                header=step.header,
+                description=step.description,
+                next_text=step.next_text,
+            )
+        if descriptor.kind == "done":
+            return ActionDoneScreen(name=name, header=step.completion_msg)
+
+        this_screen = MachineActionScreen(
+            name=name,
+            header=step.header,
+            description=step.description,
+            action=step.actions,
+            timeline=self.timeline,
+        )
+        # TODO: clean up how this works
+        if step.remove_progress_bar:
+            this_screen.children[0].remove_widget(this_screen.ids.progress_bar_layout)
+            this_screen.children[0].remove_widget(this_screen.ids.skip_button_layout)
+
+        # Don't offer skip button in production
+        if not DEBUG_MODE:
+            this_screen.children[0].remove_widget(this_screen.ids.skip_button_layout)
+        return this_screen
 
     def screenduplicates(self, screen_names):
         list_of_screen_names = {}
@@ -982,12 +1275,42 @@ class ChipFlowApp(App):
         super().__init__(**kwargs)
 
     def build(self):
+        global telemetry
+        # Pump, switch and device logs are written off the main thread
+        LogPipeline.install(level=logging.DEBUG if DEBUG_MODE else logging.INFO)
+        if telemetry is None:
+            telemetry = TelemetryRecorder(telemetry_path)
+            pumps.command_listener = telemetry.pump_command
+        if device.METRICS_PORT:
+            Metrics.start_server(device.METRICS_PORT)
+        Clock.schedule_interval(Metrics.frame_time.observe, 0)
+        Clock.schedule_interval(frame_watchdog.tick, 0)
+        frame_watchdog.start()
+        if safety is not None:
+            try:
+                safety.start()
+            except IOError as err:
+                Logger.error(f"CDA: Pumps are not guarded by the safety watchdog: {err}")
+            # From the main loop, a hung loop stops the heartbeat
+            Clock.schedule_interval(self.check_safety, HEARTBEAT_INTERVAL)
         Logger.debug("CDA: Creating main window")
         return ProcessWindow(protocol_file_name=self.protocol_name)
 
+    def check_safety(self, dt):
+        for trip in safety.poll():
+            # The replies to its stops are on our serial port
+            pumps.discard_replies()
+            self.root.safety_tripped(trip)
+        # After the replies to its stops are dropped
+        disarm_stopped(safety.overdue())
+
     def key_action(self, *args):
         Logger.debug(f"got a key event: {list(args)}")
 
+    def on_stop(self):
+        if safety is not None:
+            safety.close()
+
     def on_close(self):
         cleanup()
         if not DEBUG_MODE:
@@ -1,9 +1,32 @@
 import json
 import logging
-from git import Repo
-import cd_alpha
 import os
+import shutil
+import sys
 from pkg_resources import resource_filename
+from cd_alpha.Updater import Updater, UpdateError, update_source_from_config
+
+log = logging.getLogger("cd_alpha.device")
+
+DEVICE_CONFIG_ENV = "CD_ALPHA_DEVICE_CONFIG"
+DEVICE_CONFIG_PATH = os.path.expanduser("~/.cd_alpha/device_config.json")
+
+
+def device_config_path():
+    """
+    The device_config.json of this device. It is not part of a release, an
+    update would replace it otherwise, and is looked up in order at
+
+    - the path in the CD_ALPHA_DEVICE_CONFIG environment variable
+    - DEVICE_CONFIG_PATH, outside of the installed releases
+    - the cd_alpha package, in a git checkout of a development machine
+    """
+    path = os.environ.get(DEVICE_CONFIG_ENV)
+    if path:
+        return path
+    if os.path.exists(DEVICE_CONFIG_PATH):
+        return DEVICE_CONFIG_PATH
+    return resource_filename("cd_alpha", "device_config.json")
 
 
 class Device:
@@ -35,6 +58,10 @@ class Device:
         This is usefull when doing graphical/app dev,
         or anytime you wish to run the program not on a properly configured device
 
+    DEV_SERIAL_PUMPS: bool
+        - On a DEV_MACHINE, talk to the pumps over PUMP_SERIAL_ADDR anyway, e.g. to
+        the pump emulator in software_testing/PumpEmulator.py (default is False)
+
     PUMP_SERIAL_ADDR: str
         - Serial address for the pump/pump network. Defaults to "/dev/ttyUSB0" on linux
         which shouldn't need to be changed
@@ -57,6 +84,29 @@ class Device:
     DEBUG_MODE: bool
         - Puts the program in debug mode, for dev use only (default is False)
 
+    SAFETY_WATCHDOG: bool
+        - Stop the pumps from a separate process when the app dies or hangs, see
+        SafetyWatchdog.py. Only used when the pumps are on a serial port
+        (default is True)
+
+    SAFETY_HEARTBEAT_TIMEOUT: float
+        - Seconds without a heartbeat of the app before the watchdog stops the
+        pumps. Keep it well above the 8 s a pump command may take with its
+        retries, the heartbeat waits for it (default is 30)
+
+    UPDATE_SOURCE: str
+        - Location of the release bundles used by the updater. Either an
+        http(s) URL or a local directory (e.g. a mounted USB stick). Updates are
+        disabled when not set.
+
+    UPDATE_ROOT: str
+        - Directory holding the installed releases and the "current" symlink
+        the device is started from. Defaults to "/home/pi/cd_alpha_releases"
+
+    METRICS_PORT: int
+        - Port of the metrics endpoint, only reachable from the device itself
+        (127.0.0.1). Defaults to 9464, 0 or null disables it
+
 
     """
 
@@ -69,6 +119,9 @@ class Device:
         V0_LYSATE_DIAMETER_DEFAULT = 12.55
         POST_RUN_RATE_MM_DEFAULT = None
         POST_RUN_VOL_ML_DEFAULT = None
+        UPDATE_ROOT_DEFAULT = "/home/pi/cd_alpha_releases"
+        METRICS_PORT_DEFAULT = 9464
+        SAFETY_HEARTBEAT_TIMEOUT_DEFAULT = 30.0
 
         try:
             with open(config_file_json) as f:
@@ -84,7 +137,8 @@ class Device:
                     self.__setattr__(key, config_file_dict[key])
 
             # Set univeral defaults
-            if not hasattr(self, "PUMP_SERIAL_ADDR"):
+            # The template leaves it empty
+            if not getattr(self, "PUMP_SERIAL_ADDR", ""):
                 self.PUMP_SERIAL_ADDR = "/dev/ttyUSB0"
 
             if not hasattr(self, "DEBUG_MODE"):
@@ -96,6 +150,9 @@ class Device:
             if not hasattr(self, "DEV_MACHINE"):
                 self.DEV_MACHINE = False
 
+            if not hasattr(self, "DEV_SERIAL_PUMPS"):
+                self.DEV_SERIAL_PUMPS = False
+
             if not hasattr(self, "START_STEP"):
                 self.START_STEP = "home"
 
@@ -105,6 +162,21 @@ class Device:
             if not hasattr(self, "POST_RUN_VOL_ML"):
                 self.POST_RUN_VOL_ML = POST_RUN_VOL_ML_DEFAULT
 
+            if not hasattr(self, "SAFETY_WATCHDOG"):
+                self.SAFETY_WATCHDOG = True
+
+            if not hasattr(self, "SAFETY_HEARTBEAT_TIMEOUT"):
+                self.SAFETY_HEARTBEAT_TIMEOUT = SAFETY_HEARTBEAT_TIMEOUT_DEFAULT
+
+            if not hasattr(self, "UPDATE_SOURCE"):
+                self.UPDATE_SOURCE = None
+
+            if not hasattr(self, "UPDATE_ROOT"):
+                self.UPDATE_ROOT = UPDATE_ROOT_DEFAULT
+
+            if not hasattr(self, "METRICS_PORT"):
+                self.METRICS_PORT = METRICS_PORT_DEFAULT
+
             # Set defaults based on device type
             if self.DEVICE_TYPE == "R0":
                 if not hasattr(self, "PUMP_ADDR"):
@@ -122,25 +194,49 @@ class Device:
             else:
                 raise ValueError("Device type was not either V0 or R0 (Case sensitive)")
 
-            print(vars(self))
+            log.debug("Device config: %s", dict(vars(self)))
 
         except IOError:
             logging.error("device_config.json was not found or could not be opened.")
 
 
+def keep_device_config():
+    """Copy the device_config.json of a device that was set up in a git
+    checkout to DEVICE_CONFIG_PATH, where the releases it updates to read it."""
+    path = device_config_path()
+    if os.environ.get(DEVICE_CONFIG_ENV) or path == DEVICE_CONFIG_PATH:
+        return
+    try:
+        os.makedirs(os.path.dirname(DEVICE_CONFIG_PATH), exist_ok=True)
+        shutil.copyfile(path, DEVICE_CONFIG_PATH)
+    except OSError as err:
+        raise UpdateError(
+            f"Could not copy {path} to {DEVICE_CONFIG_PATH}: {err}"
+        ) from err
+    log.info("Device config copied to %s", DEVICE_CONFIG_PATH)
+
+
+def create_updater(device, progress=None):
+    source = update_source_from_config(device.UPDATE_SOURCE)
+    # Copied when the update runs, on the update thread of the app
+    return Updater(
+        source, device.UPDATE_ROOT, progress=progress, prepare=keep_device_config
+    )
+
+
 def get_updates():
-    # Pull in current directory
-    repo = Repo(os.path.dirname(cd_alpha.__file__), search_parent_directories=True)
+    """Console entry point, install the latest release from UPDATE_SOURCE."""
+
+    def print_progress(stage, done, total):
+        print(f"{stage}: {done}/{total}")
 
+    device = Device(device_config_path())
     try:
-        assert repo.remotes.origin.exists()
-        repo.remotes.origin.fetch()
-        repo.remotes.origin.pull()
-        print(
-            (
-                f"Update was successful, with message:"
-                f"{repo.commit(repo.active_branch.name).message}"
-            )
-        )
-    except Exception:
-        logging.warning("COULDN'T PULL REPO, NO INTERENT CONNECTION!!")
+        version = create_updater(device, progress=print_progress).update()
+    except UpdateError as err:
+        logging.error(f"Update failed: {err}")
+        sys.exit(1)
+    if version is None:
+        print("Already up to date.")
+    else:
+        print(f"Update to release {version} was successful, restart to apply.")
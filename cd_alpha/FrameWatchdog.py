@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+"""
+Find out what freezes the GUI.
+
+The Kivy main loop calls ``FrameWatchdog.tick`` every frame. A sampler thread
+checks how long ago the last tick was and, once a frame runs longer than the
+threshold, takes the stack of the main thread every ``sample_interval`` until
+the frame ends. Each stall is attributed to the call site seen most often in
+its samples, the innermost line of cd_alpha code on the stack, e.g. the
+``time.sleep(1)`` in the RESET branch of MachineActionScreen.start.
+
+Stalls are aggregated by call site into a report per run:
+
+    site                                   count  total (s)  max (s)
+    ChipFlowApp.py:377 in start                2      2.004    1.002
+"""
+
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+DEFAULT_REPORT_DIR = Path.home() / ".local" / "share" / "cd_alpha" / "stalls"
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+log = logging.getLogger("cd_alpha.watchdog")
+
+
+def call_site(stack):
+    """The innermost cd_alpha frame of an extracted stack, or the innermost
+    frame when no app code is on it."""
+    for frame in reversed(stack):
+        if frame.filename.startswith(PACKAGE_DIR) and frame.filename != __file__:
+            break
+    else:
+        frame = stack[-1]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+
+
+class StallSite:
+
+    __slots__ = ("site", "count", "total_s", "max_s", "stack")
+
+    def __init__(self, site, stack):
+        self.site = site
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.stack = stack
+
+    def add(self, duration, stack):
+        self.count += 1
+        self.total_s += duration
+        if duration >= self.max_s:
+            self.max_s = duration
+            self.stack = stack
+
+    def as_dict(self):
+        return {
+            "site": self.site,
+            "count": self.count,
+            "total_s": self.total_s,
+            "max_s": self.max_s,
+            "stack": self.stack,
+        }
+
+
+class FrameWatchdog:
+    """
+    threshold_s: float
+        - frames longer than this are stalls
+    sample_interval: float
+        - seconds between two checks of the sampler thread
+    thread_id: int
+        - thread of the main loop, the thread that creates the watchdog by default
+    """
+
+    def __init__(self, threshold_s=0.25, sample_interval=0.02, thread_id=None):
+        self.threshold_s = threshold_s
+        self.sample_interval = sample_interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.last_tick = time.perf_counter()
+        self.sites = {}
+        self.frames = 0
+        self._samples = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="FrameWatchdog", daemon=True)
+
+    def start(self):
+        self.last_tick = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.thread.join()
+
+    def tick(self, *args):
+        """Call once per frame from the main loop, e.g. as a Kivy clock
+        interval callback."""
+        now = time.perf_counter()
+        duration = now - self.last_tick
+        self.last_tick = now
+        self.frames += 1
+        if not self._samples:
+            return
+        with self._lock:
+            samples, self._samples = self._samples, []
+        if duration < self.threshold_s:
+            return
+        counts = collections.Counter(site for site, _ in samples)
+        site = counts.most_common(1)[0][0]
+        stack = traceback.format_list(next(stack for s, stack in samples if s == site))
+        if site not in self.sites:
+            self.sites[site] = StallSite(site, stack)
+        self.sites[site].add(duration, stack)
+        log.info("FWD: Frame took %.0f ms, blocked at %s", duration * 1000, site)
+
+    def _run(self):
+        while not self._stopped.wait(self.sample_interval):
+            if time.perf_counter() - self.last_tick < self.threshold_s:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            with self._lock:
+                self._samples.append((call_site(stack), stack))
+
+    def reset(self):
+        self.sites = {}
+        self.frames = 0
+
+    def report(self):
+        """Stall sites, the longest total first."""
+        return sorted(self.sites.values(), key=lambda s: s.total_s, reverse=True)
+
+    def format_report(self):
+        lines = [f"{'site':<48}{'count':>6}{'total (s)':>11}{'max (s)':>9}"]
+        for s in self.report():
+            lines.append(f"{s.site:<48}{s.count:>6}{s.total_s:>11.3f}{s.max_s:>9.3f}")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Write the report as json, returns the path."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "threshold_s": self.threshold_s,
+            "frames": self.frames,
+            "stalls": [s.as_dict() for s in self.report()],
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=4)
+        return path
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+"""
+Numeric readouts drawn from glyph textures rendered once.
+
+A Label rasterises its whole text into a texture every time the text
+changes, the countdown and percentage of a timed step change every second
+for hours. A DigitLabel instead draws one textured rectangle per character,
+the textures come from a GlyphAtlas that renders each character of a font
+once and keeps it. A new value only moves rectangles and swaps textures.
+
+DigitLabel is used from kv like a Label, for short single line texts:
+
+    DigitLabel:
+        text: "{:0.0f}%".format(root.progress)
+        font_size: dp(20)
+        halign: "center"
+
+Characters are rendered the first time they are shown, digits and the
+usual separators when the atlas is created. There is no kerning, which
+digits in the fonts of the app do not have.
+"""
+
+from kivy.clock import Clock
+from kivy.core.text import Label as CoreLabel
+from kivy.graphics import Color, Rectangle
+from kivy.properties import (
+    BooleanProperty,
+    ColorProperty,
+    ListProperty,
+    NumericProperty,
+    OptionProperty,
+    StringProperty,
+)
+from kivy.uix.widget import Widget
+
+DIGITS = "0123456789:.%- "
+
+
+class GlyphAtlas:
+    """
+    Textures of the single characters of one font.
+
+    font_name: str
+    font_size: float
+        - in pixels
+    bold: bool
+    """
+
+    _atlases = {}
+
+    def __init__(self, font_name, font_size, bold):
+        self.font_name = font_name
+        self.font_size = font_size
+        self.bold = bold
+        self.glyphs = {}
+        self.textures_created = 0
+        for char in DIGITS:
+            self.glyph(char)
+
+    @classmethod
+    def get(cls, font_name, font_size, bold=False):
+        """The shared atlas of a font."""
+        key = (font_name, round(font_size, 2), bold)
+        atlas = cls._atlases.get(key)
+        if atlas is None:
+            atlas = cls._atlases[key] = cls(font_name, font_size, bold)
+        return atlas
+
+    def glyph(self, char):
+        texture = self.glyphs.get(char)
+        if texture is None:
+            label = CoreLabel(
+                text=char,
+                font_name=self.font_name,
+                font_size=self.font_size,
+                bold=self.bold,
+            )
+            label.refresh()
+            texture = self.glyphs[char] = label.texture
+            self.textures_created += 1
+        return texture
+
+    @property
+    def line_height(self):
+        return self.glyph("0").height
+
+
+class DigitLabel(Widget):
+    """Label of a short numeric text, composed from GlyphAtlas textures.
+    The text is laid out once per frame however often it is set."""
+
+    text = StringProperty("")
+    font_name = StringProperty("Roboto")
+    # The default of a Label
+    font_size = NumericProperty("15sp")
+    bold = BooleanProperty(False)
+    color = ColorProperty([1, 1, 1, 1])
+    halign = OptionProperty("center", options=["left", "center", "right"])
+    valign = OptionProperty("middle", options=["bottom", "middle", "top"])
+    texture_size = ListProperty([0, 0])
+
+    def __init__(self, **kwargs):
+        self._rects = []
+        self._trigger_layout = Clock.create_trigger(self.layout_glyphs, -1)
+        super().__init__(**kwargs)
+        with self.canvas:
+            self._color = Color(*self.color)
+        self.fbind("color", self._update_color)
+        for name in (
+            "text",
+            "font_name",
+            "font_size",
+            "bold",
+            "halign",
+            "valign",
+            "pos",
+            "size",
+        ):
+            self.fbind(name, self._trigger_layout)
+        self._trigger_layout()
+
+    def _update_color(self, *args):
+        self._color.rgba = self.color
+
+    def layout_glyphs(self, *args):
+        atlas = GlyphAtlas.get(self.font_name, self.font_size, self.bold)
+        textures = [atlas.glyph(char) for char in self.text]
+        width = sum(texture.width for texture in textures)
+        height = atlas.line_height
+        self.texture_size = [width, height]
+
+        # One rectangle per character, kept between texts
+        while len(self._rects) < len(textures):
+            rect = Rectangle()
+            self.canvas.add(rect)
+            self._rects.append(rect)
+        while len(self._rects) > len(textures):
+            self.canvas.remove(self._rects.pop())
+
+        if self.halign == "left":
+            x = self.x
+        elif self.halign == "right":
+            x = self.right - width
+        else:
+            x = self.center_x - width / 2
+        if self.valign == "bottom":
+            y = self.y
+        elif self.valign == "top":
+            y = self.top - height
+        else:
+            y = self.center_y - height / 2
+        for rect, texture in zip(self._rects, textures):
+            rect.texture = texture
+            rect.pos = (int(x), int(y))
+            rect.size = texture.size
+            x += texture.width
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+
+"""
+Homing and syringe grabbing as event-driven state machines.
+
+Both cycles run on a StepScheduler and never block the thread that drives
+it: timed phases are scheduled deadlines and the limit switches are polled
+with one Nano read per poll for every axis. All pumps of a cycle move at the
+same time and each one is stopped as soon as its own switch closes.
+
+Homing (RESET and RESET_WASTE)
+
+    CLEARING   every pump purges forward for ``clear_time``, in case the
+               forks are already in position
+    SEEKING    every pump purges backwards until its home switch closes
+    DONE       all switches reached
+    TIMEOUT    a switch was not reached within ``timeout`` of seeking
+
+Syringe grab (GRAB and GRAB_WASTE)
+
+    SEEKING    every pump purges forward until its grab switch closes, then
+               runs ``vol_ml`` at ``rate_mm`` to grasp the syringe firmly
+    DONE       all syringes detected
+    OVERRUN    a syringe was not detected within ``timeout``
+
+A cycle that ends in TIMEOUT or OVERRUN has already stopped the pumps that
+did not reach their switch. The GUI and the ProtocolExecutor both run their
+RESET and GRAB steps with these cycles, e.g.:
+
+    Homing(pumps, nano, scheduler, ["d2", "d3"], [1, 2], on_done=done).start()
+"""
+
+import logging
+from abc import ABC, abstractmethod
+from enum import Enum
+
+# Same values as ChipFlowApp
+SWITCH_UPDATE_INTERVAL = 0.1
+RESET_PURGE_TIME = 1
+# Generous, homing after a full run takes about 90 s in the simulation
+HOMING_TIMEOUT = 180
+GRAB_OVERRUN_CHECK_INTERVAL = 20
+
+log = logging.getLogger("cd_alpha.switches")
+
+
+class HomingState(Enum):
+    IDLE = 1
+    CLEARING = 2
+    SEEKING = 3
+    DONE = 4
+    TIMEOUT = 5
+    OVERRUN = 6
+    CANCELLED = 7
+
+
+class Axis:
+    """One pump and the switch that stops it."""
+
+    __slots__ = ("switch", "addr", "state", "seek_started", "stopped")
+
+    def __init__(self, switch, addr):
+        self.switch = switch
+        self.addr = addr
+        self.state = HomingState.IDLE
+        self.seek_started = None
+        self.stopped = None
+
+    @property
+    def seek_s(self):
+        """Time from the start of seeking until the pump was stopped."""
+        if self.seek_started is None or self.stopped is None:
+            return None
+        return self.stopped - self.seek_started
+
+    def __repr__(self):
+        return f"Axis({self.switch!r}, {self.addr!r}, {self.state.name})"
+
+
+class HomingCycle(ABC):
+    """
+    pumps: PumpNetwork
+    nano: Nano
+        - limit switches, a switch reads False once it is closed
+    scheduler: StepScheduler
+        - drives the cycle, its clock times the phases
+    switches, addrs: lists
+        - the switch of every pump, in the same order
+    poll_interval: float
+        - seconds between two switch reads
+    timeout: float
+        - longest time a pump may seek its switch
+    group: str
+        - scheduler group of every call, cancelling it stops the cycle
+    on_switch: callable(axis)
+        - called when a pump was stopped at its switch
+    on_done: callable(cycle)
+        - called once when the cycle is DONE, TIMEOUT or OVERRUN
+    """
+
+    expired_state = HomingState.TIMEOUT
+
+    def __init__(
+        self,
+        pumps,
+        nano,
+        scheduler,
+        switches,
+        addrs,
+        poll_interval=SWITCH_UPDATE_INTERVAL,
+        timeout=HOMING_TIMEOUT,
+        group=None,
+        on_switch=None,
+        on_done=None,
+    ):
+        self.pumps = pumps
+        self.nano = nano
+        self.scheduler = scheduler
+        self.axes = [Axis(switch, addr) for switch, addr in zip(switches, addrs)]
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.group = group
+        self.on_switch = on_switch
+        self.on_done = on_done
+        self.state = HomingState.IDLE
+        self.started = None
+        self.finished = None
+        self.polls = 0
+        self._calls = []
+
+    @property
+    def active(self):
+        return self.state in (HomingState.CLEARING, HomingState.SEEKING)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return None
+        end = self.scheduler.clock() if self.finished is None else self.finished
+        return end - self.started
+
+    @property
+    def failed_axes(self):
+        return [axis for axis in self.axes if axis.state == self.expired_state]
+
+    def start(self):
+        if self.nano is None:
+            raise IOError(f"No switches on this device for {type(self).__name__}")
+        self.started = self.scheduler.clock()
+        self._begin()
+        return self
+
+    def cancel(self):
+        """Stop driving the cycle, the pumps are left to the caller."""
+        if self.active:
+            self._cancel_calls()
+            self.state = HomingState.CANCELLED
+
+    def summary(self):
+        return {
+            "cycle": type(self).__name__,
+            "state": self.state.name,
+            "elapsed_s": self.elapsed,
+            "polls": self.polls,
+            "axes": [
+                {
+                    "switch": a.switch,
+                    "addr": a.addr,
+                    "state": a.state.name,
+                    "seek_s": a.seek_s,
+                }
+                for a in self.axes
+            ],
+        }
+
+    # ---- phases ---- #
+
+    @abstractmethod
+    def _begin(self):
+        """Move the pumps off, the first phase of the cycle."""
+
+    def _seek(self, direction):
+        now = self.scheduler.clock()
+        self.state = HomingState.SEEKING
+        for axis in self.axes:
+            self.pumps.purge(direction, axis.addr)
+            axis.state = HomingState.SEEKING
+            axis.seek_started = now
+        self._schedule(self.scheduler.call_every, self.poll_interval, self._poll)
+        self._schedule(self.scheduler.call_later, self.timeout, self._expire)
+
+    def _poll(self, dt):
+        if not self.active:
+            return False
+        self.polls += 1
+        self.nano.update()
+        for axis in self.axes:
+            if axis.state == HomingState.SEEKING and not getattr(self.nano, axis.switch):
+                self._switch_reached(axis)
+        if all(axis.state == HomingState.DONE for axis in self.axes):
+            self._finish(HomingState.DONE)
+            return False
+
+    def _switch_reached(self, axis):
+        self.pumps.stop(axis.addr)
+        axis.stopped = self.scheduler.clock()
+        axis.state = HomingState.DONE
+        log.info("CDA: Switch %s closed, pump %s stopped", axis.switch, axis.addr)
+        if self.on_switch is not None:
+            self.on_switch(axis)
+
+    def _expire(self, dt):
+        if not self.active:
+            return
+        stuck = [axis for axis in self.axes if axis.state != HomingState.DONE]
+        for axis in stuck:
+            axis.state = self.expired_state
+        # The pumps at their switch were stopped already, or still grasp
+        self.pumps.stop_all_pumps([axis.addr for axis in stuck])
+        log.warning(
+            "CDA: %s %s, switch not reached on pump %s",
+            type(self).__name__,
+            self.expired_state.name.lower(),
+            " and ".join(str(axis.addr) for axis in stuck),
+        )
+        self._finish(self.expired_state)
+
+    def _finish(self, state):
+        self._cancel_calls()
+        self.state = state
+        self.finished = self.scheduler.clock()
+        log.debug("CDA: %s %s after %.2f s", type(self).__name__, state.name, self.elapsed)
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def _schedule(self, method, delay, callback):
+        self._calls.append(method(delay, callback, group=self.group))
+
+    def _cancel_calls(self):
+        for call in self._calls:
+            call.cancel()
+        self._calls = []
+
+
+class Homing(HomingCycle):
+    """Drive the plungers back onto their home switches.
+
+    clear_time: float
+        - seconds every pump first purges forward
+    """
+
+    def __init__(self, *args, clear_time=RESET_PURGE_TIME, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.clear_time = clear_time
+
+    def _begin(self):
+        self.state = HomingState.CLEARING
+        for axis in self.axes:
+            self.pumps.purge(1, axis.addr)
+            axis.state = HomingState.CLEARING
+        self._schedule(self.scheduler.call_later, self.clear_time, self._reverse)
+
+    def _reverse(self, dt):
+        if not self.active:
+            return
+        for axis in self.axes:
+            self.pumps.stop(axis.addr)
+        self._seek(-1)
+
+
+class SyringeGrab(HomingCycle):
+    """Drive the plungers forward until they touch the syringes, then run a
+    little further to grasp them.
+
+    rate_mm, vol_ml: float
+        - rate in ml/min and volume of the run after the switch closed
+    """
+
+    expired_state = HomingState.OVERRUN
+
+    def __init__(
+        self, *args, rate_mm, vol_ml, timeout=GRAB_OVERRUN_CHECK_INTERVAL, **kwargs
+    ):
+        super().__init__(*args, timeout=timeout, **kwargs)
+        self.rate_mm = rate_mm
+        self.vol_ml = vol_ml
+
+    def _begin(self):
+        self._seek(1)
+
+    def _switch_reached(self, axis):
+        super()._switch_reached(axis)
+        log.debug(
+            "CDA: Running extra %s ml @ %s ml/min to grasp firmly.",
+            self.vol_ml,
+            self.rate_mm,
+        )
+        self.pumps.set_rate(self.rate_mm, "MM", axis.addr)
+        self.pumps.set_volume(self.vol_ml, "ML", axis.addr)
+        self.pumps.run(axis.addr)
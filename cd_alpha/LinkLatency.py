@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+"""
+Serial timeouts learned from the round trip times of the pump link.
+
+With one fixed read timeout every lost reply costs the whole timeout, 2 s on
+the device, and a few retries cost several times that. LinkLatency keeps the
+latest round trips of every command to every pump and gives each command the
+timeout
+
+    p99 of its round trips * factor, between floor and ceiling
+
+A command with fewer than ``min_samples`` round trips borrows the window of
+the same command to all pumps, then of all commands, and gets the ceiling
+before anything was measured. Only replies are measured, so the retry after a
+timeout waits twice as long as the attempt before it and the last attempt
+waits the ceiling: a link that really got slower is still heard, and learned.
+
+The percentile is refreshed every ``recent`` round trips, and at once after
+a round trip longer than the timeout it gave. Drift is flagged
+when the median of the latest ``recent`` round trips of a command is
+``drift_factor`` times the median of its window, and cleared once it is back
+under:
+
+    NEP: RUN to pump 1 drifted, median 0.2100 s over 0.0120 s
+"""
+
+import logging
+import math
+import time
+from collections import deque
+
+from cd_alpha import Metrics
+
+# Formatted by the LogPipeline writer, keep the values as arguments
+log = logging.getLogger("cd_alpha.pumps")
+
+WINDOW = 200
+RECENT = 20
+MIN_SAMPLES = 20
+PERCENTILE = 0.99
+FACTOR = 3.0
+FLOOR = 0.05
+CEILING = 2.0
+DRIFT_FACTOR = 2.0
+ALL = "all"
+
+
+def percentile(ordered, q):
+    """Nearest rank percentile of sorted values."""
+    return ordered[min(max(math.ceil(q * len(ordered)) - 1, 0), len(ordered) - 1)]
+
+
+class RoundTrips:
+    """The latest round trips of one command. Its statistics are refreshed
+    every few samples and not on every command, sorting the window takes
+    longer than a round trip on the emulator."""
+
+    __slots__ = ("samples", "pending", "p99", "median", "recent_median", "drifting")
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.pending = 0
+        self.p99 = None
+        self.median = None
+        self.recent_median = None
+        self.drifting = False
+
+    def add(self, rtt):
+        self.samples.append(rtt)
+        self.pending += 1
+
+    def refresh(self, recent):
+        ordered = sorted(self.samples)
+        self.p99 = percentile(ordered, PERCENTILE)
+        self.median = percentile(ordered, 0.5)
+        self.recent_median = percentile(sorted(list(self.samples)[-recent:]), 0.5)
+        self.pending = 0
+
+
+class LinkLatency:
+    """
+    factor: float
+        - timeout over the p99 round trip
+    floor, ceiling: float
+        - bounds of a timeout in seconds, the ceiling is the timeout of a
+        command nothing is known about
+    window: int
+        - round trips kept per command and pump
+    min_samples: int
+        - round trips before a window is used
+    recent: int
+        - latest round trips compared with the window for drift
+    drift_factor: float
+        - recent median over window median that is flagged
+    clock: callable
+        - time of the anomalies
+    """
+
+    def __init__(
+        self,
+        factor=FACTOR,
+        floor=FLOOR,
+        ceiling=CEILING,
+        window=WINDOW,
+        min_samples=MIN_SAMPLES,
+        recent=RECENT,
+        drift_factor=DRIFT_FACTOR,
+        clock=time.monotonic,
+    ):
+        self.factor = factor
+        self.floor = floor
+        self.ceiling = ceiling
+        self.window = window
+        self.min_samples = min_samples
+        self.recent = recent
+        self.drift_factor = drift_factor
+        self.clock = clock
+        self.round_trips = {}
+        self.anomalies = []
+
+    def _trips(self, command, pump):
+        trips = self.round_trips.get((command, pump))
+        if trips is None:
+            trips = self.round_trips[(command, pump)] = RoundTrips(self.window)
+        return trips
+
+    def observe(self, command, pump, rtt):
+        """A reply to ``command`` came back from ``pump`` after ``rtt``."""
+        for key in ((command, pump), (command, ALL), (ALL, ALL)):
+            trips = self._trips(*key)
+            trips.add(rtt)
+            if len(trips.samples) < self.min_samples:
+                continue
+            if trips.p99 is None or trips.pending >= self.recent:
+                trips.refresh(self.recent)
+                if key[1] != ALL:
+                    self._check_drift(command, pump, trips)
+            elif rtt > trips.p99 * self.factor:
+                # A round trip past the timeout is learned right away
+                trips.p99 = percentile(sorted(trips.samples), PERCENTILE)
+
+    def timeout(self, command, pump, attempt=0, last=False):
+        """Read timeout of ``attempt``, counted from 0, of ``command``."""
+        if last:
+            return self.ceiling
+        for key in ((command, pump), (command, ALL), (ALL, ALL)):
+            trips = self.round_trips.get(key)
+            if trips is not None and trips.p99 is not None:
+                base = min(max(trips.p99 * self.factor, self.floor), self.ceiling)
+                return min(base * 2**attempt, self.ceiling)
+        return self.ceiling
+
+    def _check_drift(self, command, pump, trips):
+        if len(trips.samples) < self.min_samples + self.recent:
+            return
+        recent, baseline = trips.recent_median, trips.median
+        drifting = recent > baseline * self.drift_factor
+        if drifting and not trips.drifting:
+            log.warning(
+                "NEP: %s to pump %s drifted, median %.4f s over %.4f s",
+                command,
+                pump,
+                recent,
+                baseline,
+            )
+            Metrics.serial_latency_anomalies.labels(command, pump).inc()
+            self.anomalies.append(
+                {
+                    "t": self.clock(),
+                    "command": command,
+                    "pump": pump,
+                    "recent_s": recent,
+                    "baseline_s": baseline,
+                }
+            )
+        elif trips.drifting and not drifting:
+            log.info("NEP: %s to pump %s back to %.4f s", command, pump, recent)
+        trips.drifting = drifting
+
+    def summary(self):
+        """p99 and timeout of every command and pump with enough round trips."""
+        return {
+            f"{command}/{pump}": {
+                "samples": len(trips.samples),
+                "p99_s": trips.p99,
+                "timeout_s": self.timeout(command, pump),
+                "drifting": trips.drifting,
+            }
+            for (command, pump), trips in self.round_trips.items()
+            if trips.p99 is not None
+        }
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+
+"""
+Non-blocking logging for the hot paths.
+
+Pump commands, limit switch pollers and the device setup log to the
+``cd_alpha.<subsystem>`` loggers. Once the pipeline is installed, a record on
+one of them costs the calling thread a level check, a rate limit check and a
+queue put: the message is not formatted there. A writer thread formats the
+records and writes them in batches a few times a second with one flush per
+batch, so the Kivy main thread never waits for the SD card.
+
+Pass the values as logging arguments, not as f-strings, so that formatting
+is left to the writer:
+
+    log = logging.getLogger("cd_alpha.pumps")
+    log.debug("NEP: Sending command %r", cmd)
+
+Arguments are formatted later on another thread, they must not be mutated
+after the call.
+
+Levels are per subsystem and can be changed while running, see set_level.
+They can also be given in the CDA_LOG_LEVELS environment variable, e.g.
+``CDA_LOG_LEVELS=pumps=DEBUG,switches=WARNING``.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler
+from pathlib import Path
+
+ROOT_LOGGER = "cd_alpha"
+SUBSYSTEMS = ("pumps", "switches", "device", "scheduler", "telemetry")
+DEFAULT_LOG_PATH = Path.home() / ".local" / "share" / "cd_alpha" / "logs" / "cd_alpha.log"
+LOG_FORMAT = "[%(levelname)-7s] %(asctime)s %(name)s: %(message)s"
+MAX_LOG_BYTES = 10 * 1024 * 1024
+
+# Records per second and burst per category, the category is the logger name
+DEFAULT_RATE_LIMITS = {
+    "cd_alpha.switches": (2.0, 10),
+    "cd_alpha.pumps": (50.0, 200),
+}
+
+_pipeline = None
+
+
+def get_logger(subsystem):
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+def set_level(subsystem, level):
+    """Change the level of a subsystem, e.g. set_level("pumps", "DEBUG")."""
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            raise ValueError(f"Unknown log level for {subsystem}")
+    get_logger(subsystem).setLevel(level)
+
+
+def set_levels(spec):
+    """Apply ``"pumps=DEBUG,switches=WARNING"`` style level settings."""
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        subsystem, _, level = item.partition("=")
+        set_level(subsystem.strip(), level.strip())
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per category. Records over the limit are dropped and
+    counted, the next record let through carries the count."""
+
+    def __init__(self, limits, clock=time.monotonic):
+        super().__init__()
+        self.limits = dict(limits)
+        self.clock = clock
+        self.buckets = {}
+
+    def _limit(self, name):
+        # The most specific configured category wins
+        while name:
+            if name in self.limits:
+                return name, self.limits[name]
+            name = name.rpartition(".")[0]
+        return None, None
+
+    def filter(self, record):
+        category, limit = self._limit(record.name)
+        if limit is None:
+            return True
+        rate, burst = limit
+        now = self.clock()
+        tokens, last, suppressed = self.buckets.get(category, (burst, now, 0))
+        tokens = min(burst, tokens + (now - last) * rate)
+        if tokens < 1 and record.levelno < logging.WARNING:
+            self.buckets[category] = (tokens, now, suppressed + 1)
+            return False
+        self.buckets[category] = (max(tokens - 1, 0), now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue the record as it is, formatting is left to the writer. A full
+    queue drops the record instead of blocking the caller."""
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogSink:
+    """A stream the writer writes to, with its own level and format."""
+
+    def __init__(self, stream, level=logging.NOTSET, formatter=None, owned=False):
+        self.stream = stream
+        self.level = level
+        self.formatter = formatter or logging.Formatter(LOG_FORMAT)
+        # Streams the sink opened itself are closed with the pipeline
+        self.owned = owned
+
+    @classmethod
+    def for_file(cls, path, level=logging.NOTSET, max_bytes=MAX_LOG_BYTES):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Keep one old log around instead of growing forever
+        if path.exists() and path.stat().st_size > max_bytes:
+            os.replace(path, path.with_suffix(path.suffix + ".1"))
+        return cls(open(path, "a", buffering=64 * 1024), level, owned=True)
+
+    def format(self, records):
+        lines = []
+        for record in records:
+            if record.levelno < self.level:
+                continue
+            try:
+                line = self.formatter.format(record)
+            except Exception as err:
+                line = f"Unformattable record {record.msg!r}: {err}"
+            suppressed = getattr(record, "suppressed", 0)
+            if suppressed:
+                line += f" ({suppressed} earlier records suppressed)"
+            lines.append(line + "\n")
+        return "".join(lines)
+
+    def write(self, text):
+        if text:
+            self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class BatchWriter(threading.Thread):
+    """Formats and writes the queued records every ``interval`` seconds, so
+    the writer wakes up a few times a second however much is logged."""
+
+    chunk_size = 32
+
+    def __init__(self, record_queue, sinks, interval=0.25):
+        super().__init__(name="LogPipeline", daemon=True)
+        self.queue = record_queue
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.batches = 0
+        self.written = 0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self._write(self._drain())
+        # Write whatever was queued before the stop
+        self._write(self._drain())
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _write(self, batch):
+        if not batch:
+            return
+        for sink in self.sinks:
+            try:
+                for i in range(0, len(batch), self.chunk_size):
+                    sink.write(sink.format(batch[i : i + self.chunk_size]))
+                    # Hand the GIL back so a long batch does not stall the GUI
+                    time.sleep(0)
+                sink.flush()
+            except Exception as err:
+                sys.stderr.write(f"LogPipeline: writing failed: {err}\n")
+        self.batches += 1
+        self.written += len(batch)
+
+    def stop(self, timeout=2.0):
+        self.stopped.set()
+        self.join(timeout)
+
+
+class LogPipeline:
+    """
+    log_path: str or Path or None
+        - file every record is written to, None for no file
+    console_level: int or None
+        - records at or above it are also written to stderr
+    rate_limits: dict
+        - records per second and burst per category, see DEFAULT_RATE_LIMITS
+    queue_size: int
+        - records waiting for the writer before new ones are dropped
+    """
+
+    def __init__(
+        self,
+        log_path=DEFAULT_LOG_PATH,
+        console_level=logging.WARNING,
+        rate_limits=DEFAULT_RATE_LIMITS,
+        queue_size=10000,
+        interval=0.25,
+        sinks=None,
+    ):
+        if sinks is None:
+            sinks = []
+            if log_path is not None:
+                sinks.append(LogSink.for_file(log_path))
+            if console_level is not None:
+                sinks.append(LogSink(sys.stderr, console_level))
+        self.queue = queue.Queue(queue_size)
+        self.handler = LazyQueueHandler(self.queue)
+        self.rate_limit = RateLimitFilter(rate_limits)
+        self.handler.addFilter(self.rate_limit)
+        self.writer = BatchWriter(self.queue, sinks, interval)
+
+    def start(self, logger_name=ROOT_LOGGER):
+        self.logger = logging.getLogger(logger_name)
+        self.logger.addHandler(self.handler)
+        # The subsystem records only go through the pipeline
+        self.logger.propagate = False
+        self.writer.start()
+        return self
+
+    def stop(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.propagate = True
+        self.writer.stop()
+        for sink in self.writer.sinks:
+            if sink.owned:
+                sink.stream.close()
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+
+def install(log_path=DEFAULT_LOG_PATH, level=logging.INFO, **kwargs):
+    """Start the pipeline for the cd_alpha loggers, once per process. The
+    subsystem levels default to ``level`` unless set in CDA_LOG_LEVELS."""
+    global _pipeline
+    if _pipeline is not None:
+        return _pipeline
+    logging.getLogger(ROOT_LOGGER).setLevel(level)
+    set_levels(os.environ.get("CDA_LOG_LEVELS", ""))
+    _pipeline = LogPipeline(log_path, **kwargs).start()
+    atexit.register(_pipeline.stop)
+    return _pipeline
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+
+"""
+In-process performance metrics.
+
+A small registry of counters and histograms with labels. It can be read
+live from a localhost-only HTTP endpoint in the Prometheus text exposition
+format:
+
+    curl http://127.0.0.1:9464/metrics
+
+It is also dumped to a file at the end of every run, so the numbers are
+there without any outside service. Every metric the app records is defined
+at the bottom of this module.
+"""
+
+import bisect
+import logging
+import math
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+DEFAULT_METRICS_PORT = 9464
+DEFAULT_METRICS_DIR = Path.home() / ".local" / "share" / "cd_alpha" / "metrics"
+
+# Seconds, from a fast serial reply to a stalled frame
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+# Seconds a step ends off its plan, either way
+ERROR_BUCKETS = (-30, -10, -5, -1, -0.25, -0.05, 0, 0.05, 0.25, 1, 5, 10, 30, 120)
+
+log = logging.getLogger("cd_alpha.metrics")
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values, **labels):
+        if labels:
+            values = tuple(str(labels[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def clear(self):
+        with self._lock:
+            self._children = {}
+
+    def exposition(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._samples(values, child))
+        return lines
+
+
+class _CounterChild:
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self, values, child):
+        labels = _format_labels(self.labelnames, values)
+        return [f"{self.name}_total{labels} {_format_value(child.value)}"]
+
+
+class _HistogramChild:
+
+    __slots__ = ("upper_bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * len(upper_bounds)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.upper_bounds = tuple(sorted(buckets)) + (math.inf,)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self, values, child):
+        with child._lock:
+            counts, total, count = list(child.counts), child.sum, child.count
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.upper_bounds, counts):
+            cumulative += n
+            labels = _format_labels(self.labelnames, values, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets)
+
+    def reset(self):
+        """Drop every recorded value, e.g. at the start of a run."""
+        for metric in list(self._metrics.values()):
+            metric.clear()
+
+    def exposition(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].exposition())
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(self.exposition())
+        os.replace(tmp, path)
+        return path
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("MET: " + format, *args)
+
+
+class MetricsServer:
+    """Serve a registry on 127.0.0.1 only, from a daemon thread."""
+
+    def __init__(self, registry, port=DEFAULT_METRICS_PORT, host="127.0.0.1"):
+        handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name="MetricsServer", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def start_server(port=DEFAULT_METRICS_PORT, registry=None):
+    """Start the endpoint, returns None when the port is not available."""
+    try:
+        server = MetricsServer(registry or REGISTRY, port).start()
+    except OSError as err:
+        log.warning("MET: Metrics endpoint not started on port %s: %s", port, err)
+        return None
+    log.info("MET: Serving metrics on http://127.0.0.1:%s/metrics", server.port)
+    return server
+
+
+# ---- the metrics of the app ---- #
+
+REGISTRY = Registry()
+
+serial_rtt = REGISTRY.histogram(
+    "cd_alpha_serial_rtt_seconds",
+    "Round trip time of a pump command until its reply.",
+    ("command", "pump"),
+)
+serial_retries = REGISTRY.counter(
+    "cd_alpha_serial_retries",
+    "Pump commands sent again after an error or timeout.",
+    ("command", "pump"),
+)
+serial_timeouts = REGISTRY.counter(
+    "cd_alpha_serial_timeouts",
+    "Pump replies that did not arrive in time.",
+    ("command", "pump"),
+)
+serial_latency_anomalies = REGISTRY.counter(
+    "cd_alpha_serial_latency_anomalies",
+    "Pump commands whose round trip time drifted, see LinkLatency.",
+    ("command", "pump"),
+)
+i2c_read = REGISTRY.histogram(
+    "cd_alpha_i2c_read_seconds", "Time to read the limit switches from the Nano."
+)
+frame_time = REGISTRY.histogram(
+    "cd_alpha_frame_time_seconds", "Time between two frames of the Kivy main loop."
+)
+scheduler_lag = REGISTRY.histogram(
+    "cd_alpha_scheduler_lag_seconds",
+    "How late scheduled step callbacks ran after their deadline.",
+    ("scheduler",),
+)
+step_duration_error = REGISTRY.histogram(
+    "cd_alpha_step_duration_error_seconds",
+    "Actual minus planned step duration.",
+    ("step",),
+    buckets=ERROR_BUCKETS,
+)
@@ -2,6 +2,9 @@
 
 import io
 import fcntl
+import time
+
+from cd_alpha import Metrics
 
 __version__ = "0.1.1"
 
@@ -33,7 +36,9 @@ class Nano(object):
 
     def update(self):
         """Ask Nano for status and update variables"""
+        start = time.perf_counter()
         payload = self._read(1)
+        Metrics.i2c_read.observe(time.perf_counter() - start)
         self.d2 = bool((payload[0] >> 7) & 0x01)
         self.d3 = bool((payload[0] >> 6) & 0x01)
         self.d4 = bool((payload[0] >> 5) & 0x01)
@@ -2,6 +2,26 @@
 
 import serial
 import logging
+import re
+import time
+
+from cd_alpha import Metrics
+from cd_alpha.LinkLatency import LinkLatency
+
+# Formatted by the LogPipeline writer, keep the values as arguments
+log = logging.getLogger("cd_alpha.pumps")
+
+COMMAND_NAME = re.compile(r"\*?[A-Z]+")
+# Commands that must not be sent twice and the status that shows they took
+# effect. Their reply is that status.
+UNSAFE_COMMANDS = {"RUN": "IW", "PUR": "X", "STP": "S"}
+
+
+def command_name(cmd_str):
+    """Name of a pump command in the metrics and the telemetry, RAT15.00MH and
+    RAT1.00MH are both RAT. The status query is the empty command."""
+    match = COMMAND_NAME.match(cmd_str)
+    return match.group(0) if match else "STATUS"
 
 
 class PumpNetwork:
@@ -14,14 +34,27 @@ class PumpNetwork:
         "",
     ]  # MM=ml/min, MH=ml/hr, UH=μl/hr, UM=μl/min
 
-    def __init__(self, ser, max_noof_retries=3):
+    def __init__(self, ser, max_noof_retries=3, latency=None):
         self.ser = ser
         self.safe_protocol = False
         self.max_noof_retries = max_noof_retries
+        # Read timeouts from the round trips seen so far
+        self.latency = latency if latency is not None else LinkLatency()
+        # Called with (addr, command, latency_s, ok) after every attempt
+        self.command_listener = None
+        # Input to drop before the next command, e.g. the replies to the
+        # stops of the SafetyWatchdog
+        self._stale = False
+        # Replies still on their way to attempts that timed out and until
+        # when they are waited for before the next command
+        self._outstanding = 0
+        self._late_deadline = 0.0
 
     def _get_response(self):
         output = []
         first_char = self.ser.readline(1)
+        if first_char == b"":
+            raise TimeoutError("Response read timed out")
         if first_char != b"\x02":
             raise IOError(
                 "Not correctly formated response. First character was {:}, expected 0x02".format(
@@ -32,31 +65,110 @@ class PumpNetwork:
             c = self.ser.readline(1)
             if c == b"\x03":
                 break  # ETX (End of text). Stop looking for response characters.
-            elif c == "":
-                raise IOError("Response read timed out")
+            elif c == b"":
+                raise TimeoutError("Response read timed out")
             output.append(c.decode("utf8"))
         response = "".join(output)
-        logging.debug(f"NEP: Got response: {response}")
+        log.debug("NEP: Got response: %s", response)
         return response
 
     def _send_command(self, cmd_str, addr=""):
+        """Send a command and return its reply, retried on a timeout or an
+        error reply.
+
+        Replies do not say which attempt they answer: the reply to a retry may
+        be the late one of an attempt before it. Round trips are measured from
+        the first attempt and the replies still on their way are read before
+        the next command. Commands of UNSAFE_COMMANDS wait the ceiling and are
+        only sent again when the status shows they did not take effect."""
         tmp = "{0}{1}\r".format(addr, cmd_str)
-        logging.debug(f"NEP: Sending comand: {tmp}")
+        log.debug("NEP: Sending comand: %r", tmp)
+        labels = self._labels(cmd_str, addr)
+        effect = UNSAFE_COMMANDS.get(cmd_str)
+        first_sent = None
         for n in range(self.max_noof_retries + 1):
+            # A late reply to an earlier attempt is the reply of this command
+            if n == 0 and self._outstanding or self._stale:
+                self._drain()
+            if effect is not None and n > 0:
+                status = self._send_command("", addr)
+                if status[2] in effect:
+                    log.warning("NEP: Reply to %r lost, the pump took it", tmp)
+                    return status
+            last = n == self.max_noof_retries or effect is not None
+            self._set_timeout(self.latency.timeout(*labels, n, last=last))
+            sent = time.perf_counter()
+            if first_sent is None:
+                first_sent = sent
             try:
                 self.ser.write(str.encode(tmp))
+                self._outstanding += 1
+                self._late_deadline = sent + self.latency.timeout(*labels, n + 1)
                 response = self._get_response()
-                if "?" not in response: 
+                self._outstanding -= 1
+                if "?" not in response:
+                    self._report(addr, cmd_str, first_sent, True)
                     return response
                 msg_str = f"Error in response from network. Response: {response}"
                 raise IOError(msg_str)
-            except Exception:
+            except Exception as err:
+                self._report(addr, cmd_str, sent, False, err)
+                if n < self.max_noof_retries:
+                    Metrics.serial_retries.labels(*self._labels(cmd_str, addr)).inc()
                 if n >= self.max_noof_retries:
-                    logging.error(
+                    log.error(
                         "NEP: Maximum number of tries reached for sending command."
                     )
                     raise Exception
 
+    @staticmethod
+    def _labels(cmd_str, addr):
+        return command_name(cmd_str), addr if addr != "" else "all"
+
+    def discard_replies(self):
+        """Replies of another process on the link, e.g. to the stops of the
+        SafetyWatchdog, are dropped before the next command."""
+        self._stale = True
+
+    def _drain(self):
+        """Read the replies still on their way to attempts that timed out, so
+        they are not taken for the reply of the next attempt or command."""
+        while self._outstanding > 0:
+            remaining = self._late_deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            self._set_timeout(remaining)
+            try:
+                self._get_response()
+            except (TimeoutError, IOError):
+                break
+            self._outstanding -= 1
+        self._outstanding = 0
+        self._drop_input()
+
+    def _drop_input(self):
+        self._stale = False
+        if hasattr(self.ser, "reset_input_buffer"):
+            self.ser.reset_input_buffer()
+
+    def _set_timeout(self, timeout):
+        # Serials without a timeout, e.g. a replay, answer at once. Setting it
+        # reconfigures the port, only done when it changes
+        timeout = round(timeout, 3)
+        if getattr(self.ser, "timeout", timeout) != timeout:
+            self.ser.timeout = timeout
+
+    def _report(self, addr, cmd_str, sent, ok, err=None):
+        latency = time.perf_counter() - sent
+        if ok:
+            labels = self._labels(cmd_str, addr)
+            Metrics.serial_rtt.labels(*labels).observe(latency)
+            self.latency.observe(*labels, latency)
+        elif isinstance(err, TimeoutError):
+            Metrics.serial_timeouts.labels(*self._labels(cmd_str, addr)).inc()
+        if self.command_listener is not None:
+            self.command_listener(addr, cmd_str, latency, ok)
+
     def run(self, addr=""):
         return self._send_command("RUN", addr)
 
@@ -74,23 +186,23 @@ class PumpNetwork:
     def stop(self, addr):
         # make sure the pump isn't already stopped
         status = self.status(addr)
-        logging.debug(f"Status during stop was : {status}")
+        log.debug("Status during stop was : %s", status)
         if status != "S":
-            logging.debug(f"Pump not stopped, status : {status}")
+            log.debug("Pump not stopped, status : %s", status)
             status = self._send_command("STP", addr)
-        logging.debug(f"Pump {addr} was already stopped returned status {status}")
+        log.debug("Pump %s was already stopped returned status %s", addr, status)
         return status
 
     def stop_all_pumps(self, list_of_pumps=[1, 2]):
-        logging.debug("CDA: Stopping all pumps.")
+        log.debug("CDA: Stopping all pumps.")
         for addr in list_of_pumps:
             try:
                 self.stop(addr)
             except IOError as err:
                 if str(err)[-3:] == "?NA":
-                    logging.debug(f"CDA: Pump {addr:02} already stopped.")
+                    log.debug("CDA: Pump %02d already stopped.", addr)
                 else:
-                    logging.debug(f"Non-expected error encountered")
+                    log.debug("Non-expected error encountered")
                     raise err
 
     def set_diameter(self, diameter_mm, addr=""):
@@ -146,7 +258,7 @@ class PumpNetwork:
         return response
 
     def _set_addr(self, addr):
-        logging.warning(f"NEP: Setting addr of *ALL* connected pumps to {addr:02}")
+        log.warning("NEP: Setting addr of *ALL* connected pumps to %02d", addr)
         return self._send_command("ADR{}".format(addr), addr="*")
 
     def buzz(self, addr="", repetitions=1):
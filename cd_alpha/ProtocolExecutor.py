@@ -0,0 +1,447 @@
+#!/usr/bin/python3
+
+"""
+GUI independent protocol execution.
+
+ProtocolExecutor runs the steps of a parsed protocol against a PumpNetwork
+and a Nano as a state machine driven by a StepScheduler, and reports what
+happens through events. It does the same pump work as the MachineActionScreen
+in ChipFlowApp, operator steps are handed to a callback that continues
+immediately by default. On hardware chip-run prompts the operator on the
+terminal instead, see prompt_operator.
+
+The executor consumes compiled protocols, see protocols.protocol_compiler.
+Run a protocol without a display with:
+
+    chip-run path/to/protocol.json [--dry-run]
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from enum import Enum
+from pathlib import Path
+
+from cd_alpha import Metrics
+from cd_alpha.Homing import Homing, HomingState, SyringeGrab
+from cd_alpha.StepScheduler import StepScheduler
+from cd_alpha.Telemetry import TelemetryRecorder
+from cd_alpha.protocols.protocol_compiler import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_PUMP_ADDR,
+    Action,
+    ProtocolError,
+    StepKind,
+    compile_file,
+)
+
+# Same value as ChipFlowApp
+COMPLETION_MSG_TIME = 1
+# How often run() checks whether the operator finished a step
+USER_WAIT_INTERVAL = 0.1
+
+
+class ExecutorState(Enum):
+    IDLE = 1
+    RUNNING = 2
+    WAITING_USER = 3
+    FINISHED = 4
+    ABORTED = 5
+    FAILED = 6
+
+
+class ExecutorEvent:
+
+    __slots__ = ("kind", "step", "time", "data")
+
+    def __init__(self, kind, step, time, data=None):
+        self.kind = kind
+        self.step = step
+        self.time = time
+        self.data = data or {}
+
+    def as_dict(self):
+        return {"kind": self.kind, "step": self.step, "time": self.time, **self.data}
+
+    def __repr__(self):
+        return f"ExecutorEvent({self.kind!r}, {self.step!r}, {self.time:.3f})"
+
+
+def load_protocol(
+    path_to_protocol, start_step="home", pump_addr=DEFAULT_PUMP_ADDR, cache_dir=None
+):
+    """Compile a protocol file, dropping every step before ``start_step``."""
+    return compile_file(path_to_protocol, pump_addr, cache_dir).start_at(start_step)
+
+
+class ProtocolExecutor:
+    """
+    protocol: CompiledProtocol
+        Compiled protocol with the pump addresses of the device, see
+        load_protocol.
+
+    pumps: PumpNetwork
+
+    nano: Nano or None
+        Limit switches, None on an R0.
+
+    clock, sleep: callables
+        Time source and sleep used by ``run``, replace both for simulated time.
+
+    on_user_action: callable(executor, name, step)
+        Called with the StepRecord of every UserActionScreen step. The default continues right
+        away, otherwise call ``executor.continue_step()`` when done. ``run``
+        idles until then.
+    """
+
+    def __init__(
+        self,
+        protocol,
+        pumps,
+        nano,
+        device_type="V0",
+        clock=time.monotonic,
+        sleep=time.sleep,
+        post_run_rate_mm=None,
+        post_run_vol_ml=None,
+        on_user_action=None,
+    ):
+        self.protocol = protocol
+        self.pumps = pumps
+        self.nano = nano
+        self.pump_addr = protocol.pump_addr
+        self.device_type = device_type
+        self.clock = clock
+        self.sleep = sleep
+        self.post_run_rate_mm = post_run_rate_mm
+        self.post_run_vol_ml = post_run_vol_ml
+        self.on_user_action = on_user_action or (lambda ex, name, step: ex.continue_step())
+        self.scheduler = StepScheduler(clock=clock, name="executor")
+        self.listeners = []
+        self.events = []
+        self.state = ExecutorState.IDLE
+        self.step_names = protocol.names
+        self.position = -1
+        self.error = None
+
+    # ---- events ---- #
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def emit(self, kind, **data):
+        event = ExecutorEvent(kind, self.current_step, self.clock(), data)
+        self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+        return event
+
+    @property
+    def current_step(self):
+        if 0 <= self.position < len(self.step_names):
+            return self.step_names[self.position]
+        return None
+
+    @property
+    def finished(self):
+        return self.state in (
+            ExecutorState.FINISHED,
+            ExecutorState.ABORTED,
+            ExecutorState.FAILED,
+        )
+
+    # ---- state machine ---- #
+
+    def start(self):
+        self.state = ExecutorState.RUNNING
+        self.emit("protocol_started", steps=len(self.step_names))
+        self._advance()
+
+    def run(self):
+        """Run the protocol to the end, blocking. Returns the final state."""
+        if self.state == ExecutorState.IDLE:
+            self.start()
+        while not self.finished:
+            deadline = self.scheduler.next_deadline()
+            if deadline is None:
+                if self.state == ExecutorState.WAITING_USER:
+                    self.sleep(USER_WAIT_INTERVAL)
+                    continue
+                raise ProtocolError(f"Step {self.current_step} never finishes")
+            self.sleep(max(deadline - self.clock(), 0))
+            try:
+                self.scheduler.run_due()
+            except Exception as err:
+                self.fail(f"{type(err).__name__} in {self.current_step}: {err}")
+        return self.state
+
+    def continue_step(self):
+        """Finish the current operator step."""
+        if self.state == ExecutorState.WAITING_USER:
+            self.state = ExecutorState.RUNNING
+            self._finish_step()
+
+    def abort(self, cause="operator"):
+        if self.finished:
+            return
+        self.scheduler.cancel_all()
+        self.state = ExecutorState.ABORTED
+        self._stop_all()
+        self.emit("protocol_aborted", cause=cause)
+
+    def fail(self, message):
+        self.scheduler.cancel_all()
+        self.state = ExecutorState.FAILED
+        self.error = message
+        self._stop_all()
+        self.emit("protocol_failed", error=message)
+
+    def _stop_all(self):
+        try:
+            self.pumps.stop_all_pumps(list(self.pump_addr.values()))
+        except Exception as err:
+            logging.error(f"EXE: Could not stop pumps: {err}")
+
+    def _advance(self):
+        self.position += 1
+        if self.position >= len(self.step_names):
+            self.state = ExecutorState.FINISHED
+            self.emit("protocol_finished")
+            return
+        step = self.protocol.steps[self.position]
+        self.emit("step_started", type=step.kind.name)
+        if step.kind == StepKind.MACHINE:
+            try:
+                self._start_machine_step(step.name, step.actions)
+            except Exception as err:
+                self.fail(f"{type(err).__name__} in {step.name}: {err}")
+        else:
+            self.state = ExecutorState.WAITING_USER
+            self.on_user_action(self, step.name, step)
+
+    def _finish_step(self):
+        name = self.current_step
+        self.scheduler.cancel_group(name)
+        self.emit("step_finished")
+        completion_msg = self.protocol[name].completion_msg
+        if completion_msg:
+            self.emit("completion", message=completion_msg)
+            self.scheduler.call_later(
+                COMPLETION_MSG_TIME, lambda dt: self._advance(), group=name
+            )
+        else:
+            self._advance()
+
+    def _start_machine_step(self, name, actions):
+        # Steps finish when their last pending operation completes
+        self._pending = 0
+        synchronous = True
+        for record in actions:
+            handler = getattr(self, f"_action_{record.action.name.lower()}")
+            if handler(name, record) is False:
+                synchronous = False
+        if synchronous:
+            self._finish_step()
+
+    def _operation_done(self):
+        self._pending -= 1
+        if self._pending == 0 and not self.finished:
+            self._finish_step()
+
+    def _homing(self, name, cycle, record, **kwargs):
+        self._pending += 1
+        cycle(
+            self.pumps,
+            self.nano,
+            self.scheduler,
+            record.switches,
+            record.addrs,
+            group=name,
+            on_switch=lambda axis: self.emit(
+                "switch_triggered", switch=axis.switch, addr=axis.addr
+            ),
+            on_done=self._homing_done,
+            **kwargs,
+        ).start()
+        return False
+
+    def _homing_done(self, cycle):
+        if cycle.state == HomingState.DONE:
+            self._operation_done()
+            return
+        addrs = " and ".join(str(axis.addr) for axis in cycle.failed_axes)
+        if cycle.state == HomingState.OVERRUN:
+            self.fail(f"Grab overrun, syringe not detected on {addrs}")
+        else:
+            self.fail(f"Homing timed out, switch not reached on {addrs}")
+
+    def _timed(self, name, duration):
+        self._pending += 1
+        self.emit("timer_started", duration=duration)
+        self.scheduler.call_later(duration, lambda dt: self._operation_done(), group=name)
+        return False
+
+    # ---- actions, return False when the step continues asynchronously ---- #
+
+    def _action_pump(self, name, record):
+        self._action_release(name, record)
+        return self._timed(name, record.duration)
+
+    def _action_incubate(self, name, record):
+        return self._timed(name, record.duration)
+
+    def _action_release(self, name, record):
+        addr = record.addr
+        self.pumps.set_rate(record.rate, "MH", addr)
+        self.pumps.set_volume(record.vol_ml, "ML", addr)
+        self.pumps.run(addr)
+        self.emit("pump_started", addr=addr, rate_mh=record.rate, vol_ml=record.vol_ml)
+
+    def _action_change_syringe(self, name, record):
+        self.pumps.set_diameter(record.diameter_mm, record.addr)
+
+    def _action_reset(self, name, record):
+        if self.device_type == "R0":
+            logging.info("EXE: No RESET work to be done on the R0")
+            return
+        return self._homing(name, Homing, record)
+
+    _action_reset_waste = _action_reset
+
+    def _action_grab(self, name, record):
+        rate_mm = record.rate
+        vol_ml = record.vol_ml
+        if record.action == Action.GRAB:
+            # Device calibration wins over the protocol values
+            rate_mm = self.post_run_rate_mm or rate_mm
+            vol_ml = self.post_run_vol_ml or vol_ml
+        return self._homing(name, SyringeGrab, record, rate_mm=rate_mm, vol_ml=vol_ml)
+
+    _action_grab_waste = _action_grab
+
+
+def prompt_operator(executor, name, step):
+    """on_user_action for a run on hardware, shows the step on the terminal and
+    continues when the operator presses Enter."""
+    print(f"\n{step.header or name}")
+    if step.description:
+        print(step.description)
+    try:
+        input(f"Press Enter for {step.next_text!r} ")
+    except EOFError:
+        # No operator at the terminal
+        executor.abort("no operator input")
+        return
+    executor.continue_step()
+
+
+class VirtualClock:
+    """Simulated time for dry runs, sleeping only advances the clock."""
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a protocol without the GUI.")
+    parser.add_argument("protocol", help="path to the protocol json file")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="use the software stubs instead of the hardware, in simulated time",
+    )
+    parser.add_argument("--start-step", default="home")
+    parser.add_argument("--serial", default=None, help="pump serial port")
+    parser.add_argument("--events", default=None, help="write events as json lines")
+    parser.add_argument(
+        "--telemetry", default=None, help="record the run in this telemetry database"
+    )
+    parser.add_argument(
+        "--metrics", default=None, help="dump the metrics of the run to this file"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.dry_run:
+        from cd_alpha.software_testing.NanoControllerTestStub import Nano
+        from cd_alpha.software_testing.NewEraPumpsTestStub import PumpNetwork
+        from cd_alpha.software_testing.SerialStub import SerialStub
+
+        device_type, pump_addr = "V0", {"waste": 1, "lysate": 2}
+        ser, post_run = SerialStub(), (None, None)
+        clock = VirtualClock()
+        clock_fn, sleep = clock, clock.sleep
+    else:
+        import serial
+        from cd_alpha.Device import Device, device_config_path
+        from cd_alpha.NanoController import Nano
+        from cd_alpha.NewEraPumps import PumpNetwork
+
+        device = Device(device_config_path())
+        device_type = device.DEVICE_TYPE
+        pump_addr = {"waste": device.PUMP_ADDR[0]}
+        if device_type == "V0":
+            pump_addr["lysate"] = device.PUMP_ADDR[1]
+        ser = serial.Serial(args.serial or device.PUMP_SERIAL_ADDR, 19200, timeout=2)
+        post_run = (device.POST_RUN_RATE_MM, device.POST_RUN_VOL_ML)
+        clock_fn, sleep = time.monotonic, time.sleep
+
+    protocol = load_protocol(args.protocol, args.start_step, pump_addr, DEFAULT_CACHE_DIR)
+    nano = Nano(8, 7) if device_type == "V0" else None
+    pumps = PumpNetwork(ser)
+    executor = ProtocolExecutor(
+        protocol,
+        pumps,
+        nano,
+        device_type=device_type,
+        clock=clock_fn,
+        sleep=sleep,
+        post_run_rate_mm=post_run[0],
+        post_run_vol_ml=post_run[1],
+        on_user_action=None if args.dry_run else prompt_operator,
+    )
+    if args.telemetry:
+        telemetry = TelemetryRecorder(args.telemetry, clock=clock_fn)
+        telemetry.start_run(protocol, Path(args.protocol).stem, device_type)
+        pumps.command_listener = telemetry.pump_command
+        executor.subscribe(telemetry.on_executor_event)
+    events_file = open(args.events, "w") if args.events else None
+    start = clock_fn()
+
+    def report(event):
+        if event.kind in ("step_started", "step_finished", "protocol_failed"):
+            print(f"{event.time - start:10.1f} s  {event.kind:<16}{event.step}")
+        if events_file is not None:
+            events_file.write(json.dumps(event.as_dict()) + "\n")
+
+    executor.subscribe(report)
+    try:
+        state = executor.run()
+    except KeyboardInterrupt:
+        executor.abort("keyboard interrupt")
+        state = executor.state
+    except Exception as err:
+        # Never leave the pumps running
+        logging.error(f"EXE: {type(err).__name__}: {err}")
+        executor.abort(f"{type(err).__name__}: {err}")
+        state = executor.state
+    finally:
+        if events_file is not None:
+            events_file.close()
+        if args.metrics:
+            Metrics.REGISTRY.dump(args.metrics)
+        ser.close()
+    print(f"Protocol {state.name.lower()} after {clock_fn() - start:.1f} s")
+    return 0 if state == ExecutorState.FINISHED else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
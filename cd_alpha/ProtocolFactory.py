@@ -1,80 +1,252 @@
-from collections import OrderedDict
-from enum import Enum
-from dataclasses import dataclass
-import json
+#!/usr/bin/python3
 
+"""
+Build protocols in code and generate parameter sweeps of them.
 
-TEST_FILE_LOCATION = "test_output.json"
+Steps and actions are small slotted objects that serialise to the protocol
+JSON format and know their planned duration. A Sweep takes a template
+protocol and lists of values for some action parameters, e.g. the rate of
+one pump step and the length of an incubation, and streams every
+combination to disk as a protocol file. Each variant comes with its planned
+duration and pump volumes, computed from the steps that changed only, and a
+manifest CSV lists all variants for ranking.
 
+Run a sweep with:
 
-@dataclass
-class StepType(Enum):
-    PUMP = 1
-    INCUBATE = 2
-    PUMPANDRELEASE = 3
-    DESCRIPTION = 4
+    chip-sweep template.json out_dir/ --set flush_1.PUMP.rate_mh=10,15,20 \
+        --set incubate_1.INCUBATE.time=1800,3600 --rank 10
+"""
 
+import argparse
+import csv
+import heapq
+import itertools
+import json
+import sys
+import time
+from collections import OrderedDict
+from enum import Enum
+from pathlib import Path
 
-@dataclass
-class ActionType(Enum):
-    PUMP = 1
-    GRAB = 2
-    RELEASE = 3
-    INCUBATE = 4
-    RESET = 5
+from cd_alpha.protocols.protocol_compiler import Action as ActionType
+from cd_alpha.protocols.protocol_tools import (
+    COMPLETION_MSG_TIME,
+    GRAB_ESTIMATE_S,
+    RESET_ESTIMATE_S,
+    RESET_PURGE_TIME,
+    format_duration,
+)
 
 
-@dataclass
 class Target(Enum):
-    WASTE = 1
-    LYSATE = 2
+    WASTE = "waste"
+    LYSATE = "lysate"
 
 
-@dataclass
 class ScreenType(Enum):
     MachineActionScreen = 1
     UserActionScreen = 2
 
 
-@dataclass
+# Parameters written to the protocol for every action type, in file order
+ACTION_FIELDS = {
+    ActionType.PUMP: ("target", "vol_ml", "rate_mh", "eq_time"),
+    ActionType.RELEASE: ("target", "vol_ml", "rate_mh", "eq_time"),
+    ActionType.INCUBATE: ("time",),
+    ActionType.RESET: (),
+    ActionType.RESET_WASTE: (),
+    ActionType.GRAB: ("post_run_rate_mm", "post_run_vol_ml"),
+    ActionType.GRAB_WASTE: ("post_run_rate_mm", "post_run_vol_ml"),
+    ActionType.CHANGE_SYRINGE: ("diam", "pump_addr"),
+}
+
+
+class Action:
+    """A single action of a machine step, e.g. Action("PUMP", target="waste",
+    vol_ml=0.5, rate_mh=15, eq_time=0)."""
+
+    __slots__ = (
+        "type",
+        "target",
+        "vol_ml",
+        "rate_mh",
+        "eq_time",
+        "time",
+        "post_run_rate_mm",
+        "post_run_vol_ml",
+        "diam",
+        "pump_addr",
+    )
+
+    def __init__(self, action_type, **params):
+        if isinstance(action_type, str):
+            action_type = ActionType[action_type]
+        self.type = action_type
+        for field in self.__slots__[1:]:
+            setattr(self, field, None)
+        fields = ACTION_FIELDS[action_type]
+        for field, value in params.items():
+            if field not in fields:
+                raise TypeError(f"{action_type.name} has no parameter {field}")
+            if isinstance(value, Target):
+                value = value.value
+            setattr(self, field, value)
+        if "eq_time" in fields and self.eq_time is None:
+            self.eq_time = 0
+        missing = [f for f in fields if getattr(self, f) is None]
+        if missing:
+            raise TypeError(f"{action_type.name} is missing {', '.join(missing)}")
+
+    @classmethod
+    def from_json(cls, name, params):
+        return cls(name, **params)
+
+    def replace(self, **changes):
+        params = {f: getattr(self, f) for f in ACTION_FIELDS[self.type]}
+        params.update(changes)
+        return Action(self.type, **params)
+
+    def to_json(self):
+        return {f: getattr(self, f) for f in ACTION_FIELDS[self.type]}
+
+    def duration(self):
+        """Planned seconds, estimated for actions that end on a switch."""
+        if self.type in (ActionType.PUMP, ActionType.RELEASE):
+            return abs(self.vol_ml / self.rate_mh) * 3600 + self.eq_time
+        if self.type == ActionType.INCUBATE:
+            return self.time
+        if self.type in (ActionType.RESET, ActionType.RESET_WASTE):
+            return RESET_PURGE_TIME + RESET_ESTIMATE_S
+        if self.type in (ActionType.GRAB, ActionType.GRAB_WASTE):
+            return GRAB_ESTIMATE_S + abs(self.post_run_vol_ml / self.post_run_rate_mm) * 60
+        return 0
+
+    def __repr__(self):
+        params = ", ".join(f"{f}={getattr(self, f)!r}" for f in ACTION_FIELDS[self.type])
+        return f"Action({self.type.name!r}{', ' if params else ''}{params})"
+
+
 class Step:
-    material: str
-    step_number: int
-    description_text: str
-    screentype: ScreenType
-    steptype: StepType
-    target: Target
-    volume: float
-    flowrate: float
-    wait_time: int
-
-    # how do we handle description steps ?
-    def makejson(self):
-        return {
-            (self.material + "_")
-            + str(self.step_number): {
-                "type": self.screentype.name,
-                "header": f"{self.material}_{str(self.step_number)}",
-                "description": self.description_text,
-                "action": {
-                    self.steptype.name: {
-                        "target": self.target.name,
-                        "vol_ml": self.volume,
-                        "rate_mh": self.flowrate,
-                        "eq_time": self.wait_time,
-                    }
-                },
-            }
-        }
+    """A protocol step, its JSON and duration are computed once."""
+
+    __slots__ = (
+        "name",
+        "screen_type",
+        "header",
+        "description",
+        "next_text",
+        "actions",
+        "completion_msg",
+        "remove_progress_bar",
+        "_json",
+        "_duration",
+    )
+
+    def __init__(
+        self,
+        name,
+        screen_type=ScreenType.MachineActionScreen,
+        header=None,
+        description=None,
+        next_text=None,
+        actions=(),
+        completion_msg=None,
+        remove_progress_bar=False,
+    ):
+        if isinstance(screen_type, str):
+            screen_type = ScreenType[screen_type]
+        self.name = name
+        self.screen_type = screen_type
+        self.header = header
+        self.description = description
+        self.next_text = next_text
+        self.actions = tuple(actions)
+        self.completion_msg = completion_msg
+        self.remove_progress_bar = remove_progress_bar
+        self._json = None
+        self._duration = None
+
+    @classmethod
+    def from_json(cls, name, step):
+        return cls(
+            name,
+            screen_type=step["type"],
+            header=step.get("header"),
+            description=step.get("description"),
+            next_text=step.get("next_text"),
+            actions=[Action.from_json(a, p) for a, p in step.get("action", {}).items()],
+            completion_msg=step.get("completion_msg"),
+            remove_progress_bar=step.get("remove_progress_bar", False),
+        )
+
+    def replace_action(self, action_type, **changes):
+        """Copy of the step with the parameters of one action changed."""
+        if isinstance(action_type, str):
+            action_type = ActionType[action_type]
+        if action_type not in (a.type for a in self.actions):
+            raise KeyError(f"Step {self.name} has no {action_type.name} action")
+        actions = [
+            a.replace(**changes) if a.type == action_type else a for a in self.actions
+        ]
+        return Step(
+            self.name,
+            self.screen_type,
+            self.header,
+            self.description,
+            self.next_text,
+            actions,
+            self.completion_msg,
+            self.remove_progress_bar,
+        )
+
+    def to_json(self):
+        step = OrderedDict(type=self.screen_type.name)
+        for field in ("header", "description", "next_text"):
+            if getattr(self, field) is not None:
+                step[field] = getattr(self, field)
+        if self.actions:
+            step["action"] = OrderedDict((a.type.name, a.to_json()) for a in self.actions)
+        if self.remove_progress_bar:
+            step["remove_progress_bar"] = True
+        if self.completion_msg:
+            step["completion_msg"] = self.completion_msg
+        return step
+
+    def json_text(self):
+        """The step as a ``"name": {...}`` fragment of a protocol file."""
+        if self._json is None:
+            # Same layout as json.dump(protocol, f, indent=4)
+            body = json.dumps(self.to_json(), indent=4).replace("\n", "\n    ")
+            self._json = f"    {json.dumps(self.name)}: {body}"
+        return self._json
+
+    def duration(self):
+        if self._duration is None:
+            self._duration = max((a.duration() for a in self.actions), default=0)
+            if self.completion_msg:
+                self._duration += COMPLETION_MSG_TIME
+        return self._duration
+
+    def volumes(self):
+        """ml moved by the waste and the lysate pump."""
+        waste = lysate = 0.0
+        for a in self.actions:
+            if a.type in (ActionType.PUMP, ActionType.RELEASE):
+                if a.target == Target.WASTE.value:
+                    waste += abs(a.vol_ml)
+                else:
+                    lysate += abs(a.vol_ml)
+        return waste, lysate
 
 
 class StepBuilder:
     def __init__(self, step_name: str) -> None:
         self.step_name = step_name
         self.stepdict = OrderedDict()
+        self.actions = []
 
     def add_type(self, type: ScreenType):
-        self.stepdict["type"] = type.name
+        self.stepdict["screen_type"] = type
 
     def add_header(self, header: str):
         self.stepdict["header"] = header
@@ -85,84 +257,267 @@ class StepBuilder:
     def add_next_text(self, next_text: str):
         self.stepdict["next_text"] = next_text
 
-    def add_actions(self, action_types: List[Action]):
-        for act in action_type:
-            pass
+    def add_completion_msg(self, completion_msg: str):
+        self.stepdict["completion_msg"] = completion_msg
+
+    def add_actions(self, actions):
+        self.actions.extend(actions)
 
     def getStep(self):
-        return {self.step_name: self.stepdict}
+        return Step(self.step_name, actions=self.actions, **self.stepdict)
 
 
 class ProtocolFactory:
+    def __init__(self, list_of_steps):
+        self.list_of_steps = list(list_of_steps)
 
-    """ "type": "MachineActionScreen",
-    "header": "Initialization",
-    "description": "Initializing device. Resetting syringe positions and checking connections.",
-    "action": {
-        "RESET": {}
-    },
-    "remove_progress_bar": true,
-    "completion_msg": "Machine has been homed"
-    """
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as f:
+            protocol = json.loads(f.read(), object_pairs_hook=OrderedDict)
+        return cls(Step.from_json(name, step) for name, step in protocol.items())
 
-    def __init__(self, list_of_steps):
-        self.list_of_steps = list_of_steps
+    def to_json(self):
+        return OrderedDict((s.name, s.to_json()) for s in self.list_of_steps)
 
-    def create_step(self):
-        # PSEUDO CODE
+    def duration(self):
+        return sum(s.duration() for s in self.list_of_steps)
 
-        # Create a JSON protocol given the following information for every step
-        # TYPE: {PUMP, INCUBATE, PUMP/RELEASE}
-        # STEP_INFO: [TARGET, VOL_ML, RATE_MH, EQ_TIME_SECS]
-        pass
+    def json_dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=4)
 
-    def json_dump(self):
-        with open(TEST_FILE_LOCATION, "w") as f:
-            steps_dictionary = {}
-            for s in self.list_of_steps:
-                steps_dictionary.update(s.makejson())
-            json.dump(steps_dictionary, f, indent=4)
 
+class Variant:
 
-if __name__ == "__main__":
+    __slots__ = ("index", "values", "steps", "duration_s", "waste_ml", "lysate_ml")
 
-    s1 = Step(
-        "PBS",
-        1,
-        "Rinsing the chip step 1.",
-        ScreenType.MachineActionScreen,
-        StepType.PUMP,
-        Target.WASTE,
-        volume=1.0,
-        flowrate=10.0,
-        wait_time=120,
+    def __init__(self, index, values, steps, duration_s, waste_ml, lysate_ml):
+        self.index = index
+        self.values = values
+        self.steps = steps
+        self.duration_s = duration_s
+        self.waste_ml = waste_ml
+        self.lysate_ml = lysate_ml
+
+    def json_text(self):
+        return "{\n" + ",\n".join(s.json_text() for s in self.steps) + "\n}\n"
+
+
+def sweepable(steps):
+    """Parameters a Sweep can vary, the fields per "step.ACTION" of every
+    action in ``steps`` that has any."""
+    return OrderedDict(
+        (f"{step.name}.{action.type.name}", ACTION_FIELDS[action.type])
+        for step in steps
+        for action in step.actions
+        if ACTION_FIELDS[action.type]
     )
-    s2 = Step(
-        "PBS",
-        2,
-        "Rinsing the chip step 2.",
-        ScreenType.MachineActionScreen,
-        StepType.PUMP,
-        Target.WASTE,
-        volume=0.5,
-        flowrate=5.0,
-        wait_time=120,
+
+
+# What a swept value must be for the step to run, per action field
+SWEEP_CHECKS = {
+    "target": (lambda v: v in {t.value for t in Target}, "waste or lysate"),
+    "vol_ml": (lambda v: v >= 0, "a number of 0 or more"),
+    "rate_mh": (lambda v: v != 0, "a non-zero number"),
+    "eq_time": (lambda v: v >= 0, "a number of 0 or more"),
+    "time": (lambda v: v >= 0, "a number of 0 or more"),
+    "post_run_rate_mm": (lambda v: v != 0, "a non-zero number"),
+    "post_run_vol_ml": (lambda v: v >= 0, "a number of 0 or more"),
+    "diam": (lambda v: v > 0, "a number above 0"),
+    "pump_addr": (lambda v: isinstance(v, int) and v >= 0, "a pump address"),
+}
+
+
+class SweepValueError(ValueError):
+    """A swept value the step cannot run with."""
+
+
+def check_sweep_value(key, field, value):
+    valid, expected = SWEEP_CHECKS[field]
+    numeric = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if field != "target" and not numeric or not valid(value):
+        raise SweepValueError(f"{key}={value} is not valid, it must be {expected}")
+
+
+class Sweep:
+    """Every combination of ``parameters`` applied to ``steps``.
+
+    parameters: dict
+        - values per "step.ACTION.field" key, e.g.
+          {"flush_1.PUMP.rate_mh": [10, 15], "incubate_1.INCUBATE.time": [60, 120]}
+    """
+
+    def __init__(self, steps, parameters):
+        self.steps = list(steps)
+        self.parameters = OrderedDict(parameters)
+        positions = {s.name: i for i, s in enumerate(self.steps)}
+
+        # Group the swept fields by step, every step gets its variants built
+        # once and a variant of the protocol only picks one per step
+        by_step = OrderedDict()
+        fields_of = sweepable(self.steps)
+        for key, values in self.parameters.items():
+            try:
+                name, action, field = key.split(".")
+            except ValueError:
+                raise ValueError(f"Sweep key {key} is not step.ACTION.field") from None
+            if name not in positions:
+                raise ValueError(f"No step {name} in the template")
+            if field not in fields_of.get(f"{name}.{action}", ()):
+                raise ValueError(f"Step {name} has no {action} action with a {field}")
+            values = list(values)
+            for value in values:
+                check_sweep_value(key, field, value)
+            by_step.setdefault(name, []).append((key, action, field, values))
+
+        self.swept = []
+        for name, fields in by_step.items():
+            template = self.steps[positions[name]]
+            choices = []
+            for combination in itertools.product(*(f[3] for f in fields)):
+                step = template
+                values = {}
+                for (key, action, field, _), value in zip(fields, combination):
+                    step = step.replace_action(action, **{field: value})
+                    values[key] = value
+                step.json_text()
+                (waste, lysate), (base_waste, base_lysate) = step.volumes(), template.volumes()
+                choices.append(
+                    (
+                        values,
+                        step,
+                        step.duration() - template.duration(),
+                        waste - base_waste,
+                        lysate - base_lysate,
+                    )
+                )
+            self.swept.append((positions[name], choices))
+
+        self.base_duration = sum(s.duration() for s in self.steps)
+        volumes = [s.volumes() for s in self.steps]
+        self.base_waste = sum(v[0] for v in volumes)
+        self.base_lysate = sum(v[1] for v in volumes)
+        for step in self.steps:
+            step.json_text()
+
+    def __len__(self):
+        count = 1
+        for _, choices in self.swept:
+            count *= len(choices)
+        return count
+
+    def variants(self):
+        positions = [position for position, _ in self.swept]
+        choices = [choices for _, choices in self.swept]
+        for index, picks in enumerate(itertools.product(*choices)):
+            steps = list(self.steps)
+            values = {}
+            duration = self.base_duration
+            waste, lysate = self.base_waste, self.base_lysate
+            for position, (step_values, step, d_duration, d_waste, d_lysate) in zip(
+                positions, picks
+            ):
+                steps[position] = step
+                values.update(step_values)
+                duration += d_duration
+                waste += d_waste
+                lysate += d_lysate
+            yield Variant(index, values, steps, duration, waste, lysate)
+
+    def generate(self, out_dir, prefix="variant", rank=10):
+        """Write every variant and a manifest.csv to ``out_dir``. Returns the
+        ``rank`` shortest variants and the number written."""
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        width = len(str(max(len(self) - 1, 0)))
+        keys = list(self.parameters)
+        best = []
+        count = 0
+        with open(out_dir / "manifest.csv", "w", newline="") as manifest:
+            writer = csv.writer(manifest)
+            writer.writerow(["file", *keys, "duration_s", "waste_ml", "lysate_ml"])
+            for variant in self.variants():
+                filename = f"{prefix}-{variant.index:0{width}d}.json"
+                with open(out_dir / filename, "w") as f:
+                    f.write(variant.json_text())
+                writer.writerow(
+                    [
+                        filename,
+                        *(variant.values[k] for k in keys),
+                        round(variant.duration_s, 1),
+                        round(variant.waste_ml, 4),
+                        round(variant.lysate_ml, 4),
+                    ]
+                )
+                # Keep the shortest ones without holding every variant
+                item = (-variant.duration_s, variant.index, filename, variant.values)
+                if len(best) < rank:
+                    heapq.heappush(best, item)
+                elif rank:
+                    heapq.heappushpop(best, item)
+                count += 1
+        ranked = sorted(best, key=lambda item: (-item[0], item[1]))
+        return [(filename, -d, values) for d, _, filename, values in ranked], count
+
+
+def parse_sweep_value(text):
+    values = []
+    for value in text.split(","):
+        try:
+            values.append(int(value))
+        except ValueError:
+            try:
+                values.append(float(value))
+            except ValueError:
+                values.append(value)
+    return values
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate a sweep of protocol variants."
     )
-    s3 = Step(
-        "PBS",
-        3,
-        "Rinsing the chip step 3.",
-        ScreenType.MachineActionScreen,
-        StepType.PUMP,
-        Target.WASTE,
-        volume=1.5,
-        flowrate=15.0,
-        wait_time=120,
+    parser.add_argument("template", help="protocol to vary")
+    parser.add_argument("out_dir", help="directory for the variants and manifest.csv")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="STEP.ACTION.FIELD=V1,V2,...",
+        help="values of one action parameter, repeat for more parameters",
     )
+    parser.add_argument("--prefix", default=None, help="variant file name prefix")
+    parser.add_argument("--rank", type=int, default=10, help="shortest variants shown")
+    args = parser.parse_args(argv)
+
+    parameters = OrderedDict()
+    for item in args.set:
+        key, _, values = item.partition("=")
+        if not values:
+            parser.error(f"--set {item} has no values")
+        parameters[key] = parse_sweep_value(values)
+
+    started = time.perf_counter()
+    steps = ProtocolFactory.from_file(args.template).list_of_steps
+    try:
+        sweep = Sweep(steps, parameters)
+    except SweepValueError as err:
+        parser.error(str(err))
+    except ValueError as err:
+        choices = "\n  ".join(
+            f"{key}.{{{','.join(fields)}}}" for key, fields in sweepable(steps).items()
+        )
+        parser.error(f"{err}, the steps that can be swept are:\n  {choices}")
+    prefix = args.prefix or Path(args.template).stem
+    ranked, count = sweep.generate(args.out_dir, prefix, args.rank)
+    elapsed = time.perf_counter() - started
+    print(f"{count} variants written to {args.out_dir} in {elapsed:.2f} s")
+    for filename, duration, values in ranked:
+        settings = ", ".join(f"{k}={v}" for k, v in values.items())
+        print(f"{format_duration(duration)}  {filename}  {settings}")
+    return 0
 
-    list_of_steps = [s1, s2, s3]
 
-    p = ProtocolFactory(list_of_steps)
-
-    print("Making json dump ")
-    p.json_dump()
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+
+"""
+Shorten the run time of a protocol within hard constraints.
+
+The optimizer works on the ProtocolFactory step model and makes three
+kinds of changes:
+
+merge
+    Adjacent single PUMP steps to the same pump in the same direction are
+    combined into one step when the first one has no equilibration time and
+    the combined volume fits the per step limit. The same volumes are moved
+    in the same order, only the stop and restart between them is gone.
+
+rate
+    Pump rates are set to the maximum allowed for the syringe diameter of
+    their pump (unless rates are kept), rates above that limit are lowered.
+
+incubation
+    Incubations with a minimum time in the constraints are set to it.
+
+Constraints are a JSON file:
+
+    {
+        "syringe_diameter_mm": {"waste": 12.55, "lysate": 12.55},
+        "max_rate_mh": {"12.55": 30},
+        "min_incubation_s": {"incubate_1": 1800},
+        "max_step_vol_ml": 1.5
+    }
+
+``min_incubation_s`` may also be a single number for every incubation.
+
+Run with:
+
+    chip-optimize protocol.json constraints.json -o optimized.json
+"""
+
+import argparse
+import json
+import sys
+from collections import OrderedDict
+
+from cd_alpha.ProtocolFactory import ProtocolFactory, Step
+from cd_alpha.protocols.protocol_compiler import Action as ActionType
+from cd_alpha.protocols.protocol_compiler import compile_protocol
+from cd_alpha.protocols.protocol_tools import format_duration
+
+
+class Constraints:
+    """
+    syringe_diameter_mm: dict
+        - syringe diameter per pump target
+    max_rate_mh: dict
+        - highest flow rate in ml/h per syringe diameter in mm
+    min_incubation_s: float or dict or None
+        - shortest allowed incubation, for all or per step name
+    max_step_vol_ml: float or None
+        - largest volume a single step may move
+    """
+
+    def __init__(
+        self,
+        syringe_diameter_mm,
+        max_rate_mh,
+        min_incubation_s=None,
+        max_step_vol_ml=None,
+    ):
+        self.syringe_diameter_mm = dict(syringe_diameter_mm)
+        self.max_rate_mh = {float(d): float(r) for d, r in max_rate_mh.items()}
+        self.min_incubation_s = min_incubation_s
+        self.max_step_vol_ml = max_step_vol_ml
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as f:
+            return cls(**json.load(f))
+
+    def max_rate(self, target):
+        try:
+            diameter = float(self.syringe_diameter_mm[target])
+        except KeyError:
+            raise KeyError(f"No syringe diameter for pump {target}") from None
+        try:
+            return self.max_rate_mh[diameter]
+        except KeyError:
+            raise KeyError(f"No maximum rate for a {diameter} mm syringe") from None
+
+    def min_incubation(self, step_name):
+        if isinstance(self.min_incubation_s, dict):
+            return self.min_incubation_s.get(step_name)
+        return self.min_incubation_s
+
+
+class Change:
+
+    __slots__ = ("kind", "steps", "before", "after", "saved_s")
+
+    def __init__(self, kind, steps, before, after, saved_s):
+        self.kind = kind
+        self.steps = steps
+        self.before = before
+        self.after = after
+        self.saved_s = saved_s
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __str__(self):
+        return (
+            f"{self.kind:<11}{' + '.join(self.steps):<36}"
+            f"{self.before} -> {self.after}  ({self.saved_s:+.0f} s)"
+        )
+
+
+def _single_pump(step):
+    if len(step.actions) == 1 and step.actions[0].type == ActionType.PUMP:
+        return step.actions[0]
+    return None
+
+
+class ProtocolOptimizer:
+    def __init__(self, constraints, keep_rates=False):
+        self.constraints = constraints
+        self.keep_rates = keep_rates
+
+    def optimize(self, steps):
+        """Return the optimized steps, the list of changes and the
+        constraint violations that could not be fixed."""
+        self.changes = []
+        self.violations = []
+        steps = [self._set_rates(s) for s in steps]
+        steps = [self._set_incubation(s) for s in steps]
+        steps = self._merge(steps)
+        limit = self.constraints.max_step_vol_ml
+        if limit is not None:
+            for step in steps:
+                volume = sum(step.volumes())
+                if volume > limit + 1e-9:
+                    self.violations.append(
+                        f"{step.name} moves {volume:g} ml, more than {limit:g} ml"
+                    )
+        return steps, self.changes, self.violations
+
+    def _set_rates(self, step):
+        for action in step.actions:
+            if action.type not in (ActionType.PUMP, ActionType.RELEASE):
+                continue
+            max_rate = self.constraints.max_rate(action.target)
+            rate = abs(action.rate_mh)
+            if rate > max_rate or (action.type == ActionType.PUMP and not self.keep_rates):
+                new_rate = max_rate if action.rate_mh > 0 else -max_rate
+                if new_rate == action.rate_mh:
+                    continue
+                faster = step.replace_action(action.type, rate_mh=new_rate)
+                self.changes.append(
+                    Change(
+                        "rate",
+                        [step.name],
+                        f"{action.rate_mh:g} ml/h",
+                        f"{new_rate:g} ml/h",
+                        step.duration() - faster.duration(),
+                    )
+                )
+                step = faster
+        return step
+
+    def _set_incubation(self, step):
+        minimum = self.constraints.min_incubation(step.name)
+        for action in step.actions:
+            if action.type != ActionType.INCUBATE or minimum is None:
+                continue
+            if action.time == minimum:
+                continue
+            shorter = step.replace_action(ActionType.INCUBATE, time=minimum)
+            self.changes.append(
+                Change(
+                    "incubation",
+                    [step.name],
+                    format_duration(action.time),
+                    format_duration(minimum),
+                    step.duration() - shorter.duration(),
+                )
+            )
+            step = shorter
+        return step
+
+    def _can_merge(self, first, second):
+        a, b = _single_pump(first), _single_pump(second)
+        if a is None or b is None or first.completion_msg:
+            return False
+        if a.target != b.target or a.eq_time or (a.rate_mh > 0) != (b.rate_mh > 0):
+            return False
+        if a.rate_mh != b.rate_mh:
+            # Different flow profiles stay apart
+            return False
+        limit = self.constraints.max_step_vol_ml
+        return limit is None or abs(a.vol_ml) + abs(b.vol_ml) <= limit + 1e-9
+
+    def _merge(self, steps):
+        merged = []
+        for step in steps:
+            if merged and self._can_merge(merged[-1], step):
+                first = merged[-1]
+                a, b = _single_pump(first), _single_pump(step)
+                combined = Step(
+                    first.name,
+                    first.screen_type,
+                    first.header,
+                    first.description,
+                    first.next_text,
+                    [a.replace(vol_ml=a.vol_ml + b.vol_ml, eq_time=b.eq_time)],
+                    step.completion_msg,
+                    first.remove_progress_bar,
+                )
+                self.changes.append(
+                    Change(
+                        "merge",
+                        [first.name, step.name],
+                        f"{a.vol_ml:g} + {b.vol_ml:g} ml",
+                        f"{a.vol_ml + b.vol_ml:g} ml",
+                        first.duration() + step.duration() - combined.duration(),
+                    )
+                )
+                merged[-1] = combined
+            else:
+                merged.append(step)
+        return merged
+
+
+def optimize_file(path, constraints, keep_rates=False):
+    factory = ProtocolFactory.from_file(path)
+    before = factory.duration()
+    optimizer = ProtocolOptimizer(constraints, keep_rates)
+    steps, changes, violations = optimizer.optimize(factory.list_of_steps)
+    optimized = ProtocolFactory(steps)
+    # The result must still be a valid protocol
+    compile_protocol(optimized.to_json())
+    report = OrderedDict(
+        protocol=str(path),
+        duration_before_s=before,
+        duration_after_s=optimized.duration(),
+        steps_before=len(factory.list_of_steps),
+        steps_after=len(steps),
+        changes=[c.as_dict() for c in changes],
+        violations=violations,
+    )
+    return optimized, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shorten the run time of a protocol.")
+    parser.add_argument("protocol")
+    parser.add_argument("constraints", help="constraints json file")
+    parser.add_argument("-o", "--output", required=True, help="optimized protocol")
+    parser.add_argument("--report", default=None, help="write the report as json")
+    parser.add_argument(
+        "--keep-rates", action="store_true", help="only lower rates above the limit"
+    )
+    args = parser.parse_args(argv)
+
+    optimized, report = optimize_file(
+        args.protocol, Constraints.from_file(args.constraints), args.keep_rates
+    )
+    optimized.json_dump(args.output)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+
+    for change in report["changes"]:
+        print(Change(**change))
+    for violation in report["violations"]:
+        print(f"violation  {violation}")
+    print(
+        f"{report['steps_before']} -> {report['steps_after']} steps, "
+        f"{format_duration(report['duration_before_s'])} -> "
+        f"{format_duration(report['duration_after_s'])}"
+    )
+    return 1 if report["violations"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+"""
+Push values to the GUI only when they change, at most every ``min_interval``.
+
+Every Kivy property assignment dispatches its bindings: a label formats its
+text and renders a new texture, a progress bar redraws its canvas. The timer
+of a step ticks twice a second although the countdown changes once a second
+and the progress bar moves by a fraction of a pixel. A ThrottledProperties
+holds the values of one widget, rounded by the caller to what can be seen:
+
+    schedule = partial(scheduler.call_later, group=screen.name)
+    render = ThrottledProperties(screen, 1.0, schedule, scheduler.clock)
+    render.update(countdown_text="12:04", progress=41.5)
+    render.flush()    # e.g. at the end of the step
+
+update() keeps only the values that differ from what the widget shows. They
+are pushed right away when the widget was last rendered ``min_interval``
+ago, else by one scheduled callback once that is due, so the last value is
+always shown. The callback is a timer of the screen like any other,
+cancelling it drops the render it was due for.
+"""
+
+import time
+
+
+class ThrottledProperties:
+    """
+    widget: kivy.uix.widget.Widget
+        - owner of the properties
+    min_interval: float
+        - shortest time between two renders of the widget
+    schedule: callable
+        - schedule(delay, callback), e.g. StepScheduler.call_later, returns
+        the call
+    clock: callable
+        - time of the renders, the clock the callbacks are scheduled on
+    """
+
+    def __init__(self, widget, min_interval, schedule, clock=time.monotonic):
+        self.widget = widget
+        self.min_interval = min_interval
+        self.schedule = schedule
+        self.clock = clock
+        self.pending = {}
+        self.renders = 0
+        self._rendered_at = None
+        self._call = None
+
+    def update(self, **values):
+        for name, value in values.items():
+            if getattr(self.widget, name) != value:
+                self.pending[name] = value
+            else:
+                # A pending value that came back to what is shown
+                self.pending.pop(name, None)
+        if not self.pending or self.scheduled:
+            return
+        now = self.clock()
+        if self._rendered_at is None or now - self._rendered_at >= self.min_interval:
+            self.flush()
+        else:
+            delay = self._rendered_at + self.min_interval - now
+            self._call = self.schedule(delay, self._flush_due)
+
+    @property
+    def scheduled(self):
+        return self._call is not None and not self._call.cancelled
+
+    def flush(self, *args):
+        """Push the pending values now."""
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        for name, value in pending.items():
+            setattr(self.widget, name, value)
+        self.renders += 1
+        self._rendered_at = self.clock()
+
+    def _flush_due(self, dt):
+        self._call = None
+        self.flush()
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+"""
+Record everything a run depends on, to replay field faults on a desk.
+
+A recording has one json line per event, with a monotonic time in seconds
+from the start of the run:
+
+    header     protocol file and source, start step, device, wall clock start
+    operator   a button press or popup confirmation, on which screen
+    pump       one command to the pump network and the raw reply bytes
+    nano       the limit switches of one Nano read
+    end        how the run ended
+
+The pumps and the Nano are recorded at their interface, RecordingSerial and
+RecordingNano wrap the real ones and pass everything through. Recording an
+event costs the GUI thread a queue put, a writer thread encodes the queued
+events and writes them a few times a second with one flush per batch, like
+LogPipeline. A recording survives a crash of the app but its last
+``interval``, and is complete once finished. Replay a recording in
+simulated time with software_testing/RunReplay.py:
+
+    chip-replay ~/.local/share/cd_alpha/recordings/2023-05-02_141500-run12.jsonl
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+DEFAULT_RECORDING_DIR = Path.home() / ".local" / "share" / "cd_alpha" / "recordings"
+FORMAT_VERSION = 1
+SWITCHES = ("d2", "d3", "d4", "d5")
+ETX = b"\x03"
+
+log = logging.getLogger("cd_alpha.recording")
+
+
+def _text(value):
+    # The raw bytes of the pump link are written as latin-1 text
+    if isinstance(value, bytes):
+        return value.decode("latin-1")
+    raise TypeError(f"{type(value).__name__} is not recordable")
+
+
+class RecordWriter(threading.Thread):
+    """Writes the queued records of one recording every ``interval`` seconds
+    and closes its file once stopped."""
+
+    def __init__(self, file, interval=0.25):
+        super().__init__(name="RunRecording", daemon=True)
+        self.file = file
+        self.interval = interval
+        self.queue = queue.SimpleQueue()
+        self.stopped = threading.Event()
+        self.failed = None
+
+    def put(self, record):
+        self.queue.put(record)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self._write(self._drain())
+        # Write whatever was queued before the stop
+        self._write(self._drain())
+        self.file.close()
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _write(self, batch):
+        if not batch or self.failed is not None:
+            return
+        try:
+            self.file.write("".join(json.dumps(r, default=_text) + "\n" for r in batch))
+            self.file.flush()
+        except (OSError, TypeError, ValueError) as err:
+            log.warning("CDA: Recording stopped, %s", err)
+            self.failed = err
+
+    def stop(self, timeout=2.0):
+        self.stopped.set()
+        self.join(timeout)
+
+
+class RunRecorder:
+    """
+    clock: callable
+        - monotonic time of the records, e.g. the scheduler clock
+    interval: float
+        - seconds between two writes of the queued records
+    """
+
+    def __init__(self, clock=time.monotonic, interval=0.25):
+        self.clock = clock
+        self.interval = interval
+        self.path = None
+        self.outcome = None
+        self._writer = None
+        self._started = None
+
+    @property
+    def active(self):
+        return self._writer is not None
+
+    def start(self, path, **header):
+        """Start recording a run to ``path``, the keyword arguments go to the
+        header. A recording that cannot be written is skipped, it never
+        stops a run."""
+        self.close()
+        path = Path(path)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            file = open(path, "w")
+        except OSError as err:
+            log.warning("CDA: Not recording the run, %s", err)
+            return None
+        self._writer = RecordWriter(file, self.interval)
+        self._writer.start()
+        self.path = path
+        self.outcome = None
+        self._started = self.clock()
+        self._write(
+            {
+                "kind": "header",
+                "version": FORMAT_VERSION,
+                "started_at": datetime.now().isoformat(timespec="seconds"),
+                **header,
+            }
+        )
+        return path
+
+    def record(self, kind, t=None, **data):
+        if self._writer is None:
+            return
+        now = self.clock() if t is None else t
+        self._write({"t": round(now - self._started, 6), "kind": kind, **data})
+
+    def operator(self, action, screen, **data):
+        self.record("operator", action=action, screen=screen, **data)
+
+    def pump(self, tx, rx, rtt, t=None):
+        # The writer decodes the bytes
+        self.record("pump", t, tx=tx, rx=rx, rtt=round(rtt, 6))
+
+    def nano(self, nano):
+        self.record("nano", **{s: bool(getattr(nano, s)) for s in SWITCHES})
+
+    def finish(self, outcome, cause=None):
+        """End the recording, returns its path."""
+        if self._writer is None:
+            return None
+        self.record("end", outcome=outcome, cause=cause)
+        self.outcome = outcome
+        self._writer.stop()
+        self._writer = None
+        return self.path
+
+    def close(self):
+        """End a recording that was not finished."""
+        self.finish("interrupted")
+
+    def _write(self, record):
+        self._writer.put(record)
+
+
+class RecordingSerial:
+    """Serial port of the pump network, every command is recorded with its
+    reply once the reply is complete or timed out."""
+
+    def __init__(self, ser, recorder):
+        self.ser = ser
+        self.recorder = recorder
+        self._tx = None
+        self._rx = []
+        self._t = None
+        self._sent = None
+
+    def write(self, data):
+        self._flush()
+        self._tx = bytes(data)
+        self._rx = []
+        self._t = self.recorder.clock()
+        self._sent = time.perf_counter()
+        return self.ser.write(data)
+
+    def readline(self, *args):
+        return self._received(self.ser.readline(*args))
+
+    def read(self, *args):
+        return self._received(self.ser.read(*args))
+
+    def close(self):
+        self._flush()
+        self.ser.close()
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.ser.timeout = timeout
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def _received(self, data):
+        if self._tx is not None:
+            self._rx.append(data)
+            if data == b"" or data.endswith(ETX):
+                self._flush()
+        return data
+
+    def _flush(self):
+        if self._tx is None:
+            return
+        rtt = time.perf_counter() - self._sent
+        self.recorder.pump(self._tx, b"".join(self._rx), rtt, t=self._t)
+        self._tx = None
+
+
+class RecordingNano:
+    """Nano of the limit switches, every read is recorded."""
+
+    def __init__(self, nano, recorder):
+        self.nano = nano
+        self.recorder = recorder
+
+    def update(self):
+        self.nano.update()
+        self.recorder.nano(self.nano)
+
+    def __getattr__(self, name):
+        return getattr(self.nano, name)
+
+
+def read_recording(path):
+    """The header, the events and the end record of a recording. The end
+    is None when the app stopped in the middle of the run."""
+    header, events, end = None, [], None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record["kind"] == "header":
+                header = record
+            elif record["kind"] == "end":
+                end = record
+            else:
+                events.append(record)
+    if header is None:
+        raise ValueError(f"{path} is not a run recording, it has no header")
+    if header.get("version") != FORMAT_VERSION:
+        raise ValueError(f"{path} has recording format {header.get('version')}")
+    return header, events, end
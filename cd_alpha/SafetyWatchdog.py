@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+
+"""
+Pump safety watchdog in a process of its own.
+
+The app can only stop its pumps while it runs: a crash of the Kivy process
+leaves the pumps to the exception handler of main() and a hung process stops
+nothing at all. The watchdog is a small separate process with its own handle
+on the pump serial port. It stops the pumps when
+
+    the app dies        its end of the pipe closes without a goodbye
+    the app hangs       no heartbeat for ``heartbeat_timeout``
+    a pump overruns     it is still armed ``grace`` after its planned end
+
+The app talks to it through a SafetyLink, one json line per message on the
+stdin of the watchdog:
+
+    {"hb": 1}                   heartbeat, sent from the GUI main loop
+    {"arm": 1, "for": 120.0}    pump 1 may run for 120 s from now
+    {"disarm": 1}               pump 1 is done, {"disarm": null} for all
+    {"bye": 1}                  the app exits cleanly
+
+and the watchdog reports every stop on its stdout, which the app reads from
+its main loop to abort the run:
+
+    {"trip": [1, 2], "reason": "no heartbeat for 30.2 s"}
+
+The GUI main loop sends the heartbeat and waits for the pumps on a blocking
+serial link, the heartbeat timeout is well above the longest a pump command
+may take with its retries. A pump is only disarmed once the app read its
+status as stopped, at the end of a step or when it polls the pumps that are
+past their planned end (SafetyLink.overdue). A pump that keeps running is
+stopped ``grace`` after its planned end, whether the app is responsive or
+not. Both are above the worst case of the serial link, a slow pump never
+stops a run.
+
+The watchdog only writes to the serial port, it never reads: the app reads
+the replies of its own commands on the same port. A stop writes STP to every
+pump concerned at once and the replies are left to the app, which drops them
+when it is told about the stop. Deadlines are on the monotonic clock of the
+watchdog, arming sends a duration and not a time so the clock of the app
+does not matter.
+"""
+
+import argparse
+import json
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+HEARTBEAT_INTERVAL = 0.5
+# A pump command retried to the end takes up to 8 s on the defaults of
+# PumpNetwork and LinkLatency, a main loop waiting for one must not trip
+HEARTBEAT_TIMEOUT = 30.0
+OVERRUN_GRACE = 10.0
+READY = "ready"
+
+log = logging.getLogger("cd_alpha.safety")
+
+
+class SafetyWatchdog:
+    """
+    ser: serial.Serial
+        - own handle on the pump network
+    addrs: list[int]
+        - every pump, stopped when the app dies or hangs
+    heartbeat_timeout: float
+        - longest silence of the app
+    grace: float
+        - how long an armed pump may run past its planned end
+    report: file or None
+        - text stream every stop is reported on, one json line each
+    clock: callable
+    """
+
+    def __init__(
+        self,
+        ser,
+        addrs,
+        heartbeat_timeout=HEARTBEAT_TIMEOUT,
+        grace=OVERRUN_GRACE,
+        report=None,
+        clock=time.monotonic,
+    ):
+        self.ser = ser
+        self.addrs = list(addrs)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.grace = grace
+        self.report = report
+        self.clock = clock
+        self.last_heartbeat = clock()
+        # Planned end of every armed pump, grace included
+        self.armed = {}
+        self.hung = False
+        self.trips = []
+
+    def next_deadline(self):
+        deadlines = list(self.armed.values())
+        if not self.hung:
+            deadlines.append(self.last_heartbeat + self.heartbeat_timeout)
+        return min(deadlines) if deadlines else None
+
+    def feed(self, message):
+        now = self.clock()
+        if "hb" in message:
+            if self.hung:
+                log.warning("SWD: Heartbeat back after %.1f s", now - self.last_heartbeat)
+                self.hung = False
+            self.last_heartbeat = now
+        elif "arm" in message:
+            self.armed[message["arm"]] = now + message["for"] + self.grace
+        elif "disarm" in message:
+            if message["disarm"] is None:
+                self.armed.clear()
+            else:
+                self.armed.pop(message["disarm"], None)
+
+    def check(self):
+        """Stop what is overdue, returns the pumps stopped."""
+        now = self.clock()
+        if not self.hung and now - self.last_heartbeat > self.heartbeat_timeout:
+            self.hung = True
+            self.armed.clear()
+            silence = now - self.last_heartbeat
+            return self.stop(self.addrs, f"no heartbeat for {silence:.1f} s")
+        overdue = [addr for addr, deadline in self.armed.items() if now > deadline]
+        for addr in overdue:
+            del self.armed[addr]
+        if overdue:
+            return self.stop(overdue, "past the planned end of the step")
+        return []
+
+    def stop(self, addrs, reason):
+        started = self.clock()
+        for addr in addrs:
+            self.ser.write(b"%dSTP\r" % addr)
+        self.ser.flush()
+        log.error(
+            "SWD: Stopped pump %s, %s", " and ".join(str(a) for a in addrs), reason
+        )
+        self.trips.append({"t": started, "addrs": list(addrs), "reason": reason})
+        if self.report is not None:
+            trip = {"trip": list(addrs), "reason": reason}
+            try:
+                self.report.write(json.dumps(trip) + "\n")
+                self.report.flush()
+            except OSError:
+                # The app is gone
+                pass
+        return list(addrs)
+
+    def serve(self, stream):
+        """Watch the app on ``stream`` until it says goodbye or dies."""
+        fd = stream.fileno()
+        buffer = b""
+        while True:
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else max(deadline - self.clock(), 0)
+            readable, _, _ = select.select([fd], [], [], timeout)
+            if readable:
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    self.stop(self.addrs, "the app died")
+                    return False
+                buffer += chunk
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    message = json.loads(line)
+                    if "bye" in message:
+                        log.info("SWD: App exited, watchdog stopping")
+                        return True
+                    self.feed(message)
+            self.check()
+
+
+class SafetyLink:
+    """App side of the watchdog, starts the process and talks to it. A
+    watchdog that died is reported once and then left alone, the app keeps
+    running without it.
+
+    serial_path: str
+    addrs: list[int]
+    heartbeat_timeout, grace: float
+        - passed on to the SafetyWatchdog
+    clock: callable
+        - time of the planned ends of the armed pumps
+    """
+
+    def __init__(
+        self,
+        serial_path,
+        addrs,
+        heartbeat_timeout=HEARTBEAT_TIMEOUT,
+        grace=OVERRUN_GRACE,
+        clock=time.monotonic,
+    ):
+        self.serial_path = serial_path
+        self.addrs = list(addrs)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.grace = grace
+        self.clock = clock
+        self.process = None
+        # Planned end of the motion of every armed pump
+        self.planned = {}
+        self._reports = b""
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, ready_timeout=10):
+        """Start the watchdog and wait until it holds the serial port."""
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "cd_alpha.SafetyWatchdog",
+                self.serial_path,
+                "--addrs",
+                *map(str, self.addrs),
+                "--heartbeat-timeout",
+                str(self.heartbeat_timeout),
+                "--grace",
+                str(self.grace),
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+        )
+        readable, _, _ = select.select([self.process.stdout], [], [], ready_timeout)
+        line = self.process.stdout.readline() if readable else b""
+        if line.strip() != READY.encode():
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+            raise IOError(f"Safety watchdog did not start on {self.serial_path}")
+        log.info("SWD: Watchdog %d watching pumps %s", self.process.pid, self.addrs)
+        return self
+
+    def heartbeat(self, *args):
+        self._send({"hb": 1})
+
+    def poll(self, *args):
+        """Heartbeat from the main loop of the app. Returns the stops the
+        watchdog made since the last poll, e.g.
+        [{"trip": [1, 2], "reason": "..."}]."""
+        self.heartbeat()
+        return self._read_trips()
+
+    def overdue(self):
+        """Armed pumps past their planned end. The app disarms the ones it
+        reads as stopped, the others are stopped by the watchdog."""
+        now = self.clock()
+        return [addr for addr, end in self.planned.items() if now >= end]
+
+    def arm(self, addr, seconds):
+        self.planned[addr] = self.clock() + seconds
+        self._send({"arm": addr, "for": seconds})
+
+    def disarm(self, addr=None):
+        if addr is None:
+            self.planned.clear()
+        else:
+            self.planned.pop(addr, None)
+        self._send({"disarm": addr})
+
+    def _read_trips(self):
+        if self.process is None:
+            return []
+        stdout = self.process.stdout
+        readable, _, _ = select.select([stdout], [], [], 0)
+        if not readable:
+            return []
+        chunk = os.read(stdout.fileno(), 4096)
+        if not chunk:
+            return []
+        self._reports += chunk
+        lines = self._reports.split(b"\n")
+        self._reports = lines.pop()
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def close(self):
+        if self.process is None:
+            return
+        self._send({"bye": 1})
+        process, self.process = self.process, None
+        process.stdin.close()
+        process.stdout.close()
+        process.wait()
+
+    def _send(self, message):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(json.dumps(message).encode() + b"\n")
+        except OSError as err:
+            log.error("SWD: Safety watchdog is gone, pumps are unguarded: %s", err)
+            self.process = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("serial", help="pump serial port")
+    parser.add_argument("--addrs", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT)
+    parser.add_argument("--grace", type=float, default=OVERRUN_GRACE)
+    args = parser.parse_args(argv)
+    # A Ctrl-C on the app reaches the watchdog too, it stops the pumps when
+    # the app is gone and not before
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO, format="[%(levelname)-7s] %(asctime)s %(message)s"
+    )
+    import serial
+
+    # Written to only, the replies are read by the app
+    ser = serial.Serial(args.serial, 19200)
+    watchdog = SafetyWatchdog(
+        ser, args.addrs, args.heartbeat_timeout, args.grace, report=sys.stdout
+    )
+    print(READY, flush=True)
+    try:
+        return 0 if watchdog.serve(sys.stdin.buffer) else 1
+    finally:
+        ser.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+
+"""
+Single owner of every step timer in the app.
+
+All timers are absolute deadlines on ``time.monotonic()`` kept in one heap.
+The scheduler only asks its waker for a single wakeup at the earliest
+deadline, instead of every poller keeping its own Kivy clock event alive.
+Callbacks that are due within ``coalesce_window`` of each other are run in
+the same wakeup. Timers are tagged with a group (the step they belong to) so
+that everything a step scheduled can be cancelled in one call.
+
+Callbacks follow the Kivy clock convention: they are called with the time
+since they were scheduled or last called and a repeating callback that
+returns False is not called again.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from cd_alpha import Metrics
+
+
+class ScheduledCall:
+
+    __slots__ = (
+        "deadline",
+        "callback",
+        "group",
+        "interval",
+        "last",
+        "seq",
+        "cancelled",
+        "scheduler",
+    )
+
+    def __init__(self, scheduler, deadline, callback, group, interval, last, seq):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.group = group
+        self.interval = interval
+        self.last = last
+        self.seq = seq
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    @property
+    def name(self):
+        callback = self.callback
+        while hasattr(callback, "func"):  # functools.partial
+            callback = callback.func
+        return getattr(callback, "__qualname__", repr(callback))
+
+    def __repr__(self):
+        return (
+            f"ScheduledCall({self.name}, group={self.group!r}, "
+            f"deadline={self.deadline:.3f}, interval={self.interval})"
+        )
+
+
+class StepScheduler:
+    """
+    clock: callable
+        Monotonic time source in seconds, ``time.monotonic`` by default.
+
+    waker: callable(delay)
+        Asked to call ``run_due`` after ``delay`` seconds, or to cancel any
+        pending wakeup when ``delay`` is None. Only the earliest deadline is
+        ever armed.
+
+    coalesce_window: float
+        Callbacks due within this many seconds of each other run together.
+
+    name: str or None
+        Label of the scheduler lag metric, the lag is not recorded without.
+    """
+
+    def __init__(
+        self, clock=time.monotonic, waker=None, coalesce_window=0.005, name=None
+    ):
+        self.clock = clock
+        self.name = name
+        self.waker = waker
+        self.coalesce_window = coalesce_window
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+        self._armed = None
+        self._in_flight = []
+        self.wakeups = 0
+
+    def call_at(self, deadline, callback, group=None, interval=None):
+        with self._lock:
+            call = ScheduledCall(
+                self,
+                deadline,
+                callback,
+                group,
+                interval,
+                self.clock(),
+                next(self._counter),
+            )
+            heapq.heappush(self._heap, call)
+            self._rearm()
+        return call
+
+    def call_later(self, delay, callback, group=None):
+        return self.call_at(self.clock() + delay, callback, group)
+
+    def call_every(self, interval, callback, group=None):
+        return self.call_at(self.clock() + interval, callback, group, interval)
+
+    def cancel(self, call):
+        with self._lock:
+            if call.cancelled:
+                return
+            call.cancelled = True
+            self._rearm()
+
+    def cancel_group(self, group):
+        with self._lock:
+            for call in itertools.chain(self._heap, self._in_flight):
+                if call.group == group:
+                    call.cancelled = True
+            self._rearm()
+
+    def cancel_all(self):
+        with self._lock:
+            for call in itertools.chain(self._heap, self._in_flight):
+                call.cancelled = True
+            self._heap = []
+            self._rearm()
+
+    def queue(self):
+        """Snapshot of the pending calls, earliest first."""
+        with self._lock:
+            return sorted(c for c in self._heap if not c.cancelled)
+
+    def groups(self):
+        return {c.group for c in self.queue()}
+
+    def next_deadline(self):
+        with self._lock:
+            self._drop_cancelled()
+            return self._heap[0].deadline if self._heap else None
+
+    def run_due(self, now=None):
+        """Run every callback that is due, returns the number of calls made."""
+        with self._lock:
+            self._armed = None
+            self.wakeups += 1
+            now = self.clock() if now is None else now
+            due = []
+            while self._heap and self._heap[0].deadline <= now + self.coalesce_window:
+                call = heapq.heappop(self._heap)
+                if not call.cancelled:
+                    due.append(call)
+            self._in_flight = pending = list(due)
+        try:
+            while pending:
+                # The running call stays in flight so that it can cancel itself
+                call = pending[0]
+                # An earlier callback in this batch may have cancelled it
+                if call.cancelled:
+                    pending.pop(0)
+                    continue
+                if self.name is not None:
+                    # Looked up every time, a reset of the registry drops
+                    # the series of a run
+                    lag = Metrics.scheduler_lag.labels(self.name)
+                    lag.observe(max(now - call.deadline, 0))
+                dt = now - call.last
+                call.last = now
+                keep = call.callback(dt)
+                pending.pop(0)
+                if call.interval is None or keep is False or call.cancelled:
+                    call.cancelled = True
+                    continue
+                # Fixed rate without accumulating drift, skip missed ticks
+                call.deadline += call.interval
+                if call.deadline <= now:
+                    missed = (now - call.deadline) // call.interval + 1
+                    call.deadline += missed * call.interval
+                with self._lock:
+                    heapq.heappush(self._heap, call)
+        finally:
+            with self._lock:
+                self._in_flight = []
+                # Calls left over after a callback raised stay scheduled
+                for call in pending:
+                    if not call.cancelled:
+                        heapq.heappush(self._heap, call)
+                self._rearm()
+        return len(due)
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0].cancelled:
+            heapq.heappop(self._heap)
+
+    def _rearm(self):
+        self._drop_cancelled()
+        deadline = self._heap[0].deadline if self._heap else None
+        if deadline == self._armed or self.waker is None:
+            return
+        self._armed = deadline
+        self.waker(None if deadline is None else max(deadline - self.clock(), 0))
+
+
+class KivyClockWaker:
+    """Drive a StepScheduler from the Kivy main loop with one clock event."""
+
+    def __init__(self, scheduler):
+        from kivy.clock import Clock
+
+        self.clock = Clock
+        self.scheduler = scheduler
+        self.event = None
+        scheduler.waker = self.arm
+
+    def arm(self, delay):
+        if self.event is not None:
+            self.event.cancel()
+            self.event = None
+        if delay is not None:
+            self.event = self.clock.schedule_once(self._fire, delay)
+
+    def _fire(self, dt):
+        self.event = None
+        self.scheduler.run_due()
+
+
+class ThreadWaker:
+    """Drive a StepScheduler from a dedicated timing thread, so deadlines fire
+    on time no matter how long the Kivy frames take. Callbacks run on this
+    thread and must hand any GUI work back to the main loop."""
+
+    def __init__(self, scheduler, name="cd-alpha-step-timer"):
+        self.scheduler = scheduler
+        self._condition = threading.Condition()
+        self._target = None
+        self._stopped = False
+        scheduler.waker = self.arm
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def arm(self, delay):
+        with self._condition:
+            self._target = None if delay is None else self.scheduler.clock() + delay
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.thread.join()
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                if self._target is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._target - self.scheduler.clock()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                self._target = None
+                self._condition.release()
+                try:
+                    self.scheduler.run_due()
+                except Exception:
+                    logging.exception("SCH: Step timer callback failed")
+                finally:
+                    self._condition.acquire()
@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+
+"""
+Per run telemetry in a local SQLite database.
+
+Every run records the planned and actual start and end of its steps, the
+latency of every pump command, when limit switches triggered and how the run
+ended. Times of a run are seconds on a monotonic clock from the start of the
+run, the planned times come from the protocol timeline. Rows are buffered and
+written once per step so the database is not touched on every pump command.
+
+The GUI and the ProtocolExecutor both record through a TelemetryRecorder.
+Summarise the recorded runs with:
+
+    chip-telemetry [--protocol v0-protocol-21v4] [--since 2023-01-01]
+"""
+
+import argparse
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from cd_alpha import Metrics
+from cd_alpha.NewEraPumps import command_name
+from cd_alpha.protocols.protocol_tools import USER
+
+DEFAULT_TELEMETRY_PATH = Path.home() / ".local" / "share" / "cd_alpha" / "telemetry.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    protocol TEXT NOT NULL,
+    source_hash TEXT,
+    device TEXT,
+    started_at REAL NOT NULL,
+    ended_at REAL,
+    duration_s REAL,
+    outcome TEXT,
+    abort_cause TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    position INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    estimated INTEGER NOT NULL,
+    planned_start REAL,
+    planned_end REAL,
+    actual_start REAL,
+    actual_end REAL
+);
+CREATE TABLE IF NOT EXISTS pump_commands (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    step TEXT,
+    addr TEXT,
+    command TEXT NOT NULL,
+    time REAL NOT NULL,
+    latency_s REAL NOT NULL,
+    ok INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS switches (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    step TEXT,
+    switch TEXT NOT NULL,
+    addr INTEGER,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_protocol ON runs (protocol);
+CREATE INDEX IF NOT EXISTS runs_started_at ON runs (started_at);
+CREATE INDEX IF NOT EXISTS steps_step ON steps (step);
+CREATE INDEX IF NOT EXISTS steps_run ON steps (run_id);
+CREATE INDEX IF NOT EXISTS pump_commands_run ON pump_commands (run_id);
+CREATE INDEX IF NOT EXISTS switches_run ON switches (run_id);
+"""
+
+
+def open_database(db_path):
+    if str(db_path) != ":memory:":
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    # Pump commands may be recorded from other threads than the GUI one
+    db = sqlite3.connect(str(db_path), check_same_thread=False)
+    db.executescript(SCHEMA)
+    return db
+
+
+class TelemetryRecorder:
+    """
+    db_path: str or Path
+        - SQLite database the runs are added to
+    clock: callable
+        - monotonic time source, the time of a run starts at its first step
+
+    Recording never raises, a failing database only logs a warning.
+    """
+
+    def __init__(self, db_path=DEFAULT_TELEMETRY_PATH, clock=time.monotonic):
+        self.db = open_database(db_path)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.run_id = None
+        self.run_start = None
+        self.timeline = None
+        self.current_step = None
+        self._steps = {}
+        self._commands = []
+        self._switches = []
+
+    @property
+    def active(self):
+        return self.run_id is not None
+
+    def close(self):
+        self.db.close()
+
+    def _now(self, t):
+        return (self.clock() if t is None else t) - self.run_start
+
+    def start_run(self, protocol, name, device="", t=None):
+        """Start recording a run of a CompiledProtocol, a run that is still
+        open is closed as interrupted."""
+        if self.active:
+            self.finish("interrupted")
+        with self.lock:
+            try:
+                with self.db:
+                    cursor = self.db.execute(
+                        "INSERT INTO runs (protocol, source_hash, device, started_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        (name, protocol.source_hash, device, time.time()),
+                    )
+            except sqlite3.Error as err:
+                logging.warning(f"TEL: Could not start run: {err}")
+                return
+            self.run_id = cursor.lastrowid
+            self.run_start = self.clock() if t is None else t
+            self.timeline = protocol.timeline
+            self.current_step = None
+            self._steps = {}
+
+    def step_started(self, name, t=None):
+        """Start ``name``, which ends the step before it. Steps end when the
+        next one starts so completion messages count like in the timeline."""
+        if not self.active or name not in self.timeline.names:
+            return
+        now = self._now(t)
+        self._end_step(now)
+        with self.lock:
+            self.current_step = name
+            self._steps[name] = [now, None]
+        self.flush()
+
+    def _end_step(self, now):
+        with self.lock:
+            name = self.current_step
+            if name not in self._steps:
+                return
+            self._steps[name][1] = now
+            i = self.timeline.index(name)
+        # Operator steps have no planned length
+        if self.timeline.kinds[i] != USER:
+            error = now - self._steps[name][0] - float(self.timeline.durations[i])
+            Metrics.step_duration_error.labels(name).observe(error)
+
+    def pump_command(self, addr, command, latency_s, ok=True, t=None):
+        if not self.active:
+            return
+        with self.lock:
+            self._commands.append(
+                (
+                    self.run_id,
+                    self.current_step,
+                    str(addr),
+                    command,
+                    self._now(t),
+                    latency_s,
+                    int(ok),
+                )
+            )
+
+    def switch_triggered(self, switch, addr, t=None):
+        if not self.active:
+            return
+        with self.lock:
+            self._switches.append(
+                (self.run_id, self.current_step, switch, addr, self._now(t))
+            )
+
+    def finish(self, outcome, cause=None, t=None):
+        """Close the run as finished, aborted or failed."""
+        if not self.active:
+            return
+        duration = self._now(t)
+        self._end_step(duration)
+        self.flush()
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute(
+                        "UPDATE runs SET ended_at = ?, duration_s = ?, outcome = ?, "
+                        "abort_cause = ? WHERE id = ?",
+                        (time.time(), duration, outcome, cause, self.run_id),
+                    )
+            except sqlite3.Error as err:
+                logging.warning(f"TEL: Could not finish run: {err}")
+            logging.info(f"TEL: Run {self.run_id} {outcome} after {duration:.1f} s")
+            self.run_id = None
+
+    def flush(self):
+        """Write the buffered rows in one transaction."""
+        with self.lock:
+            steps = []
+            for name, (start, end) in list(self._steps.items()):
+                if end is None:
+                    continue
+                i = self.timeline.index(name)
+                steps.append(
+                    (
+                        self.run_id,
+                        i,
+                        name,
+                        int(self.timeline.estimated[i]),
+                        float(self.timeline.starts[i]),
+                        float(self.timeline.ends[i]),
+                        start,
+                        end,
+                    )
+                )
+                del self._steps[name]
+            commands, self._commands = self._commands, []
+            switches, self._switches = self._switches, []
+            try:
+                with self.db:
+                    self.db.executemany(
+                        "INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)", steps
+                    )
+                    self.db.executemany(
+                        "INSERT INTO pump_commands VALUES (?, ?, ?, ?, ?, ?, ?)", commands
+                    )
+                    self.db.executemany(
+                        "INSERT INTO switches VALUES (?, ?, ?, ?, ?)", switches
+                    )
+            except sqlite3.Error as err:
+                logging.warning(f"TEL: Could not write telemetry: {err}")
+
+    def on_executor_event(self, event):
+        """ProtocolExecutor listener, see ProtocolExecutor.subscribe."""
+        if event.kind == "step_started":
+            self.step_started(event.step, event.time)
+        elif event.kind == "switch_triggered":
+            self.switch_triggered(event.data["switch"], event.data["addr"], event.time)
+        elif event.kind == "protocol_finished":
+            self.finish("finished", t=event.time)
+        elif event.kind == "protocol_aborted":
+            self.finish("aborted", event.data.get("cause"), t=event.time)
+        elif event.kind == "protocol_failed":
+            self.finish("failed", event.data.get("error"), t=event.time)
+
+
+# ---- analysis ---- #
+
+
+def _run_filter(protocol, since):
+    clauses, params = [], []
+    if protocol is not None:
+        clauses.append("runs.protocol = ?")
+        params.append(protocol)
+    if since is not None:
+        clauses.append("runs.started_at >= ?")
+        params.append(since)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def step_statistics(db, protocol=None, since=None):
+    """Overrun (actual minus planned length) and start drift (actual minus
+    planned start, operator time included) of every step across runs.
+    Returns a dict of step name to a dict of statistics in seconds."""
+    where, params = _run_filter(protocol, since)
+    rows = db.execute(
+        "SELECT steps.step, steps.position, steps.planned_start, steps.planned_end, "
+        "steps.actual_start, steps.actual_end FROM steps "
+        f"JOIN runs ON runs.id = steps.run_id{where} ORDER BY steps.position",
+        params,
+    ).fetchall()
+    if not rows:
+        return {}
+    names = np.array([row[0] for row in rows])
+    times = np.array([row[2:] for row in rows], dtype=np.float64)
+    overrun = (times[:, 3] - times[:, 2]) - (times[:, 1] - times[:, 0])
+    drift = times[:, 2] - times[:, 0]
+    stats = {}
+    for name in dict.fromkeys(names.tolist()):
+        mask = names == name
+        values = overrun[mask]
+        stats[name] = {
+            "runs": int(mask.sum()),
+            "planned_s": float(np.median(times[mask, 1] - times[mask, 0])),
+            "overrun_mean_s": float(values.mean()),
+            "overrun_std_s": float(values.std()),
+            "overrun_p95_s": float(np.percentile(values, 95)),
+            "overrun_max_s": float(values.max()),
+            "drift_mean_s": float(drift[mask].mean()),
+        }
+    return stats
+
+
+def command_statistics(db, protocol=None, since=None):
+    """Pump command latency per command, in seconds."""
+    where, params = _run_filter(protocol, since)
+    rows = db.execute(
+        "SELECT pump_commands.command, pump_commands.latency_s, pump_commands.ok "
+        f"FROM pump_commands JOIN runs ON runs.id = pump_commands.run_id{where}",
+        params,
+    ).fetchall()
+    if not rows:
+        return {}
+    commands = np.array([command_name(row[0]) for row in rows])
+    latency = np.array([row[1] for row in rows], dtype=np.float64)
+    ok = np.array([row[2] for row in rows], dtype=bool)
+    stats = {}
+    for command in np.unique(commands).tolist():
+        mask = commands == command
+        stats[command] = {
+            "count": int(mask.sum()),
+            "errors": int((~ok[mask]).sum()),
+            "latency_mean_s": float(latency[mask].mean()),
+            "latency_p99_s": float(np.percentile(latency[mask], 99)),
+        }
+    return stats
+
+
+def outcome_counts(db, protocol=None, since=None):
+    where, params = _run_filter(protocol, since)
+    return db.execute(
+        "SELECT outcome, abort_cause, COUNT(*) FROM runs"
+        f"{where} GROUP BY outcome, abort_cause ORDER BY COUNT(*) DESC",
+        params,
+    ).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise the recorded runs.")
+    parser.add_argument("--db", default=DEFAULT_TELEMETRY_PATH)
+    parser.add_argument("--protocol", default=None, help="only runs of this protocol")
+    parser.add_argument("--since", default=None, help="only runs since YYYY-MM-DD")
+    args = parser.parse_args(argv)
+
+    since = datetime.fromisoformat(args.since).timestamp() if args.since else None
+    db = open_database(args.db)
+    steps = step_statistics(db, args.protocol, since)
+    if not steps:
+        print("No runs recorded")
+        return 1
+    print(
+        f"{'step':<28}{'runs':>5}{'planned':>10}{'overrun':>10}"
+        f"{'std':>8}{'p95':>8}{'max':>8}{'drift':>10}"
+    )
+    for name, s in steps.items():
+        print(
+            f"{name:<28}{s['runs']:>5}{s['planned_s']:>10.1f}{s['overrun_mean_s']:>10.1f}"
+            f"{s['overrun_std_s']:>8.1f}{s['overrun_p95_s']:>8.1f}"
+            f"{s['overrun_max_s']:>8.1f}{s['drift_mean_s']:>10.1f}"
+        )
+    print()
+    print(f"{'command':<10}{'count':>8}{'errors':>8}{'mean ms':>10}{'p99 ms':>10}")
+    for command, s in command_statistics(db, args.protocol, since).items():
+        print(
+            f"{command:<10}{s['count']:>8}{s['errors']:>8}"
+            f"{s['latency_mean_s'] * 1000:>10.1f}{s['latency_p99_s'] * 1000:>10.1f}"
+        )
+    print()
+    for outcome, cause, count in outcome_counts(db, args.protocol, since):
+        print(f"{count:>5}  {outcome or 'unfinished'}{f' ({cause})' if cause else ''}")
+    db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,384 @@
+#!/usr/bin/python3
+
+"""
+Delta over-the-air updates for the cd_alpha package.
+
+An update source is content-addressed. It holds every file blob under
+``objects/<sha256>`` and a ``latest.json`` pointer naming the release version
+and the hash of its manifest, which is itself stored as an object:
+
+    <source>/latest.json      {"version": "1.3", "manifest": "<sha256>"}
+    <source>/objects/<sha256> file contents (manifest included)
+
+The manifest maps every relative path of the release to its hash, size and
+mode. A release holds the ``cd_alpha`` package itself. On the device every
+release is installed into its own directory and ``current`` is a symlink to
+the active one:
+
+    <root>/releases/<version>/cd_alpha/...
+    <root>/current -> releases/<version>
+
+The app is started with ``current`` first on the import path, so the package
+of the active release is imported and not the one installed with pip:
+
+    PYTHONPATH=<root>/current python3 -m cd_alpha.ChipFlowApp
+
+device_config.json belongs to the device and not to a release, it is never
+published and is read from outside the releases, see Device.device_config_path.
+
+An update only downloads objects whose hash differs from the running release,
+hard-links the unchanged files, verifies the complete staged tree and then
+swaps the ``current`` symlink with a single ``os.replace``. If power drops at
+any point the device keeps booting either the old or the new release, never
+a mix of both.
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+
+MANIFEST_NAME = ".manifest.json"
+LATEST_NAME = "latest.json"
+OBJECTS_DIR = "objects"
+RELEASES_DIR = "releases"
+STAGING_DIR = "staging"
+CURRENT_LINK = "current"
+CHUNK_SIZE = 64 * 1024
+PACKAGE_NAME = "cd_alpha"
+EXCLUDE = ("__pycache__", ".git", "device_config.json")
+
+
+class UpdateError(Exception):
+    pass
+
+
+def sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(tree, version, package=PACKAGE_NAME, exclude=EXCLUDE):
+    """Hash every file below the package directory ``tree`` and return a
+    release manifest dict, the files are installed below ``package``."""
+    tree = Path(tree)
+    files = {}
+    for path in sorted(tree.rglob("*")):
+        rel = path.relative_to(tree)
+        if any(part in exclude for part in rel.parts) or not path.is_file():
+            continue
+        if rel.name == MANIFEST_NAME or path.suffix in (".pyc", ".pyo"):
+            continue
+        files[(Path(package) / rel).as_posix()] = {
+            "sha256": sha256_file(path),
+            "size": path.stat().st_size,
+            "mode": path.stat().st_mode & 0o777,
+        }
+    return {"version": str(version), "files": files}
+
+
+def _write_atomic(path, data):
+    tmp = Path(f"{path}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _fsync_dir(path):
+    # Directory fsync is not supported on every filesystem, best effort only
+    with contextlib.suppress(OSError):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def publish_release(tree, source_dir, version, package=PACKAGE_NAME):
+    """Publish the package directory ``tree`` as ``version`` into a local
+    file-based update source. Objects that already exist in the source are not
+    copied again, so publishing a release only adds the files that changed."""
+    source_dir = Path(source_dir)
+    objects = source_dir / OBJECTS_DIR
+    objects.mkdir(parents=True, exist_ok=True)
+    manifest = build_manifest(tree, version, package)
+    for rel, entry in manifest["files"].items():
+        target = objects / entry["sha256"]
+        if not target.exists():
+            shutil.copyfile(Path(tree) / Path(rel).relative_to(package), target)
+    manifest_data = json.dumps(manifest, indent=4, sort_keys=True).encode("utf8")
+    manifest_hash = sha256_bytes(manifest_data)
+    _write_atomic(objects / manifest_hash, manifest_data)
+    latest = {"version": str(version), "manifest": manifest_hash}
+    _write_atomic(source_dir / LATEST_NAME, json.dumps(latest, indent=4).encode("utf8"))
+    return manifest
+
+
+class LocalUpdateSource:
+    """Update source backed by a directory, e.g. a mounted USB stick or a
+    test fixture."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read(self, name):
+        try:
+            with open(self.path / name, "rb") as f:
+                return f.read()
+        except FileNotFoundError as err:
+            raise UpdateError(f"Update source is missing {name}") from err
+
+    def __repr__(self):
+        return f"LocalUpdateSource({str(self.path)!r})"
+
+
+class HttpUpdateSource:
+    """Update source served over HTTP(S) with the same layout as a local
+    source."""
+
+    def __init__(self, base_url, timeout=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def read(self, name):
+        import requests
+
+        try:
+            response = requests.get(f"{self.base_url}/{name}", timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as err:
+            raise UpdateError(f"Could not fetch {name}: {err}") from err
+        return response.content
+
+    def __repr__(self):
+        return f"HttpUpdateSource({self.base_url!r})"
+
+
+def update_source_from_config(location):
+    if location is None or location == "":
+        raise UpdateError("No UPDATE_SOURCE configured in device_config.json")
+    if location.startswith(("http://", "https://")):
+        return HttpUpdateSource(location)
+    return LocalUpdateSource(location)
+
+
+class Updater:
+    """Fetch, verify, stage and activate a release from ``source`` into the
+    release directory ``root``.
+
+    progress: callable(stage: str, done: int, total: int)
+        Called as the update proceeds. Stages are "check", "fetch",
+        "verify" and "switch".
+
+    prepare: callable()
+        Called by update() before the source is checked, on the thread the
+        update runs on. Raises UpdateError to cancel the update.
+    """
+
+    def __init__(self, source, root, progress=None, keep_releases=2, prepare=None):
+        self.source = source
+        self.root = Path(root)
+        self.progress = progress or (lambda stage, done, total: None)
+        self.keep_releases = keep_releases
+        self.prepare = prepare or (lambda: None)
+
+    @property
+    def current_release(self):
+        link = self.root / CURRENT_LINK
+        if not link.is_symlink():
+            return None
+        return self.root / os.readlink(link)
+
+    def current_manifest(self):
+        release = self.current_release
+        if release is None:
+            return {"version": None, "files": {}}
+        with open(release / MANIFEST_NAME) as f:
+            return json.load(f)
+
+    def check(self):
+        """Return the remote release pointer if it differs from the installed
+        release, otherwise None."""
+        self.progress("check", 0, 1)
+        try:
+            latest = json.loads(self.source.read(LATEST_NAME))
+            version, manifest_hash = latest["version"], latest["manifest"]
+        except (ValueError, KeyError) as err:
+            raise UpdateError(f"Malformed {LATEST_NAME} in {self.source}") from err
+        self.progress("check", 1, 1)
+        if version == self.current_manifest()["version"]:
+            return None
+        return {"version": version, "manifest": manifest_hash}
+
+    def update(self):
+        """Install the latest release if there is one. Returns the version that
+        was activated or None when already up to date."""
+        self.prepare()
+        latest = self.check()
+        if latest is None:
+            logging.info("UPD: Already running the latest release.")
+            return None
+        version = latest["version"]
+        manifest_data = self._fetch_object(latest["manifest"])
+        manifest = json.loads(manifest_data)
+        if manifest.get("version") != version:
+            raise UpdateError(
+                f"Manifest version {manifest.get('version')} does not match {version}"
+            )
+        staged = self.stage(manifest, manifest_data)
+        self.activate(staged)
+        self.prune()
+        logging.info(f"UPD: Activated release {version}")
+        return version
+
+    def changed_files(self, manifest):
+        """Relative paths whose content differs from the installed release."""
+        installed = self.current_manifest()["files"]
+        return [
+            rel
+            for rel, entry in manifest["files"].items()
+            if installed.get(rel, {}).get("sha256") != entry["sha256"]
+        ]
+
+    def stage(self, manifest, manifest_data):
+        version = manifest["version"]
+        _check_version_name(version)
+        staging = self.root / STAGING_DIR / version
+        if staging.exists():
+            shutil.rmtree(staging)
+        staging.mkdir(parents=True)
+        current = self.current_release
+        changed = set(self.changed_files(manifest))
+        files = manifest["files"]
+
+        done = 0
+        self.progress("fetch", done, len(changed))
+        for rel, entry in files.items():
+            target = staging / _safe_relpath(rel)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            mode = entry.get("mode", 0o644)
+            if rel in changed:
+                data = self._fetch_object(entry["sha256"])
+                with open(target, "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                done += 1
+                self.progress("fetch", done, len(changed))
+            elif os.stat(current / rel).st_mode & 0o777 == mode:
+                # A hard link shares its mode with the installed release, it
+                # is only taken when the mode is the same already
+                try:
+                    os.link(current / rel, target)
+                    continue
+                except OSError:
+                    shutil.copyfile(current / rel, target)
+            else:
+                shutil.copyfile(current / rel, target)
+            os.chmod(target, mode)
+
+        self.verify(staging, manifest)
+        _write_atomic(staging / MANIFEST_NAME, manifest_data)
+        _fsync_dir(staging)
+        return staging
+
+    def verify(self, tree, manifest):
+        """Check every file of a staged tree against the manifest."""
+        files = manifest["files"]
+        for n, (rel, entry) in enumerate(files.items(), start=1):
+            digest = sha256_file(Path(tree) / rel)
+            if digest != entry["sha256"]:
+                raise UpdateError(f"Verification failed for {rel}")
+            self.progress("verify", n, len(files))
+
+    def activate(self, staged):
+        """Move a staged release into place and atomically repoint
+        ``current`` at it."""
+        releases = self.root / RELEASES_DIR
+        releases.mkdir(parents=True, exist_ok=True)
+        release = releases / staged.name
+        if release.exists():
+            # Only reachable when a previous attempt died after the rename
+            # but before the link swap, the staged copy is verified and wins.
+            shutil.rmtree(release)
+        os.rename(staged, release)
+        _fsync_dir(releases)
+
+        self.progress("switch", 0, 1)
+        tmp_link = self.root / f"{CURRENT_LINK}.tmp"
+        if tmp_link.is_symlink() or tmp_link.exists():
+            tmp_link.unlink()
+        os.symlink(Path(RELEASES_DIR) / staged.name, tmp_link)
+        os.replace(tmp_link, self.root / CURRENT_LINK)
+        _fsync_dir(self.root)
+        self.progress("switch", 1, 1)
+
+    def prune(self):
+        """Remove leftover staging trees and all but the newest releases."""
+        shutil.rmtree(self.root / STAGING_DIR, ignore_errors=True)
+        releases = self.root / RELEASES_DIR
+        current = self.current_release
+        candidates = sorted(
+            (p for p in releases.iterdir() if p.is_dir()),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+        for old in candidates[self.keep_releases :]:
+            if current is not None and old.resolve() == current.resolve():
+                continue
+            shutil.rmtree(old, ignore_errors=True)
+
+    def _fetch_object(self, digest):
+        data = self.source.read(f"{OBJECTS_DIR}/{digest}")
+        if sha256_bytes(data) != digest:
+            raise UpdateError(f"Object {digest} is corrupt")
+        return data
+
+
+def _safe_relpath(rel):
+    path = Path(rel)
+    if path.is_absolute() or ".." in path.parts:
+        raise UpdateError(f"Refusing to install file outside of release: {rel}")
+    return path
+
+
+def _check_version_name(version):
+    if not version or "/" in version or version in (".", ".."):
+        raise UpdateError(f"Invalid release version: {version!r}")
+
+
+class UpdateThread(threading.Thread):
+    """Run an ``Updater`` in the background.
+
+    on_progress(stage, done, total) and on_done(version, error) are called from
+    the update thread; GUI callers must marshal them back to the main loop.
+    """
+
+    def __init__(self, updater, on_progress=None, on_done=None):
+        super().__init__(name="cd-alpha-updater", daemon=True)
+        self.updater = updater
+        if on_progress is not None:
+            updater.progress = on_progress
+        self.on_done = on_done or (lambda version, error: None)
+
+    def run(self):
+        try:
+            version = self.updater.update()
+        except Exception as err:
+            logging.error(f"UPD: Update failed: {err}")
+            self.on_done(None, err)
+        else:
+            self.on_done(version, None)
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+"""
+Dry-run every protocol of the library against simulated hardware.
+
+Every protocol file is run by a ProtocolExecutor on the simulated pump
+network and limit switches in simulated time, spread over a process pool
+with one worker per core. The report lists per protocol whether it ran to
+the end, its simulated duration, the volume moved by each pump and how long
+the dry run took.
+
+Run with:
+
+    chip-validate [path ...] [--archive] [--json report.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pkg_resources import resource_filename
+
+from cd_alpha.ProtocolExecutor import (
+    ExecutorState,
+    ProtocolExecutor,
+    VirtualClock,
+    load_protocol,
+)
+from cd_alpha.protocols.protocol_tools import format_duration
+from cd_alpha.software_testing.SimulatedHardware import (
+    SimulatedNano,
+    SimulatedPumpNetwork,
+)
+
+PUMP_ADDR = {"waste": 1, "lysate": 2}
+TARGETS = {addr: target for target, addr in PUMP_ADDR.items()}
+
+
+def validate_protocol(path):
+    """Dry-run a single protocol file and return its result as a dict."""
+    started = time.perf_counter()
+    result = {"path": str(path), "passed": False, "error": None}
+    clock = VirtualClock()
+    pumps = SimulatedPumpNetwork(clock)
+    try:
+        protocol = load_protocol(path, pump_addr=PUMP_ADDR)
+        executor = ProtocolExecutor(
+            protocol,
+            pumps,
+            SimulatedNano(pumps),
+            clock=clock,
+            sleep=clock.sleep,
+        )
+        state = executor.run()
+        result["passed"] = state == ExecutorState.FINISHED
+        result["error"] = executor.error
+        result["steps"] = len(protocol)
+    except Exception as err:
+        result["error"] = f"{type(err).__name__}: {err}"
+    result["simulated_s"] = clock()
+    result["volumes_ml"] = {
+        TARGETS[addr]: volumes for addr, volumes in pumps.volumes().items()
+    }
+    result["pump_commands"] = pumps.commands
+    result["wall_s"] = time.perf_counter() - started
+    return result
+
+
+def find_protocols(paths, archive=False):
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(path.glob("*.json")))
+            if archive:
+                files.extend(sorted((path / "ARCHIVE").glob("*.json")))
+        else:
+            files.append(path)
+    return files
+
+
+def validate_all(files, workers=None):
+    """Validate ``files`` on a process pool, results keep the file order."""
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return list(pool.map(validate_protocol, files))
+
+
+def print_report(results, wall_s):
+    print(
+        f"{'protocol':<40}{'result':>8}{'duration':>11}"
+        f"{'waste ml':>10}{'lysate ml':>11}{'dry run':>9}"
+    )
+    for r in results:
+        duration = format_duration(r["simulated_s"])
+        moved = {
+            target: r["volumes_ml"].get(target, {}).get("infused_ml", 0.0)
+            + r["volumes_ml"].get(target, {}).get("withdrawn_ml", 0.0)
+            for target in PUMP_ADDR
+        }
+        print(
+            f"{Path(r['path']).name:<40}{'PASS' if r['passed'] else 'FAIL':>8}"
+            f"{duration:>11}{moved['waste']:>10.2f}{moved['lysate']:>11.2f}"
+            f"{r['wall_s'] * 1000:>7.0f}ms"
+        )
+        if not r["passed"]:
+            print(f"    {r['error']}")
+    failed = sum(not r["passed"] for r in results)
+    print(f"{len(results)} protocols, {failed} failed, checked in {wall_s:.2f} s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dry-run the protocol library.")
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=[resource_filename("cd_alpha", "protocols/")],
+        help="protocol files or directories (default: the shipped protocols)",
+    )
+    parser.add_argument("--archive", action="store_true", help="include ARCHIVE/")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--json", default=None, help="write the results to a file")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    results = validate_all(find_protocols(args.paths, args.archive), args.workers)
+    wall_s = time.perf_counter() - started
+    print_report(results, wall_s)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+    return 0 if all(r["passed"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+"""
+Benchmark of what logging costs the thread that logs.
+
+The same pump command traffic (a send and a response record per command,
+the values passed as arguments) is logged at DEBUG in three setups:
+
+sync
+    A plain logging.FileHandler, formatting and writing on the caller.
+
+sync-fstring
+    The same handler with the messages built as f-strings, as the pump code
+    did before the pipeline.
+
+pipeline
+    The LogPipeline: the caller only queues the record, the writer thread
+    formats and writes in batches.
+
+For each the time per record on the calling thread is reported, with the
+percentiles of single calls, and the time until everything is on disk. On a
+single core the writer thread still preempts the caller now and then, which
+shows in the max column rather than in the per record cost.
+
+Run with: python3 -m cd_alpha.benchmarks.logging_overhead
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from cd_alpha.LogPipeline import LogPipeline, LogSink, LOG_FORMAT
+
+LOGGER = "cd_alpha.benchmark.pumps"
+
+
+def _traffic(log, commands, fstring):
+    """Log ``commands`` pump commands, return the duration of every call."""
+    calls = []
+    for n in range(commands):
+        addr, cmd, response = n % 2 + 1, f"RAT{n % 50:.2f}MH", f"0{n % 2 + 1}S"
+        start = time.perf_counter()
+        if fstring:
+            log.debug(f"NEP: Sending comand: {addr}{cmd}")
+        else:
+            log.debug("NEP: Sending comand: %s%s", addr, cmd)
+        calls.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        if fstring:
+            log.debug(f"NEP: Got response: {response}")
+        else:
+            log.debug("NEP: Got response: %s", response)
+        calls.append(time.perf_counter() - start)
+    return calls
+
+
+def _logger():
+    log = logging.getLogger(LOGGER)
+    log.handlers.clear()
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    return log
+
+
+def measure_sync(path, commands, fstring):
+    log = _logger()
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log.addHandler(handler)
+    start = time.perf_counter()
+    calls = _traffic(log, commands, fstring)
+    caller = time.perf_counter() - start
+    handler.close()
+    log.removeHandler(handler)
+    return calls, caller, time.perf_counter() - start
+
+
+def measure_pipeline(path, commands):
+    log = _logger()
+    pipeline = LogPipeline(
+        sinks=[LogSink(open(path, "a", buffering=64 * 1024), owned=True)],
+        rate_limits={},
+        queue_size=4 * commands,
+    ).start(LOGGER)
+    start = time.perf_counter()
+    calls = _traffic(log, commands, fstring=False)
+    caller = time.perf_counter() - start
+    pipeline.stop()
+    return calls, caller, time.perf_counter() - start
+
+
+def summary(calls, caller, total):
+    calls = sorted(calls)
+    return {
+        "records": len(calls),
+        "per_record_us": caller / len(calls) * 1e6,
+        "median_us": statistics.median(calls) * 1e6,
+        "p99_us": calls[int(len(calls) * 0.99)] * 1e6,
+        "max_us": calls[-1] * 1e6,
+        "total_s": total,
+    }
+
+
+def run(commands=20000, directory=None):
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        return {
+            "sync": summary(*measure_sync(os.path.join(tmp, "sync.log"), commands, False)),
+            "sync-fstring": summary(
+                *measure_sync(os.path.join(tmp, "fstring.log"), commands, True)
+            ),
+            "pipeline": summary(
+                *measure_pipeline(os.path.join(tmp, "pipeline.log"), commands)
+            ),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--commands", type=int, default=20000)
+    parser.add_argument(
+        "--dir", default=None, help="write the logs here, e.g. on the SD card"
+    )
+    args = parser.parse_args()
+    result = run(args.commands, args.dir)
+    print(f"{args.commands * 2} DEBUG records per setup")
+    print(
+        f"{'setup':<14}{'per rec (us)':>14}{'median':>10}{'p99':>10}"
+        f"{'max':>10}{'on disk (s)':>13}"
+    )
+    for setup, r in result.items():
+        print(
+            f"{setup:<14}{r['per_record_us']:>14.2f}{r['median_us']:>10.2f}"
+            f"{r['p99_us']:>10.2f}{r['max_us']:>10.0f}{r['total_s']:>13.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
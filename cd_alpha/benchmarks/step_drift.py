@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+"""
+Benchmark of how far timed PUMP/INCUBATE steps end from their planned length.
+
+Two models are compared on the same simulated frame sequence, 60 fps with
+random frame stalls:
+
+legacy
+    The step ends on the first progress bar tick (a Kivy interval event) at
+    which the summed ``dt`` reaches the step length, so it is late by up to
+    one update interval plus any stall.
+
+deadline
+    The end is an absolute monotonic deadline fired by the StepScheduler
+    timing thread, the GUI moves on at the next frame.
+
+The timing thread latency itself is measured in real time with the main
+thread stalling, both sleeping and holding the GIL.
+
+Run with: python3 -m cd_alpha.benchmarks.step_drift
+"""
+
+import argparse
+import random
+import statistics
+import threading
+import time
+
+from cd_alpha.StepScheduler import StepScheduler, ThreadWaker
+
+FRAME_S = 1 / 60
+
+
+def frame_times(duration, stall_probability, max_stall_s, rng):
+    """Start times of the Kivy frames over ``duration`` seconds."""
+    now = 0.0
+    while now <= duration:
+        yield now
+        now += FRAME_S
+        if rng.random() < stall_probability:
+            now += rng.uniform(0, max_stall_s)
+
+
+def legacy_step_end(frames, step_s, interval_s):
+    """End time of a step timed by summing interval event dt values."""
+    last = 0.0
+    elapsed = 0.0
+    for now in frames:
+        if now - last < interval_s:
+            continue
+        elapsed += now - last
+        last = now
+        if elapsed >= step_s:
+            return now
+    raise ValueError("Not enough frames simulated")
+
+
+def deadline_step_end(frames, step_s):
+    """End time of a step ended from an absolute deadline."""
+    for now in frames:
+        if now >= step_s:
+            return now
+    raise ValueError("Not enough frames simulated")
+
+
+def simulate(step_s, runs, stall_probability, max_stall_s, interval_s, seed):
+    legacy, deadline = [], []
+    for n in range(runs):
+        rng = random.Random(seed + n)
+        frames = list(
+            frame_times(step_s + 10 * max_stall_s + 5, stall_probability, max_stall_s, rng)
+        )
+        legacy.append(legacy_step_end(frames, step_s, interval_s) - step_s)
+        deadline.append(deadline_step_end(frames, step_s) - step_s)
+    return legacy, deadline
+
+
+def measure_timer_latency(steps, step_s, stall_s):
+    """Fire ``steps`` deadlines from the timing thread while the main thread
+    stalls, return the lateness of every boundary in seconds."""
+    scheduler = StepScheduler()
+    waker = ThreadWaker(scheduler)
+    lateness = []
+    done = threading.Event()
+
+    def boundary(deadline, dt):
+        lateness.append(time.monotonic() - deadline)
+        if len(lateness) == steps:
+            done.set()
+
+    for n in range(steps):
+        deadline = time.monotonic() + step_s * (n + 1)
+        scheduler.call_at(deadline, lambda dt, d=deadline: boundary(d, dt))
+
+    busy = False
+    while not done.wait(0):
+        # Alternate a sleeping stall and a GIL holding stall
+        end = time.monotonic() + stall_s
+        if busy:
+            while time.monotonic() < end:
+                pass
+        else:
+            time.sleep(stall_s)
+        busy = not busy
+    waker.stop()
+    return lateness
+
+
+def summary(values):
+    values = [abs(v) for v in values]
+    return {
+        "mean_s": statistics.mean(values),
+        "max_s": max(values),
+        "stdev_s": statistics.pstdev(values),
+    }
+
+
+def run(step_s=3600, runs=20, stall_probability=0.002, max_stall_s=2.0,
+        interval_s=0.5, seed=0, timer_steps=20):
+    legacy, deadline = simulate(
+        step_s, runs, stall_probability, max_stall_s, interval_s, seed
+    )
+    latency = measure_timer_latency(timer_steps, 0.05, 0.03)
+    return {
+        "step_s": step_s,
+        "runs": runs,
+        "legacy": summary(legacy),
+        "deadline": summary(deadline),
+        "timer_thread": summary(latency),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--step", type=float, default=3600, help="step length in s")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--stall-probability", type=float, default=0.002)
+    parser.add_argument("--max-stall", type=float, default=2.0, help="in s")
+    args = parser.parse_args()
+    result = run(args.step, args.runs, args.stall_probability, args.max_stall)
+    print(f"Step length {result['step_s']:.0f} s, {result['runs']} simulated runs")
+    print(f"{'model':<14}{'mean (ms)':>12}{'max (ms)':>12}{'stdev (ms)':>12}")
+    for model in ("legacy", "deadline", "timer_thread"):
+        r = result[model]
+        print(
+            f"{model:<14}{r['mean_s'] * 1000:>12.1f}"
+            f"{r['max_s'] * 1000:>12.1f}{r['stdev_s'] * 1000:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
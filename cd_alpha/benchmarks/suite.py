@@ -0,0 +1,463 @@
+#!/usr/bin/python3
+
+"""
+Benchmark suite of the hot spots of the app, compared against a baseline.
+
+protocol_parse
+    json.loads of every shipped protocol.
+
+load_protocol
+    ProcessWindow.load_protocol of every shipped protocol, its time and the
+    peak of the Python memory it allocates.
+
+summary_screen
+    Building the SummaryScreen of the newest shipped protocol.
+
+serial
+    PumpNetwork status commands per second to the PumpEmulator, through
+    pyserial like on the device. Only the host side is measured, the
+    emulator answers right away instead of at the baud rate.
+
+i2c_poll
+    Nano.update reading from a pipe, the host side of one limit switch poll.
+
+step_transition
+    From next_step until the next screen is entered, over every step of the
+    newest shipped protocol, in the headless app.
+
+readout
+    A Label and a DigitLabel counting down like the timer of a step, one new
+    value per frame: the frame time, the textures created and the texts
+    rasterised. No window draws in the headless app, its GL is a software
+    mock, the textures are bound after each frame like a draw would.
+
+Times of a repeated call are the fastest of the repeats, times of many
+different updates their median, and every result is the best of a few
+rounds of the whole suite. The results are written as json with the machine
+they were measured on and whether the run was a quick one, every result with
+the time of a reference loop of plain Python run right before and after its
+benchmark, and compared against baseline.json next to this file,
+baseline-quick.json for a --quick run. A result worse than its baseline by
+more than its tolerance is a regression and fails the run, the results in
+TOLERANCES are allowed more:
+
+    python3 -m cd_alpha.benchmarks.suite --output results.json
+    python3 -m cd_alpha.benchmarks.suite --update-baseline
+
+Timings are compared relative to their reference loop time, so a host that
+is slower or busier than the one the baseline was measured on is not
+reported as a regression. Quick runs count fewer updates and repeat less,
+they are only compared against a quick baseline.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Sets up Kivy without a window, before anything imports it
+from cd_alpha.software_testing.HeadlessApp import HeadlessApp
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+PROTOCOL_DIR = PACKAGE_DIR / "protocols"
+BASELINE_PATH = Path(__file__).resolve().parent / "baseline.json"
+QUICK_BASELINE_PATH = BASELINE_PATH.with_name("baseline-quick.json")
+DEFAULT_TOLERANCE = 0.4
+# Results that still vary up to twice between runs on a busy host, the
+# shortest calls, the ones that allocate enough to trigger the collector and
+# the slowest frames
+TOLERANCES = {
+    "protocol_parse.*": 1.0,
+    "readout.*.frame": 0.9,
+    "load_protocol.*.time": 1.0,
+    "step_transition.p90": 0.6,
+}
+ROUNDS = 3
+# Units of the results scaled by the reference loop
+TIMED_UNITS = ("ms", "us", "cmd/s")
+
+
+def shipped_protocols():
+    return sorted(PROTOCOL_DIR.glob("v0-protocol-*.json"))
+
+
+def best_time(func, repeats):
+    """Seconds of the fastest of ``repeats`` calls of func, the other work
+    of the host only ever makes a call slower."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def result(value, unit, better="lower"):
+    return {"value": value, "unit": unit, "better": better}
+
+
+def reference_loop(size=20000):
+    """Plain Python work the speed of the host is measured with."""
+    table = {}
+    for n in range(size):
+        table[str(n)] = n * n
+    return sum(len(key) for key in table if table[key] % 3)
+
+
+# ---- benchmarks, each returns {name: result} ---- #
+
+
+def bench_protocol_parse(repeats=200):
+    results = {}
+    for path in shipped_protocols():
+        text = path.read_text()
+        seconds = best_time(lambda: json.loads(text), repeats)
+        results[f"protocol_parse.{path.stem}"] = result(seconds * 1e3, "ms")
+    return results
+
+
+def bench_load_protocol(app, repeats=10):
+    results = {}
+    for path in shipped_protocols():
+        # The first load fills the compile cache, like the first boot
+        app.root.load_protocol(path)
+        seconds = best_time(lambda: app.root.load_protocol(path), repeats)
+        tracemalloc.start()
+        app.root.load_protocol(path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[f"load_protocol.{path.stem}.time"] = result(seconds * 1e3, "ms")
+        results[f"load_protocol.{path.stem}.peak_memory"] = result(peak / 1024, "KiB")
+    return results
+
+
+def bench_summary_screen(app, repeats=10):
+    descriptor = next(
+        d for d in app.screen_manager.descriptors.values() if d.kind == "summary"
+    )
+    screens = []
+    seconds = best_time(
+        lambda: screens.append(app.root.build_screen(descriptor)), repeats
+    )
+    # The table is filled in on a later frame, not in the next benchmark
+    for screen in screens:
+        screen.table_thread.join()
+    app.frame()
+    return {"summary_screen.build": result(seconds * 1e3, "ms")}
+
+
+def bench_serial(commands=2000):
+    import serial
+
+    from cd_alpha.NewEraPumps import PumpNetwork
+    from cd_alpha.software_testing.PumpEmulator import PumpEmulator
+
+    pump = PumpEmulator(byte_time=0, turnaround=0).start()
+    ser = serial.Serial(pump.path, 19200, timeout=2)
+    try:
+        pumps = PumpNetwork(ser)
+        pumps.status(1)
+        start = time.perf_counter()
+        for n in range(commands):
+            pumps.status(n % 2 + 1)
+        seconds = time.perf_counter() - start
+    finally:
+        ser.close()
+        pump.close()
+    return {
+        "serial.status_commands": result(commands / seconds, "cmd/s", better="higher")
+    }
+
+
+def bench_i2c_poll(polls=20000):
+    from cd_alpha.NanoController import Nano
+
+    read_fd, write_fd = os.pipe()
+    nano = Nano.__new__(Nano)
+    nano._fr = os.fdopen(read_fd, "rb", buffering=0)
+    nano._fw = os.fdopen(write_fd, "wb", buffering=0)
+    try:
+        times = []
+        # A pipe holds 64 KiB, refill it in chunks
+        for chunk in range(0, polls, 4096):
+            count = min(4096, polls - chunk)
+            nano._write(b"\xa0" * count)
+            for _ in range(count):
+                start = time.perf_counter()
+                nano.update()
+                times.append(time.perf_counter() - start)
+    finally:
+        nano.close()
+    return {"i2c_poll.update": result(statistics.median(times) * 1e6, "us")}
+
+
+def bench_step_transition(app):
+    sequence = app.screen_manager.sequence
+    times = []
+    app.root.process_sm.show(sequence[0])
+    app.frame()
+    for _ in sequence[1:]:
+        start = time.perf_counter()
+        app.root.next_step()
+        # The screen is entered on the next frame
+        app.frame()
+        times.append(time.perf_counter() - start)
+    app.root.abort()
+    return {
+        "step_transition.median": result(statistics.median(times) * 1e3, "ms"),
+        "step_transition.p90": result(
+            sorted(times)[int(len(times) * 0.9)] * 1e3, "ms"
+        ),
+    }
+
+
+def drawn_textures(widget):
+    """The text texture of a Label, the glyphs of a DigitLabel."""
+    from kivy.graphics import Rectangle
+
+    if getattr(widget, "texture", None) is not None:
+        return [widget.texture]
+    return [i.texture for i in widget.canvas.children if isinstance(i, Rectangle)]
+
+
+def bench_readout(app, updates=600):
+    import kivy.core.text as core_text
+    from kivy.uix.label import Label
+
+    from cd_alpha.GlyphAtlas import DigitLabel
+
+    counts = {"textures": 0, "rasterised": 0}
+    texture_class, texture_fill = core_text.Texture, core_text.LabelBase._texture_fill
+
+    class CountingTexture:
+        @staticmethod
+        def create(*args, **kwargs):
+            counts["textures"] += 1
+            return texture_class.create(*args, **kwargs)
+
+    def counting_fill(label, texture):
+        counts["rasterised"] += 1
+        texture_fill(label, texture)
+
+    core_text.Texture = CountingTexture
+    core_text.LabelBase._texture_fill = counting_fill
+    results = {}
+    try:
+        for name, widget_class in (("label", Label), ("digit_label", DigitLabel)):
+            widget = widget_class(text="10:00", size=(300, 100))
+            app.frame()
+            counts.update(textures=0, rasterised=0)
+            times = []
+            for n in range(updates):
+                start = time.perf_counter()
+                widget.text = "{:02d}:{:02d}".format(*divmod(updates - n, 60))
+                app.frame()
+                for texture in drawn_textures(widget):
+                    texture.bind()
+                times.append(time.perf_counter() - start)
+            results[f"readout.{name}.frame"] = result(
+                statistics.median(times) * 1e3, "ms"
+            )
+            results[f"readout.{name}.textures_created"] = result(
+                counts["textures"], "count"
+            )
+            results[f"readout.{name}.rasterised"] = result(counts["rasterised"], "count")
+    finally:
+        core_text.Texture = texture_class
+        core_text.LabelBase._texture_fill = texture_fill
+    return results
+
+
+# ---- running and comparing ---- #
+
+
+def machine():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PACKAGE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+def referenced(repeats, bench, *args):
+    """Results of bench(*args) with the time of the reference loop run right
+    before and after it, the faster of the two."""
+    before = best_time(reference_loop, repeats)
+    results = bench(*args)
+    reference_ms = min(before, best_time(reference_loop, repeats)) * 1e3
+    for r in results.values():
+        r["reference_ms"] = reference_ms
+    return results
+
+
+def relative(r):
+    """A result in units of its reference loop time, timings only."""
+    if r["unit"] not in TIMED_UNITS:
+        return r["value"]
+    if r["better"] == "lower":
+        return r["value"] / r["reference_ms"]
+    return r["value"] * r["reference_ms"]
+
+
+def run_round(quick):
+    repeats = 3 if quick else 10
+    results = {}
+    results.update(referenced(repeats, bench_protocol_parse, 20 if quick else 200))
+    results.update(referenced(repeats, bench_serial, 200 if quick else 2000))
+    results.update(referenced(repeats, bench_i2c_poll, 2000 if quick else 20000))
+    app = HeadlessApp(shipped_protocols()[-1])
+    try:
+        results.update(referenced(repeats, bench_summary_screen, app, repeats))
+        results.update(referenced(repeats, bench_step_transition, app))
+        results.update(referenced(repeats, bench_readout, app, 100 if quick else 600))
+        results.update(referenced(repeats, bench_load_protocol, app, repeats))
+    finally:
+        app.close()
+    return results
+
+
+def run(quick=False, rounds=ROUNDS):
+    """The best of ``rounds`` runs of every benchmark, the other work of the
+    host slows down a few of them in each run. Every round runs in a process
+    of its own, the frames of a headless app get slower with every app the
+    process ran before."""
+    results = {}
+    for _ in range(rounds):
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            round_results = pool.submit(run_round, quick).result()
+        for name, now in round_results.items():
+            best = results.get(name)
+            if best is None:
+                results[name] = now
+            elif now["better"] == "lower" and relative(now) < relative(best):
+                results[name] = now
+            elif now["better"] == "higher" and relative(now) > relative(best):
+                results[name] = now
+    return {"machine": machine(), "quick": quick, "rounds": rounds, "results": results}
+
+
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE, tolerances=TOLERANCES):
+    """Results worse than the baseline by more than their tolerance, as
+    (name, baseline value, current value) tuples. Timings are compared
+    relative to their reference loop time, the current value is scaled to
+    the one of the baseline. Raises ValueError for results of another mode."""
+    if current.get("quick", False) != baseline.get("quick", False):
+        modes = ["full", "quick"]
+        raise ValueError(
+            f"A {modes[current.get('quick', False)]} run cannot be compared "
+            f"against a {modes[baseline.get('quick', False)]} baseline"
+        )
+    regressions = []
+    for name, base in baseline["results"].items():
+        now = current["results"].get(name)
+        if now is None:
+            continue
+        if base["unit"] in TIMED_UNITS and "reference_ms" not in base:
+            raise ValueError("The baseline has no reference loop times, record it again")
+        allowed = next(
+            (t for pattern, t in tolerances.items() if fnmatch.fnmatchcase(name, pattern)),
+            tolerance,
+        )
+        if base["better"] == "lower":
+            worse = relative(now) > relative(base) * (1 + allowed)
+        else:
+            worse = relative(now) < relative(base) * (1 - allowed)
+        if worse:
+            value = base["value"] * relative(now) / relative(base)
+            regressions.append((name, base["value"], value))
+    return regressions
+
+
+def format_results(current, baseline=None):
+    base = baseline["results"] if baseline else {}
+    lines = [f"{'benchmark':<48}{'value':>12}  {'unit':<6}{'baseline':>12}"]
+    for name, r in sorted(current["results"].items()):
+        reference = base.get(name, {}).get("value")
+        reference = f"{reference:>12.3f}" if reference is not None else f"{'-':>12}"
+        lines.append(f"{name:<48}{r['value']:>12.3f}  {r['unit']:<6}{reference}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument(
+        "--baseline", help="baseline json file, the committed one of the mode by default"
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store the results as the new baseline instead of comparing",
+    )
+    parser.add_argument("--quick", action="store_true", help="fewer repeats")
+    parser.add_argument(
+        "--rounds", type=int, default=ROUNDS, help="runs the best result is kept of"
+    )
+    args = parser.parse_args(argv)
+
+    if args.baseline is None:
+        args.baseline = QUICK_BASELINE_PATH if args.quick else BASELINE_PATH
+    current = run(args.quick, args.rounds)
+    if args.output:
+        Path(args.output).write_text(json.dumps(current, indent=4) + "\n")
+    if args.update_baseline:
+        Path(args.baseline).write_text(json.dumps(current, indent=4) + "\n")
+        print(format_results(current))
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    baseline = None
+    if Path(args.baseline).exists():
+        baseline = json.loads(Path(args.baseline).read_text())
+    print(format_results(current, baseline))
+    if baseline is None:
+        print(f"No baseline at {args.baseline}, nothing to compare")
+        return 0
+    for key in ("machine", "processor", "cpu_count"):
+        if baseline["machine"].get(key) != current["machine"][key]:
+            print(
+                f"Warning: baseline measured on another machine "
+                f"({key} {baseline['machine'].get(key)} vs {current['machine'][key]})"
+            )
+    try:
+        regressions = compare(current, baseline, args.tolerance)
+    except ValueError as err:
+        print(err)
+        return 2
+    for name, base, now in regressions:
+        print(f"REGRESSION {name}: {now:.3f} vs baseline {base:.3f}")
+    if regressions:
+        return 1
+    print(
+        f"No regression beyond {args.tolerance:.0%} of the baseline "
+        f"(more for the results in TOLERANCES)"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
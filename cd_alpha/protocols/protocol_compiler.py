@@ -0,0 +1,300 @@
+"""
+Compile protocol files into a validated, immutable representation.
+
+A protocol is parsed and checked once. Steps become StepRecord tuples and
+their actions become ActionRecord tuples, with an Action enum and the pump
+addresses and limit switches already resolved for the device. The result is
+cached on disk under the sha256 of the protocol file, so the GUI and the
+ProtocolExecutor only read JSON when a protocol is new or has changed.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+from enum import Enum
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple
+
+from cd_alpha.protocols.protocol_tools import ProtocolTimeline
+
+# Bump when the records change so stale cache entries are not loaded
+IR_VERSION = 1
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "cd_alpha" / "protocols"
+DEFAULT_PUMP_ADDR = {"waste": 1, "lysate": 2}
+
+HOME_SWITCHES = {"waste": "d2", "lysate": "d3"}
+GRAB_SWITCHES = {"waste": "d4", "lysate": "d5"}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Action(Enum):
+    PUMP = 1
+    INCUBATE = 2
+    RESET = 3
+    RESET_WASTE = 4
+    GRAB = 5
+    GRAB_WASTE = 6
+    RELEASE = 7
+    CHANGE_SYRINGE = 8
+
+
+class StepKind(Enum):
+    HOME = 1
+    SUMMARY = 2
+    USER = 3
+    MACHINE = 4
+
+
+class ActionRecord(NamedTuple):
+    action: Action
+    # Pumps the action drives and, for RESET and GRAB, the switch of each
+    addrs: Tuple[int, ...] = ()
+    switches: Tuple[str, ...] = ()
+    # ml/h for PUMP and RELEASE, ml/min for the GRAB post run
+    rate: float = 0.0
+    vol_ml: float = 0.0
+    # eq_time of PUMP and RELEASE, time of INCUBATE
+    time_s: float = 0.0
+    diameter_mm: float = 0.0
+    # Length of PUMP and INCUBATE, 0 for actions that end on a switch
+    duration: float = 0.0
+
+    @property
+    def addr(self):
+        return self.addrs[0]
+
+
+class StepRecord(NamedTuple):
+    name: str
+    kind: StepKind
+    header: str = ""
+    description: str = ""
+    next_text: str = "Next"
+    completion_msg: Optional[str] = None
+    remove_progress_bar: bool = False
+    actions: Tuple[ActionRecord, ...] = ()
+
+
+class CompiledProtocol:
+    """
+    steps: tuple
+        - StepRecord per step, in protocol order
+    pump_addr: dict
+        - pump address per target the records were resolved with
+    source_hash: str
+        - sha256 of the protocol file
+    timeline: ProtocolTimeline
+        - planned timing and volumes of the steps
+    """
+
+    __slots__ = ("steps", "pump_addr", "source_hash", "timeline", "_index")
+
+    def __init__(self, steps, pump_addr, source_hash, timeline):
+        self.steps = tuple(steps)
+        self.pump_addr = dict(pump_addr)
+        self.source_hash = source_hash
+        self.timeline = timeline
+        self._index = {step.name: i for i, step in enumerate(self.steps)}
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __getitem__(self, name):
+        return self.steps[self._index[name]]
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    @property
+    def names(self):
+        return [step.name for step in self.steps]
+
+    def start_at(self, step_name):
+        """The protocol without the steps before ``step_name``."""
+        if step_name not in self._index:
+            raise KeyError(f"{step_name} not a valid step in the protocol.")
+        first = self._index[step_name]
+        if first == 0:
+            return self
+        return CompiledProtocol(
+            self.steps[first:],
+            self.pump_addr,
+            self.source_hash,
+            self.timeline.from_step(step_name),
+        )
+
+
+def _resolve(target, pump_addr):
+    try:
+        return pump_addr[target]
+    except KeyError as err:
+        raise ProtocolError(f"Unknown pump target {target}") from err
+
+
+def _compile_action(kind, params, pump_addr):
+    try:
+        action = Action[kind]
+    except KeyError as err:
+        raise ProtocolError(f"Unknown action {kind}") from err
+
+    if action in (Action.PUMP, Action.RELEASE):
+        rate_mh = float(params["rate_mh"])
+        vol_ml = float(params["vol_ml"])
+        eq_time = float(params.get("eq_time", 0))
+        if rate_mh == 0:
+            raise ProtocolError(f"{kind} with a flow rate of 0")
+        return ActionRecord(
+            action,
+            addrs=(_resolve(params["target"], pump_addr),),
+            rate=rate_mh,
+            vol_ml=vol_ml,
+            time_s=eq_time,
+            duration=abs(vol_ml / rate_mh) * 3600 + eq_time,
+        )
+    if action == Action.INCUBATE:
+        seconds = float(params["time"])
+        return ActionRecord(action, time_s=seconds, duration=seconds)
+    if action == Action.CHANGE_SYRINGE:
+        return ActionRecord(
+            action,
+            addrs=(int(params["pump_addr"]),),
+            diameter_mm=float(params["diam"]),
+        )
+
+    # Homing and grabbing every pump the device has, or only the waste one
+    if action in (Action.RESET_WASTE, Action.GRAB_WASTE):
+        targets = ["waste"]
+    else:
+        targets = [t for t in ("waste", "lysate") if t in pump_addr]
+    if action in (Action.RESET, Action.RESET_WASTE):
+        return ActionRecord(
+            action,
+            addrs=tuple(pump_addr[t] for t in targets),
+            switches=tuple(HOME_SWITCHES[t] for t in targets),
+        )
+    return ActionRecord(
+        action,
+        addrs=tuple(pump_addr[t] for t in targets),
+        switches=tuple(GRAB_SWITCHES[t] for t in targets),
+        rate=float(params["post_run_rate_mm"]),
+        vol_ml=float(params["post_run_vol_ml"]),
+    )
+
+
+def _compile_step(name, step, pump_addr):
+    screen_type = step.get("type", None)
+    if screen_type == "UserActionScreen":
+        if name == "home":
+            kind = StepKind.HOME
+        elif name == "summary":
+            kind = StepKind.SUMMARY
+        else:
+            kind = StepKind.USER
+        actions = ()
+    elif screen_type == "MachineActionScreen":
+        kind = StepKind.MACHINE
+        for required in ("header", "action"):
+            if required not in step:
+                raise KeyError(
+                    f"Corrupt protocol. Step {name} is missing '{required}'."
+                )
+        actions = tuple(
+            _compile_action(action, params, pump_addr)
+            for action, params in step["action"].items()
+        )
+    elif screen_type is None:
+        raise TypeError(
+            "Corrupt protocol. Every protocol step must contain a 'type' key."
+        )
+    else:
+        raise TypeError(f"Corrupt protocol. Unrecognized 'type' key: {screen_type}")
+
+    return StepRecord(
+        name,
+        kind,
+        header=step.get("header", "NO HEADER"),
+        description=step.get(
+            "description", "" if kind == StepKind.MACHINE else "NO DESCRIPTION"
+        ),
+        next_text=step.get("next_text", "Next"),
+        completion_msg=step.get("completion_msg", None) or None,
+        remove_progress_bar=bool(step.get("remove_progress_bar", False)),
+        actions=actions,
+    )
+
+
+def compile_protocol(protocol, pump_addr=DEFAULT_PUMP_ADDR, source_hash=None):
+    """Validate a parsed protocol and compile it, raises on the first error."""
+    steps = [_compile_step(name, step, pump_addr) for name, step in protocol.items()]
+    if not steps:
+        raise ProtocolError("Protocol has no steps")
+    try:
+        timeline = ProtocolTimeline.from_protocol(protocol)
+    except ValueError as err:
+        raise ProtocolError(str(err)) from err
+    return CompiledProtocol(steps, pump_addr, source_hash, timeline)
+
+
+def cache_path(cache_dir, source_hash, pump_addr):
+    # The records depend on the pump addresses as well as on the file
+    config = json.dumps([IR_VERSION, sorted(pump_addr.items())]).encode()
+    config_hash = hashlib.sha256(config).hexdigest()[:16]
+    return Path(cache_dir) / f"{source_hash}-{config_hash}.pickle"
+
+
+def compile_file(path, pump_addr=DEFAULT_PUMP_ADDR, cache_dir=None):
+    """Compile a protocol file, reusing the cached result for identical
+    files when ``cache_dir`` is given."""
+    with open(path, "rb") as f:
+        data = f.read()
+    source_hash = hashlib.sha256(data).hexdigest()
+
+    cached = None
+    if cache_dir is not None:
+        cached = cache_path(cache_dir, source_hash, pump_addr)
+        try:
+            with open(cached, "rb") as f:
+                compiled = pickle.load(f)
+            if compiled.source_hash == source_hash:
+                return compiled
+        except Exception:
+            # Missing, stale or unreadable entries are simply rebuilt
+            pass
+
+    protocol = json.loads(data, object_pairs_hook=OrderedDict)
+    compiled = compile_protocol(protocol, pump_addr, source_hash)
+
+    if cached is not None:
+        tmp = None
+        try:
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            # A file of its own per writer, the app and chip-run or the
+            # validation farm may compile the same protocol at once
+            with tempfile.NamedTemporaryFile(
+                dir=cached.parent, prefix=cached.name, suffix=".tmp", delete=False
+            ) as f:
+                tmp = f.name
+                pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cached)
+        except OSError:
+            if tmp is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+    return compiled
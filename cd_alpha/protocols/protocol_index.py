@@ -0,0 +1,204 @@
+"""
+Persistent index of the protocol library.
+
+Every protocol file is compiled once and its metadata is kept in an SQLite
+database keyed by path, modification time and sha256: name, version, planned
+duration, step count, volume per pump and the validation error, if any.
+``refresh`` only recompiles files whose size or mtime changed and whose
+content hash differs, and drops files that were removed.
+
+IndexThread runs the refresh off the GUI thread and hands plain
+ProtocolEntry tuples back to it.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from cd_alpha.protocols.protocol_compiler import DEFAULT_PUMP_ADDR, compile_protocol
+
+DEFAULT_INDEX_PATH = Path.home() / ".cache" / "cd_alpha" / "protocol_index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS protocols (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    duration_s REAL,
+    step_count INTEGER,
+    waste_ml REAL,
+    lysate_ml REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS protocols_directory ON protocols (directory);
+"""
+
+# e.g. v0-protocol-21v4.json is version 21v4
+VERSION_PATTERN = re.compile(r"(\d+v\d+)$")
+
+
+class ProtocolEntry(NamedTuple):
+    path: str
+    name: str
+    version: str
+    duration_s: Optional[float]
+    step_count: Optional[int]
+    waste_ml: Optional[float]
+    lysate_ml: Optional[float]
+    error: Optional[str]
+
+    @property
+    def valid(self):
+        return self.error is None
+
+
+def describe_protocol(path, data):
+    """Metadata columns of a protocol file from its raw content."""
+    stem = Path(path).stem
+    match = VERSION_PATTERN.search(stem)
+    row = {
+        "name": stem,
+        "version": match.group(1) if match else "",
+        "duration_s": None,
+        "step_count": None,
+        "waste_ml": None,
+        "lysate_ml": None,
+        "error": None,
+    }
+    try:
+        protocol = json.loads(data, object_pairs_hook=OrderedDict)
+        compiled = compile_protocol(protocol, DEFAULT_PUMP_ADDR)
+    except Exception as err:
+        row["error"] = f"{type(err).__name__}: {err}"
+        return row
+    volumes = compiled.timeline.volume_totals()
+    row.update(
+        duration_s=compiled.timeline.total,
+        step_count=len(compiled),
+        waste_ml=volumes["waste"],
+        lysate_ml=volumes["lysate"],
+    )
+    return row
+
+
+class ProtocolIndex:
+    """SQLite index of protocol files. A connection belongs to the thread
+    that opened the index, use one ProtocolIndex per thread."""
+
+    def __init__(self, db_path=DEFAULT_INDEX_PATH):
+        self.db_path = Path(db_path)
+        if str(db_path) != ":memory:":
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(db_path))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, directory, pattern="*.json"):
+        """Bring the index of ``directory`` up to date, returns the paths
+        that were (re)compiled and the ones that were removed."""
+        directory = str(Path(directory).resolve())
+        known = {
+            path: (mtime_ns, size, sha256)
+            for path, mtime_ns, size, sha256 in self.db.execute(
+                "SELECT path, mtime_ns, size, sha256 FROM protocols WHERE directory = ?",
+                (directory,),
+            )
+        }
+        changed, seen = [], set()
+        with self.db:
+            for protocol_file in sorted(Path(directory).glob(pattern)):
+                path = str(protocol_file)
+                seen.add(path)
+                try:
+                    stat = protocol_file.stat()
+                    previous = known.get(path)
+                    if previous and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+                        continue
+                    data = protocol_file.read_bytes()
+                except OSError as err:
+                    logging.warning(f"IDX: Could not read {path}: {err}")
+                    continue
+                sha256 = hashlib.sha256(data).hexdigest()
+                if previous and previous[2] == sha256:
+                    # Touched but not changed
+                    self.db.execute(
+                        "UPDATE protocols SET mtime_ns = ?, size = ? WHERE path = ?",
+                        (stat.st_mtime_ns, stat.st_size, path),
+                    )
+                    continue
+                row = describe_protocol(path, data)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO protocols VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        path,
+                        directory,
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                        sha256,
+                        row["name"],
+                        row["version"],
+                        row["duration_s"],
+                        row["step_count"],
+                        row["waste_ml"],
+                        row["lysate_ml"],
+                        row["error"],
+                    ),
+                )
+                changed.append(path)
+            removed = sorted(set(known) - seen)
+            self.db.executemany(
+                "DELETE FROM protocols WHERE path = ?", [(path,) for path in removed]
+            )
+        return changed, removed
+
+    def entries(self, directory):
+        """Indexed protocols of ``directory`` sorted by name."""
+        directory = str(Path(directory).resolve())
+        return [
+            ProtocolEntry(*row)
+            for row in self.db.execute(
+                "SELECT path, name, version, duration_s, step_count, waste_ml, "
+                "lysate_ml, error FROM protocols WHERE directory = ? ORDER BY name",
+                (directory,),
+            )
+        ]
+
+
+class IndexThread(threading.Thread):
+    """Report the indexed entries of a directory, refresh the index and
+    report again if anything changed. ``on_entries`` is called from this
+    thread with the list of ProtocolEntry."""
+
+    def __init__(self, directory, on_entries, db_path=DEFAULT_INDEX_PATH):
+        super().__init__(name="ProtocolIndex", daemon=True)
+        self.directory = directory
+        self.on_entries = on_entries
+        self.db_path = db_path
+
+    def run(self):
+        try:
+            index = ProtocolIndex(self.db_path)
+            try:
+                entries = index.entries(self.directory)
+                if entries:
+                    self.on_entries(entries)
+                changed, removed = index.refresh(self.directory)
+                if changed or removed or not entries:
+                    self.on_entries(index.entries(self.directory))
+            finally:
+                index.close()
+        except Exception:
+            logging.exception("IDX: Indexing the protocol library failed")
@@ -1,8 +1,306 @@
 from collections import OrderedDict
 import json
 import sys
-import time
-import calendar
+from pathlib import Path
+
+import numpy as np
+
+# Machine steps that end on a limit switch have no fixed length, these are
+# typical values on a V0 used for the estimate.
+RESET_PURGE_TIME = 1
+RESET_ESTIMATE_S = 30.0
+GRAB_ESTIMATE_S = 10.0
+COMPLETION_MSG_TIME = 1
+
+PUMP_TARGETS = ("waste", "lysate")
+
+# Step kinds, the index is the code stored in ProtocolTimeline.kinds
+STEP_KINDS = (
+    "USER",
+    "PUMP",
+    "INCUBATE",
+    "RESET",
+    "RESET_WASTE",
+    "GRAB",
+    "GRAB_WASTE",
+    "RELEASE",
+    "CHANGE_SYRINGE",
+)
+KIND_CODES = {kind: code for code, kind in enumerate(STEP_KINDS)}
+(
+    USER,
+    PUMP,
+    INCUBATE,
+    RESET,
+    RESET_WASTE,
+    GRAB,
+    GRAB_WASTE,
+    RELEASE,
+    CHANGE_SYRINGE,
+) = range(len(STEP_KINDS))
+SWITCHED = (RESET, RESET_WASTE, GRAB, GRAB_WASTE)
+
+
+def format_duration(seconds):
+    """H:MM:SS, hours are not wrapped at 24."""
+    hours, rest = divmod(int(round(seconds)), 3600)
+    return f"{hours:d}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+class StepColumns:
+    """Raw numbers of a set of protocols as flat columns, one entry per step
+    and one per machine action. This is the only place the JSON is walked."""
+
+    def __init__(self):
+        self.names = []
+        self.headers = []
+        self.protocol_offsets = [0]
+        self.step_completion = []
+        self.action_step = []
+        self.action_kind = []
+        self.action_target = []
+        self.action_vol_ml = []
+        self.action_rate_mh = []
+        self.action_time_s = []
+
+    def add_protocol(self, protocol):
+        # Parse everything first so a broken protocol leaves no partial rows
+        steps, actions = [], []
+        for name, step in protocol.items():
+            steps.append(
+                (
+                    name,
+                    step.get("header", ""),
+                    COMPLETION_MSG_TIME if step.get("completion_msg") else 0,
+                )
+            )
+            index = len(self.names) + len(steps) - 1
+            for kind, params in step.get("action", {}).items():
+                actions.append((index, *self._parse_action(kind, params)))
+        for name, header, completion in steps:
+            self.names.append(name)
+            self.headers.append(header)
+            self.step_completion.append(completion)
+        for index, code, target, vol_ml, rate_mh, time_s in actions:
+            self.action_step.append(index)
+            self.action_kind.append(code)
+            self.action_target.append(target)
+            self.action_vol_ml.append(vol_ml)
+            self.action_rate_mh.append(rate_mh)
+            self.action_time_s.append(time_s)
+        self.protocol_offsets.append(len(self.names))
+
+    @staticmethod
+    def _parse_action(kind, params):
+        if kind not in KIND_CODES or kind == "USER":
+            raise ValueError(f"Unknown action {kind}")
+        code = KIND_CODES[kind]
+        target = -1
+        vol_ml = rate_mh = time_s = 0.0
+        if code in (PUMP, RELEASE):
+            if params["target"] not in PUMP_TARGETS:
+                raise ValueError(f"Unknown pump target {params['target']}")
+            target = PUMP_TARGETS.index(params["target"])
+            vol_ml = params["vol_ml"]
+            rate_mh = params["rate_mh"]
+            time_s = params.get("eq_time", 0)
+        elif code == INCUBATE:
+            time_s = params["time"]
+        elif code in (GRAB, GRAB_WASTE):
+            # Post run after the syringe is detected, the rate is in ml/min
+            vol_ml = params["post_run_vol_ml"]
+            rate_mh = params["post_run_rate_mm"] * 60
+        return code, target, vol_ml, rate_mh, time_s
+
+
+def compute_timelines(columns):
+    """Step lengths, start and end times and pump volumes of every protocol
+    in ``columns`` at once. Returns one ProtocolTimeline per protocol."""
+    n_steps = len(columns.names)
+    step = np.asarray(columns.action_step, dtype=np.intp)
+    kind = np.asarray(columns.action_kind, dtype=np.int8)
+    target = np.asarray(columns.action_target, dtype=np.intp)
+    vol_ml = np.asarray(columns.action_vol_ml, dtype=np.float64)
+    rate_mh = np.asarray(columns.action_rate_mh, dtype=np.float64)
+    time_s = np.asarray(columns.action_time_s, dtype=np.float64)
+
+    moving = np.isin(kind, (PUMP, RELEASE, GRAB, GRAB_WASTE)) & (rate_mh != 0)
+    travel_s = np.zeros_like(vol_ml)
+    np.divide(np.abs(vol_ml) * 3600, np.abs(rate_mh), out=travel_s, where=moving)
+    action_s = travel_s + time_s
+    resetting = np.isin(kind, (RESET, RESET_WASTE))
+    action_s += np.where(resetting, RESET_PURGE_TIME + RESET_ESTIMATE_S, 0)
+    action_s += np.where(np.isin(kind, (GRAB, GRAB_WASTE)), GRAB_ESTIMATE_S, 0)
+
+    # Actions of one step run side by side, the slowest one ends it
+    durations = np.zeros(n_steps)
+    np.maximum.at(durations, step, action_s)
+    durations += np.asarray(columns.step_completion, dtype=np.float64)
+
+    kinds = np.full(n_steps, USER, dtype=np.int8)
+    # The first action names the step, e.g. PUMP for PUMP + RELEASE
+    first = np.unique(step, return_index=True)[1]
+    kinds[step[first]] = kind[first]
+    rates = np.zeros(n_steps)
+    pump_first = first[np.isin(kind[first], (PUMP, RELEASE))]
+    rates[step[pump_first]] = rate_mh[pump_first]
+    targets = np.full(n_steps, -1, dtype=np.int8)
+    targets[step[pump_first]] = target[pump_first]
+    estimated = np.zeros(n_steps, dtype=bool)
+    estimated[step[np.isin(kind, SWITCHED)]] = True
+
+    volumes = np.zeros((len(PUMP_TARGETS), n_steps))
+    pumping = target >= 0
+    np.add.at(
+        volumes,
+        (target[pumping], step[pumping]),
+        np.copysign(vol_ml[pumping], rate_mh[pumping]),
+    )
+
+    # Cumulative times restart at every protocol
+    offsets = np.asarray(columns.protocol_offsets, dtype=np.intp)
+    ends = np.cumsum(durations)
+    restart = np.concatenate(([0.0], ends))[offsets[:-1]]
+    ends -= np.repeat(restart, np.diff(offsets))
+    starts = ends - durations
+
+    return [
+        ProtocolTimeline(
+            columns.names[a:b],
+            columns.headers[a:b],
+            kinds[a:b],
+            starts[a:b],
+            ends[a:b],
+            estimated[a:b],
+            rates[a:b],
+            targets[a:b],
+            volumes[:, a:b],
+        )
+        for a, b in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+class ProtocolTimeline:
+    """Numeric timeline of a protocol.
+
+    Every array holds one entry per step in protocol order, times are in
+    seconds from the start of the protocol.
+
+    names: list
+        - step names
+    kinds: numpy.ndarray
+        - step kind codes, see STEP_KINDS. Operator steps are USER and take no time
+    starts, ends, durations: numpy.ndarray
+        - planned start, end and length of every step
+    estimated: numpy.ndarray
+        - True where the length depends on limit switches and is only an estimate
+    rates, targets: numpy.ndarray
+        - flow rate in ml/h and PUMP_TARGETS index of the first pump action of
+          a step, 0 and -1 without one
+    volumes: numpy.ndarray
+        - ml moved by each pump in PUMP_TARGETS (rows) per step (columns),
+          negative when the pump runs in reverse
+    """
+
+    def __init__(self, names, headers, kinds, starts, ends, estimated, rates, targets, volumes):
+        self.names = names
+        self.headers = headers
+        self.kinds = kinds
+        self.starts = starts
+        self.ends = ends
+        self.durations = ends - starts
+        self.estimated = estimated
+        self.rates = rates
+        self.targets = targets
+        self.volumes = volumes
+        self._index = {name: i for i, name in enumerate(names)}
+
+    @classmethod
+    def from_protocol(cls, protocol):
+        columns = StepColumns()
+        columns.add_protocol(protocol)
+        return compute_timelines(columns)[0]
+
+    def __len__(self):
+        return len(self.names)
+
+    def from_step(self, name):
+        """The timeline of the protocol started at step ``name``."""
+        i = self._index[name]
+        offset = self.starts[i]
+        return ProtocolTimeline(
+            self.names[i:],
+            self.headers[i:],
+            self.kinds[i:],
+            self.starts[i:] - offset,
+            self.ends[i:] - offset,
+            self.estimated[i:],
+            self.rates[i:],
+            self.targets[i:],
+            self.volumes[:, i:],
+        )
+
+    @property
+    def total(self):
+        return float(self.ends[-1]) if len(self) else 0.0
+
+    def index(self, name):
+        return self._index[name]
+
+    def eta(self, name):
+        """Seconds from the start of the protocol until step ``name`` ends."""
+        return float(self.ends[self._index[name]])
+
+    def remaining_after(self, name):
+        """Planned seconds left once step ``name`` has ended."""
+        return self.total - self.eta(name)
+
+    def cumulative_volumes(self):
+        return np.cumsum(self.volumes, axis=1)
+
+    def volume_totals(self):
+        """Total ml moved per pump target."""
+        return dict(zip(PUMP_TARGETS, np.abs(self.volumes).sum(axis=1).tolist()))
+
+    def summary_rows(self):
+        """Rows of step number, material, flow rate, volume and duration for
+        the summary table. Incubations are added to the step before them."""
+        rows = []
+        for i, name in enumerate(self.names):
+            kind = self.kinds[i]
+            if kind == USER:
+                continue
+            if kind == INCUBATE and rows:
+                rows[-1][4] += self.durations[i]
+                continue
+            if kind in (PUMP, RELEASE):
+                material = self.headers[i].split(" ")[0]
+                flowrate = float(self.rates[i])
+                volume = abs(float(self.volumes[self.targets[i], i]))
+            else:
+                material, flowrate, volume = self.headers[i], "", ""
+            rows.append([len(rows) + 1, material, flowrate, volume, self.durations[i], i])
+        return [
+            row[:4] + [("~" if self.estimated[row[5]] else "") + format_duration(row[4])]
+            for row in rows
+        ]
+
+
+def timelines_for_directory(path, pattern="*.json"):
+    """Timelines of every protocol in a directory, computed in one pass.
+    Returns a dict of path to timeline and a dict of path to load error."""
+    columns = StepColumns()
+    loaded, errors = [], {}
+    for protocol_file in sorted(Path(path).glob(pattern)):
+        try:
+            with open(protocol_file, "r") as f:
+                protocol = json.loads(f.read(), object_pairs_hook=OrderedDict)
+            columns.add_protocol(protocol)
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            errors[protocol_file] = err
+            continue
+        loaded.append(protocol_file)
+    return dict(zip(loaded, compute_timelines(columns))), errors
 
 
 class ProcessProtocol:
@@ -10,63 +308,20 @@ class ProcessProtocol:
     def __init__(self, protocol_file) -> None:
         self.protocol_file = protocol_file
         self.load_protocol()
-    
-    #protocol_file = "v0-protocol-16v3.json"
 
     def load_protocol(self):
         with open(self.protocol_file, 'r') as f:
             self.protocol = json.loads(f.read(), object_pairs_hook=OrderedDict)
+        self.timeline = ProtocolTimeline.from_protocol(self.protocol)
 
     def list_steps(self):
-        step_number = 0
-        incubate = 0
-        list_of_table_entries = []
-        print("Step # \t\tMaterial \t\tFlowrate(mL/h) \t\tVolume(mL) \t\tStep Duration")
-        for key in self.protocol.keys():
-            for k in self.protocol[key]:
-                if k == "action":
-                    for steps in self.protocol[key][k]:
-                        if steps == "PUMP":
-                            step_number += 1
-                            for s in self.protocol[key][k][steps]:
-                                if s == "vol_ml":
-                                    volume = self.protocol[key][k][steps][s]
-                                elif s == "rate_mh":
-                                    flowrate = self.protocol[key][k][steps][s]
-                                elif s == "eq_time":
-                                    duration = self.protocol[key][k][steps][s]
-                            step_time = self.calculate_step_time_sec(volume, flowrate, duration)
-                            material = self.protocol[key]["header"].split(" ")[0]
-                            list_of_table_entries.append([step_number, material, flowrate, volume, step_time])
-                        elif steps == "INCUBATE":
-                            # This is so hacky it's insane, but it I couldn't figure out how to fix the year getting set to 1900
-                            # So if we force the year to 1970 during the conversion all of the conversions back and forth between date-times
-                            # and times work out. 
-                            incubate = self.protocol[key][k][steps]["time"]
-                            str_time_without_inc = list_of_table_entries[-1][-1]
-                            time_as_struct = time.strptime(str_time_without_inc + ":1970", '%H:%M:%S:%Y')
-                            time_with_inc = calendar.timegm(time_as_struct) + incubate
-                            str_time_with_inc = time.strftime('%H:%M:%S', time.gmtime(time_with_inc))
-                            list_of_table_entries[-1][-1] = str_time_with_inc
-
-        
-        return list_of_table_entries
-                            
-
-    def calculate_step_time_sec(self, vol: int, flowrate: float, wait: int):
-        seconds = (vol/flowrate * 3600 + wait)
-        return time.strftime('%H:%M:%S', time.gmtime(seconds))
+        return self.timeline.summary_rows()
 
 
 if __name__ == "__main__":
-    filename = 'v0-protocol-16v3-pretty.txt'
-    original_stdout = sys.stdout
-    with open(filename, 'w') as f:
-        proto = ProcessProtocol("v0-protocol-16v3.json")
-        print("Process Protocol")
-        sys.stdout = f
-        for line in proto.list_steps():
-            print(line)
-        sys.stdout = original_stdout
-        print("File Output to: {}".format(filename))
-
+    timelines, errors = timelines_for_directory(sys.argv[1] if len(sys.argv) > 1 else ".")
+    for protocol_file, timeline in timelines.items():
+        volumes = ", ".join(f"{t} {v:.2f} mL" for t, v in timeline.volume_totals().items())
+        print(f"{protocol_file.name:<32}{format_duration(timeline.total):>10}  {volumes}")
+    for protocol_file, err in errors.items():
+        print(f"{protocol_file.name:<32}{'invalid':>10}  {err}")
@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+
+"""
+Run ChipFlowApp without a window, on simulated hardware and simulated time.
+
+HeadlessApp boots the real GUI code: the ProcessWindow, its screens, the step
+schedulers and the Kivy Clock. The pumps and the Nano are replaced with the
+SimulatedHardware ones and every clock reads one VirtualClock, so a protocol
+of hours is walked through in seconds:
+
+    app = HeadlessApp("cd_alpha/tests/v0-protocol-16v1.json")
+    app.run_protocol()
+    app.close()
+
+Frames are only run when something is due. Time jumps to the next step
+timer, but never more than ``max_frame`` at once, so plain Kivy clock events
+fire at most that late.
+
+Import this module before anything imports kivy.core.window: it selects
+Kivy's mock GL backend and a window provider that never opens anything. When
+a real window already exists it is used as it is. ChipFlowApp still reads the
+device config on import, it has to be a DEV_MACHINE one. The app is never
+built, so the cd_alpha logs are not written to the device log file.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+if "kivy.core.window" not in sys.modules:
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    os.environ["KIVY_GL_BACKEND"] = "mock"
+    os.environ["KIVY_WINDOW"] = ""
+
+from cd_alpha.ProtocolExecutor import VirtualClock
+from cd_alpha.RunRecording import RecordingNano, RecordingSerial
+from cd_alpha.Telemetry import TelemetryRecorder
+from cd_alpha.software_testing.SimulatedHardware import (
+    SimulatedNano,
+    SimulatedPumpNetwork,
+)
+
+# Steps the operator has to confirm with the next button
+OPERATOR_KINDS = ("home", "user", "summary")
+MIN_FRAME = 0.001
+
+_window = None
+
+
+def _quiet_kivy():
+    # The missing window provider and the mock GL are expected here
+    from kivy.logger import Logger
+
+    level = Logger.level
+    Logger.setLevel(logging.CRITICAL + 1)
+    return lambda: Logger.setLevel(level)
+
+
+def install_window():
+    """Give Kivy a window that renders nothing, once per process. Returns
+    the window in use."""
+    global _window
+    if _window is not None:
+        return _window
+    restore = _quiet_kivy()
+    try:
+        import kivy.core.window
+        from kivy.base import EventLoop
+        from kivy.core.window import WindowBase
+
+        if kivy.core.window.Window is not None:
+            _window = kivy.core.window.Window
+            return _window
+
+        class HeadlessWindow(WindowBase):
+            def flip(self):
+                pass
+
+            def mainloop(self):
+                pass
+
+            def set_title(self, title):
+                pass
+
+            def set_icon(self, filename):
+                pass
+
+            def close(self):
+                pass
+
+        _window = HeadlessWindow()
+        kivy.core.window.Window = _window
+        EventLoop.set_window(_window)
+    finally:
+        restore()
+    return _window
+
+
+class HeadlessApp:
+    """
+    protocol: str or Path
+        - protocol file to load, the default protocol of the device when None
+    max_frame: float
+        - most virtual seconds between two frames
+    data_dir: str or Path
+        - telemetry, metrics, stall reports, recordings, the compiled
+        protocols and the protocol index, a temporary directory when None
+    transitions: bool
+        - keep the screen transitions, they take a few frames each
+    clock: VirtualClock
+        - shared with hardware that keeps its own time, a new one when None
+    pumps, nano:
+        - hardware to use instead of the SimulatedHardware, e.g. a
+        PumpNetwork on the PumpEmulator. Runs are recorded like on the
+        device, the SimulatedPumpNetwork has no serial port to record.
+    """
+
+    def __init__(
+        self,
+        protocol=None,
+        max_frame=0.5,
+        data_dir=None,
+        transitions=False,
+        clock=None,
+        pumps=None,
+        nano=None,
+    ):
+        self.window = install_window()
+        from kivy.app import App
+        from kivy.clock import Clock
+        from kivy.uix.screenmanager import NoTransition
+
+        from cd_alpha import ChipFlowApp as cfa
+
+        self.cfa = cfa
+        self.kivy_clock = Clock
+        self.max_frame = max_frame
+        self.clock = clock or VirtualClock()
+        self._tmp = None
+        if data_dir is None:
+            self._tmp = tempfile.TemporaryDirectory(prefix="cd_alpha_headless_")
+            data_dir = self._tmp.name
+        self.data_dir = Path(data_dir)
+
+        # Every clock of the app reads the virtual one
+        self._max_fps = Clock._max_fps
+        Clock._max_fps = 0
+        Clock.time = self.clock
+        Clock._last_tick = self.clock()
+        cfa.scheduler.clock = self.clock
+        cfa.scheduler.cancel_all()
+        # The boundaries are run from the frames instead of the timing thread
+        cfa.boundary_scheduler.clock = self.clock
+        cfa.boundary_scheduler.waker = None
+        cfa.boundary_scheduler.cancel_all()
+
+        self.pumps = pumps or SimulatedPumpNetwork(self.clock, cfa.list_of_pumps)
+        if hasattr(self.pumps, "ser"):
+            self.pumps.ser = RecordingSerial(self.pumps.ser, cfa.recorder)
+        cfa.pumps = self.pumps
+        if cfa.nano is not None:
+            self.nano = nano or SimulatedNano(self.pumps)
+            cfa.nano = RecordingNano(self.nano, cfa.recorder)
+        else:
+            self.nano = None
+        self.telemetry = TelemetryRecorder(self.data_dir / "telemetry.sqlite", self.clock)
+        cfa.telemetry = self.telemetry
+        cfa.protocol_cache_dir = self.data_dir / "protocols"
+        cfa.protocol_index_path = self.data_dir / "protocol_index.sqlite"
+        cfa.metrics_dir = self.data_dir / "metrics"
+        cfa.stall_report_dir = self.data_dir / "stalls"
+        cfa.recorder.clock = self.clock
+        cfa.recording_dir = self.data_dir / "recordings"
+
+        self.app = cfa.ChipFlowApp()
+        if protocol is not None:
+            self.app.protocol_path = Path(protocol).parent
+            self.app.protocol_name = Path(Path(protocol).name)
+        App._running_app = self.app
+        self.root = cfa.ProcessWindow(protocol_file_name=self.app.protocol_name)
+        self.app.root = self.root
+        self.window.add_widget(self.root)
+        self.screen_manager = self.root.process_sm
+        if not transitions:
+            self.screen_manager.transition = NoTransition()
+        # Screens in the order they were entered, with the virtual time
+        self.screens = [(self.screen_manager.current, self.clock())]
+        self.screen_manager.bind(current=self._screen_changed)
+        self.frames = 0
+        self.frame()
+
+    def _screen_changed(self, manager, name):
+        self.screens.append((name, self.clock()))
+
+    # ---- state ---- #
+
+    @property
+    def current(self):
+        return self.screen_manager.current
+
+    @property
+    def current_screen(self):
+        return self.screen_manager.current_screen
+
+    @property
+    def entered(self):
+        """The current screen is entered, its transition is over."""
+        return not self.screen_manager.transition.is_active
+
+    def on_screen(self, name):
+        return self.current == name and self.entered
+
+    @property
+    def waiting_for_operator(self):
+        descriptor = self.screen_manager.descriptors.get(self.current)
+        return self.entered and descriptor is not None and descriptor.kind in OPERATOR_KINDS
+
+    def next_deadline(self):
+        deadlines = [
+            d
+            for d in (
+                self.cfa.scheduler.next_deadline(),
+                self.cfa.boundary_scheduler.next_deadline(),
+            )
+            if d is not None
+        ]
+        return min(deadlines) if deadlines else None
+
+    # ---- driving ---- #
+
+    def frame(self):
+        """Run one frame at the current virtual time."""
+        self.cfa.boundary_scheduler.run_due()
+        self.kivy_clock.tick()
+        self.frames += 1
+
+    def advance(self, seconds):
+        """Let ``seconds`` of virtual time pass, running the frames on the way."""
+        self.run_until(lambda: False, seconds, raise_timeout=False)
+
+    def run_until(self, condition, timeout, raise_timeout=True):
+        """Run frames until ``condition()`` is true, at most ``timeout``
+        virtual seconds. Returns the condition."""
+        end = self.clock() + timeout
+        while not condition():
+            if self.clock() >= end:
+                if raise_timeout:
+                    raise TimeoutError(
+                        f"Still on {self.current} after {timeout} s of virtual time"
+                    )
+                return False
+            deadline = self.next_deadline()
+            step = self.max_frame if deadline is None else deadline - self.clock()
+            # A Kivy event can miss a deadline by a rounding error, move on anyway
+            step = min(max(step, MIN_FRAME), self.max_frame)
+            self.clock.now = min(self.clock() + step, end)
+            self.frame()
+        return True
+
+    def run_until_screen(self, name, timeout=3600):
+        return self.run_until(lambda: self.on_screen(name), timeout)
+
+    def press_next(self):
+        """The operator confirms the current screen."""
+        if not self.waiting_for_operator:
+            raise RuntimeError(f"{self.current} is not waiting for the operator")
+        self.root.press_next()
+        self.frame()
+
+    def skip(self):
+        self.current_screen.skip()
+        self.frame()
+
+    def abort(self):
+        """Confirm the abort popup."""
+        self.root.abort()
+        self.frame()
+
+    def run_to_screen(self, name, timeout=24 * 3600):
+        """Run until ``name`` is shown, confirming every operator screen on
+        the way."""
+        end = self.clock() + timeout
+        while True:
+            self.run_until(
+                lambda: self.on_screen(name) or self.waiting_for_operator,
+                end - self.clock(),
+            )
+            if self.on_screen(name):
+                return
+            self.press_next()
+
+    def run_protocol(self, timeout=24 * 3600, on_operator=None):
+        """Walk the whole protocol back to its first screen, confirming every
+        operator screen. ``on_operator(app)`` is called on each before it is
+        confirmed. Returns the wall clock seconds it took."""
+        started = time.perf_counter()
+        first = self.screen_manager.sequence[0]
+        end = self.clock() + timeout
+        left_home = False
+        while True:
+            self.run_until(
+                lambda: self.waiting_for_operator or (left_home and self.on_screen(first)),
+                end - self.clock(),
+            )
+            if left_home and self.on_screen(first):
+                return time.perf_counter() - started
+            if on_operator is not None:
+                on_operator(self)
+            left_home = True
+            self.press_next()
+
+    def close(self):
+        self.cfa.cleanup()
+        self.screen_manager.unbind(current=self._screen_changed)
+        self.window.remove_widget(self.root)
+        self.telemetry.close()
+        self.cfa.recorder.close()
+        del self.kivy_clock.time
+        self.kivy_clock._max_fps = self._max_fps
+        if self._tmp is not None:
+            self._tmp.cleanup()
@@ -1,4 +1,7 @@
 import logging
+import time
+
+log = logging.getLogger("cd_alpha.pumps")
 
 class PumpNetwork:
     '''TESTING STUB FOR LOCAL GUI DEVELOPMENT. DOES NOT COMMUNICATE WITH PUMP NETWORK'''
@@ -11,6 +14,7 @@ class PumpNetwork:
         self.ser = ser
         self.safe_protocol = False
         self.max_noof_retries = max_noof_retries
+        self.command_listener = None
 
 
     def _get_response(self):
@@ -25,17 +29,20 @@ class PumpNetwork:
         #        raise IOError('Response read timed out')
         #    output.append(c.decode('utf8'))
         response = "".join(output)
-        logging.debug(f"NEP: Got response: {response}")
+        log.debug("NEP: Got response: %s", response)
         return response
 
 
     def _send_command(self, cmd_str, addr=''):
         tmp = '{0}{1}\r'.format(addr, cmd_str)
-        logging.debug(f"NEP: Sending comand: {tmp}")
+        log.debug("NEP: Sending comand: %r", tmp)
         for n in range(self.max_noof_retries + 1):
+            sent = time.perf_counter()
             try:
                 self.ser.write(str.encode(tmp))
                 response = self._get_response()
+                if self.command_listener is not None:
+                    self.command_listener(addr, cmd_str, time.perf_counter() - sent, '?' not in response)
                 if '?' in response:
                     msg_str = "Error in response from network. Response: {}".format(response)
                     raise IOError(msg_str)
@@ -43,7 +50,7 @@ class PumpNetwork:
                     return response
             except:
                 if n >= self.max_noof_retries:
-                    logging.error("NEP: Maximum number of tries reached for sending command.")
+                    log.error("NEP: Maximum number of tries reached for sending command.")
                     raise
 
 
@@ -121,20 +128,20 @@ class PumpNetwork:
 
 
     def _set_addr(self, addr):
-        logging.warning(f"NEP: Setting addr of *ALL* connected pumps to {addr:02}")
+        log.warning("NEP: Setting addr of *ALL* connected pumps to %02d", addr)
         return self._send_command("ADR{}".format(addr), addr='*')
 
     def buzz(self, addr='', repetitions=1):
         return self._send_command("BUZ 1 {:}".format(int(repetitions)), addr)
     
     def stop_all_pumps(self, list_of_pumps=[1,2]):
-        logging.debug("CDA: Stopping all pumps.")
+        log.debug("CDA: Stopping all pumps.")
         for addr in list_of_pumps:
             try:
                 self.stop(addr)
             except IOError as err:
                 if str(err)[-3:] == "?NA":
-                    logging.debug(f"CDA: Pump {addr:02} already stopped.")
+                    log.debug("CDA: Pump %02d already stopped.", addr)
                 else:
                     raise        
 
@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+
+"""
+NE-500 pump network emulator on a pseudo-terminal.
+
+The emulator opens a pseudo-terminal and answers on it like a network of
+NE-500 pumps, byte for byte, so the real NewEraPumps.PumpNetwork and pyserial
+can be run against it. The plungers move like the SimulatedHardware ones, on
+the wall clock or on any other clock:
+
+    python3 -m cd_alpha.software_testing.PumpEmulator --addrs 1 2
+    /dev/pts/4
+
+Point ``chip-run --serial`` at the printed path, or PUMP_SERIAL_ADDR with
+DEV_SERIAL_PUMPS on a DEV_MACHINE to run the GUI on it. ``--link`` also
+makes a symlink to it, for a path that does not change between runs.
+
+Wire protocol
+
+    command    [addr]<command>[data]<CR>, the address is 0 when left out
+    reply      <STX><addr, 2 digits><status>[data]<ETX>
+    status     I infusing, W withdrawing, X purging, S stopped
+    errors     after the status: ? unknown command, ?NA not applicable
+               right now, ?OOR out of range
+
+A command to an address without a pump is not answered, like on the network.
+Replies go out after ``turnaround`` plus the time the command took to come
+in, then one byte every ``byte_time`` (10 bits per byte at the baud rate).
+"""
+
+import argparse
+import logging
+import os
+import pty
+import re
+import select
+import signal
+import sys
+import threading
+import time
+import tty
+from collections import deque
+
+from cd_alpha.software_testing.SimulatedHardware import (
+    PURGE_RATE_MH,
+    START_POSITION_ML,
+    SimulatedPump,
+)
+
+log = logging.getLogger("cd_alpha.emulator")
+
+STX = b"\x02"
+ETX = b"\x03"
+BAUD_RATE = 19200
+DEFAULT_TURNAROUND = 0.005
+HISTORY_LENGTH = 1000
+# ml/h per unit of RAT
+RATE_UNITS = {"MM": 60, "MH": 1, "UM": 0.06, "UH": 0.001}
+MAX_VALUE = 9999
+DIAMETER_RANGE_MM = (0.1, 50.0)
+NUMBER = re.compile(r"(\d+\.?\d*|\.\d+)(MM|MH|UM|UH)?$")
+# The address is up to two digits in front of the command
+COMMAND = re.compile(r"(\d{0,2})(.*)")
+
+
+def byte_time(baud_rate):
+    """Seconds per byte on the wire, 8N1."""
+    return 10 / baud_rate if baud_rate else 0.0
+
+
+class CommandError(Exception):
+    """Answered with the status and the code, e.g. ?NA."""
+
+    def __init__(self, code="?"):
+        super().__init__(code)
+        self.code = code
+
+
+class EmulatedPump(SimulatedPump):
+    """A SimulatedPump with the settings an NE-500 reports back."""
+
+    __slots__ = ("rate", "rate_unit", "volume")
+
+    def __init__(self, addr, position_ml=START_POSITION_ML):
+        super().__init__(addr, position_ml)
+        self.diameter_mm = 0.0
+        self.rate = 0.0
+        self.rate_unit = "MH"
+        self.volume = 0.0
+
+    def volume_ml(self):
+        return self.volume / (1000 if self.volume_unit == "UL" else 1)
+
+    def status(self, now):
+        if not self.is_running(now):
+            return "S"
+        if self.purging:
+            return "X"
+        return "I" if self.direction == "INF" else "W"
+
+
+class PumpEmulator:
+    """
+    addrs: list[int]
+        - addresses of the pumps on the network
+    byte_time: float
+        - seconds per byte in both directions, see byte_time()
+    turnaround: float
+        - seconds from the end of a command to the start of its reply
+    clock: callable
+        - time the plungers move on, e.g. a VirtualClock shared with the
+        ProtocolExecutor
+    """
+
+    def __init__(
+        self,
+        addrs=(1, 2),
+        byte_time=byte_time(BAUD_RATE),
+        turnaround=DEFAULT_TURNAROUND,
+        clock=time.monotonic,
+    ):
+        self.byte_time = byte_time
+        self.turnaround = turnaround
+        self.clock = clock
+        # Same layout as SimulatedPumpNetwork, a SimulatedNano can read it
+        self.pumps = {addr: EmulatedPump(addr) for addr in addrs}
+        self.commands = 0
+        # (wall time, address, command) of the latest commands, for timing
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        # Replies lost on the wire from now on, the pumps still execute them
+        self.lost_replies = 0
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ---- running ---- #
+
+    def start(self):
+        """Serve from a daemon thread."""
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="PumpEmulator", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        buffer = b""
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                chunk = os.read(self.master, 1024)
+            except OSError:
+                return
+            # The command is complete once its CR came in over the wire
+            received = time.perf_counter()
+            buffer += chunk
+            while b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                reply = self.handle(line.decode("ascii", "replace"))
+                if reply is not None and self.lost_replies:
+                    self.lost_replies -= 1
+                elif reply is not None:
+                    self._send(reply, received + (len(line) + 1) * self.byte_time)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.slave)
+        os.close(self.master)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _send(self, reply, command_end):
+        due = command_end + self.turnaround
+        if not self.byte_time:
+            _sleep_until(due)
+            os.write(self.master, reply)
+            return
+        # A byte is in once its last bit is
+        for n in range(len(reply)):
+            _sleep_until(due + (n + 1) * self.byte_time)
+            os.write(self.master, reply[n : n + 1])
+
+    # ---- protocol ---- #
+
+    def handle(self, line):
+        """The reply to one command line without its CR, None when no pump
+        has its address."""
+        addr, command = COMMAND.match(line.strip()).groups()
+        pump = self.pumps.get(int(addr) if addr else 0)
+        if pump is None:
+            log.debug("EMU: No pump at %r, %r not answered", addr, command)
+            return None
+        self.commands += 1
+        self.history.append((time.perf_counter(), pump.addr, command))
+        now = self.clock()
+        try:
+            data = self._execute(pump, command.upper().replace(" ", ""), now)
+        except CommandError as err:
+            data = err.code
+        log.debug("EMU: %02d %r -> %r", pump.addr, command, data)
+        return b"%s%02d%s%s%s" % (
+            STX,
+            pump.addr,
+            pump.status(now).encode(),
+            data.encode(),
+            ETX,
+        )
+
+    def _execute(self, pump, command, now):
+        # Commands are three letters, the system commands start with a *
+        if command == "*RESET":
+            name, arg = "RESET", ""
+        else:
+            name, arg = command[:3], command[3:]
+        handler = getattr(self, "_cmd_" + name, None)
+        if handler is None or not name.isalpha() and name:
+            raise CommandError()
+        return handler(pump, arg, now) or ""
+
+    def _cmd_(self, pump, arg, now):
+        # The empty command queries the status
+        if arg:
+            raise CommandError()
+
+    def _cmd_RUN(self, pump, arg, now):
+        if pump.purging and pump.is_running(now):
+            raise CommandError("?NA")
+        pump.settle(now)
+        pump.purging = False
+        if pump.target_ml <= 0:
+            # A volume of 0 runs until stopped
+            pump.target_ml = pump.volume_ml() or float("inf")
+        pump.running_since = now
+
+    def _cmd_STP(self, pump, arg, now):
+        pump.stop(now)
+
+    def _cmd_PUR(self, pump, arg, now):
+        if pump.is_running(now):
+            raise CommandError("?NA")
+        pump.settle(now)
+        pump.purging = True
+        pump.running_since = now
+
+    def _cmd_DIR(self, pump, arg, now):
+        if not arg:
+            return pump.direction
+        if arg not in ("INF", "WDR", "REV"):
+            raise CommandError("?OOR")
+        pump.settle(now)
+        if arg == "REV":
+            arg = "WDR" if pump.direction == "INF" else "INF"
+        pump.direction = arg
+
+    def _cmd_RAT(self, pump, arg, now):
+        if not arg:
+            return f"{pump.rate:.2f}{pump.rate_unit}"
+        value, unit = _number(arg)
+        pump.settle(now)
+        pump.rate = value
+        pump.rate_unit = unit or pump.rate_unit
+        pump.rate_mh = value * RATE_UNITS[pump.rate_unit]
+
+    def _cmd_VOL(self, pump, arg, now):
+        if not arg:
+            return f"{pump.volume:.3f}{pump.volume_unit}"
+        if arg in ("ML", "UL"):
+            pump.volume_unit = arg
+            return
+        value, unit = _number(arg)
+        if unit is not None:
+            raise CommandError("?OOR")
+        pump.settle(now)
+        pump.volume = value
+        pump.target_ml = pump.volume_ml()
+
+    def _cmd_DIA(self, pump, arg, now):
+        if not arg:
+            return f"{pump.diameter_mm:.2f}"
+        if pump.is_running(now):
+            raise CommandError("?NA")
+        value, unit = _number(arg)
+        if unit is not None or not DIAMETER_RANGE_MM[0] <= value <= DIAMETER_RANGE_MM[1]:
+            raise CommandError("?OOR")
+        pump.diameter_mm = value
+
+    def _cmd_DIS(self, pump, arg, now):
+        pump.settle(now)
+        scale = 1000 if pump.volume_unit == "UL" else 1
+        return (
+            f"I{pump.infused_ml * scale:.3f}"
+            f"W{pump.withdrawn_ml * scale:.3f}{pump.volume_unit}"
+        )
+
+    def _cmd_CLD(self, pump, arg, now):
+        pump.settle(now)
+        if arg == "INF":
+            pump.infused_ml = 0.0
+        elif arg == "WDR":
+            pump.withdrawn_ml = 0.0
+        else:
+            raise CommandError("?OOR")
+
+    def _cmd_BUZ(self, pump, arg, now):
+        if arg and arg[0] not in "01":
+            raise CommandError("?OOR")
+
+    def _cmd_RESET(self, pump, arg, now):
+        pump.stop(now)
+        pump.__init__(pump.addr, pump.position_ml)
+
+
+def _number(arg):
+    match = NUMBER.match(arg)
+    if match is None:
+        raise CommandError()
+    value = float(match.group(1))
+    if value > MAX_VALUE:
+        raise CommandError("?OOR")
+    return value, match.group(2)
+
+
+def _sleep_until(deadline):
+    delay = deadline - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--addrs", type=int, nargs="+", default=[1, 2])
+    parser.add_argument(
+        "--baud",
+        type=int,
+        default=BAUD_RATE,
+        help="time the bytes like this baud rate, 0 answers at once",
+    )
+    parser.add_argument(
+        "--turnaround",
+        type=float,
+        default=DEFAULT_TURNAROUND,
+        help="seconds from a command to its reply",
+    )
+    parser.add_argument("--link", default=None, help="also make a symlink here")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every command")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    emulator = PumpEmulator(args.addrs, byte_time(args.baud), args.turnaround)
+    if args.link:
+        if os.path.islink(args.link):
+            os.unlink(args.link)
+        os.symlink(emulator.path, args.link)
+    # Clean up the link when stopped like a service too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(emulator.path, flush=True)
+    log.info(
+        "EMU: Pumps %s, %s baud, %.1f ms turnaround, purging at %.0f ml/h",
+        ", ".join(map(str, args.addrs)),
+        args.baud,
+        args.turnaround * 1e3,
+        PURGE_RATE_MH,
+    )
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+        if args.link and os.path.islink(args.link):
+            os.unlink(args.link)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
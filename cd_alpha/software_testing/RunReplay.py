@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+"""
+Replay a run recording in the headless app, in simulated time.
+
+The recorded run is walked through again by the real GUI code: the pump
+network is the real PumpNetwork on a ReplaySerial that answers every command
+with its recorded reply, the Nano hands out the recorded switch reads and the
+operator presses the same buttons on the same screens at the same time from
+the start of the run. A two hour run replays in seconds:
+
+    chip-replay recording.jsonl [--output replayed.jsonl]
+
+The pump replies and switch reads are handed out in the recorded order. A
+command the app sends in another order than the recording is a divergence:
+the replay skips ahead to the next recorded command that matches, or lets the
+command time out when none does. After the end of the recorded run every
+pump answers that it is stopped. The replay records itself like the device
+does, a replay without divergences records the same pump commands and
+switch reads as the original.
+"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Sets up Kivy without a window, before anything imports it
+from cd_alpha.software_testing.HeadlessApp import HeadlessApp
+
+from cd_alpha.NewEraPumps import PumpNetwork
+from cd_alpha.RunRecording import SWITCHES, read_recording
+
+log = logging.getLogger("cd_alpha.replay")
+
+# Recorded commands searched for a match before a command times out
+RESYNC_WINDOW = 50
+# Virtual seconds the replay waits for the screen of an operator action
+SCREEN_SLACK = 600
+# Operator actions that change the run, the others only open popups
+REPLAYED_ACTIONS = ("next", "skip", "abort")
+COMMAND_ADDR = re.compile(r"\d{0,2}")
+
+
+class ReplaySerial:
+    """Serial port answering every command with its recorded reply."""
+
+    def __init__(self, exchanges, clock=None):
+        self.exchanges = exchanges
+        self.clock = clock
+        self.position = 0
+        self.divergences = []
+        self.ended = False
+        self._rx = b""
+
+    def end(self):
+        """The recorded run is over, every pump is stopped from now on."""
+        self.ended = True
+
+    def write(self, data):
+        tx = bytes(data).decode("latin-1")
+        if self.ended:
+            addr = COMMAND_ADDR.match(tx).group(0)
+            self._rx = b"\x02%02dS\x03" % int(addr or 0)
+            return len(data)
+        window = self.exchanges[self.position : self.position + RESYNC_WINDOW]
+        for skipped, exchange in enumerate(window):
+            if exchange["tx"] == tx:
+                if skipped:
+                    self._diverged(tx, f"skipped {skipped} recorded commands")
+                self.position += skipped + 1
+                self._rx = exchange["rx"].encode("latin-1")
+                return len(data)
+        self._diverged(tx, "not in the recording, timed out")
+        self._rx = b""
+        return len(data)
+
+    def readline(self, size=-1):
+        return self.read(len(self._rx) if size is None or size < 0 else size)
+
+    def read(self, size=1):
+        data, self._rx = self._rx[:size], self._rx[size:]
+        return data
+
+    def close(self):
+        pass
+
+    def _diverged(self, tx, what):
+        t = self.clock() if self.clock is not None else None
+        log.warning("CDA: Replay diverged at %r, %s", tx, what)
+        self.divergences.append({"t": t, "command": tx, "divergence": what})
+
+
+class ReplayNano:
+    """Limit switches read from the recording, in order. The last read is
+    held once the recording runs out."""
+
+    def __init__(self, reads):
+        self.reads = reads
+        self.position = 0
+        for switch in SWITCHES:
+            setattr(self, switch, True)
+
+    def update(self):
+        if self.position < len(self.reads):
+            read = self.reads[self.position]
+            self.position += 1
+            for switch in SWITCHES:
+                setattr(self, switch, read[switch])
+
+    def close(self):
+        pass
+
+
+class RunReplay:
+    """
+    path: str or Path
+        - run recording, see RunRecording
+    app_kwargs:
+        - passed on to the HeadlessApp
+    """
+
+    def __init__(self, path, **app_kwargs):
+        self.path = Path(path)
+        self.header, self.events, self.end = read_recording(self.path)
+        self._tmp = tempfile.TemporaryDirectory(prefix="cd_alpha_replay_")
+        protocol = Path(self._tmp.name) / self.header["protocol_file"]
+        protocol.write_text(self.header["protocol_source"])
+
+        self.serial = ReplaySerial([e for e in self.events if e["kind"] == "pump"])
+        self.nano = ReplayNano([e for e in self.events if e["kind"] == "nano"])
+        self.operator = [
+            e
+            for e in self.events
+            if e["kind"] == "operator" and e["action"] in REPLAYED_ACTIONS
+        ]
+        from cd_alpha import ChipFlowApp as cfa
+
+        self._start_step = cfa.START_STEP
+        cfa.START_STEP = self.header["start_step"]
+        self.app = HeadlessApp(
+            protocol, pumps=PumpNetwork(self.serial), nano=self.nano, **app_kwargs
+        )
+        self.serial.clock = self._run_time
+        self.divergences = self.serial.divergences
+        self._started = None
+
+    def _run_time(self):
+        if self._started is None:
+            return None
+        return round(self.app.clock() - self._started, 6)
+
+    def _diverged(self, event, what):
+        log.warning("CDA: Replay diverged at %s, %s", event, what)
+        self.divergences.append(
+            {"t": self._run_time(), "event": event, "divergence": what}
+        )
+
+    def run(self):
+        """Replay the whole run, returns a summary of the replay. An error the
+        app raises, e.g. after a pump timed out, ends the replay like it
+        ends the app on the device."""
+        started = time.perf_counter()
+        error = None
+        try:
+            self._replay()
+        except Exception as err:
+            log.exception("CDA: The app failed during the replay")
+            error = f"{type(err).__name__}: {err}"
+        self.serial.end()
+        recorder = self.app.cfa.recorder
+        if error is not None:
+            outcome = "crashed"
+        else:
+            outcome = recorder.outcome if not recorder.active else None
+        return {
+            "recording": str(self.path),
+            "recorded_outcome": self.end["outcome"] if self.end else None,
+            "outcome": outcome,
+            "error": error,
+            "replayed": str(recorder.path) if recorder.path else None,
+            "run_s": self._run_time(),
+            "recorded_run_s": self.end["t"] if self.end else None,
+            "wall_s": round(time.perf_counter() - started, 3),
+            "pump_commands": self.serial.position,
+            "switch_reads": self.nano.position,
+            "divergences": self.divergences,
+        }
+
+    def _replay(self):
+        app = self.app
+        app.run_until_screen(self.header["start_screen"])
+        # The recording starts when the operator left the first screen
+        self._started = app.clock()
+        app.press_next()
+        for event in self.operator:
+            app.advance(max(self._started + event["t"] - app.clock(), 0))
+            if not app.run_until(
+                lambda: app.on_screen(event["screen"]), SCREEN_SLACK, raise_timeout=False
+            ):
+                self._diverged(event, f"never reached, still on {app.current}")
+                return
+            if event["action"] == "next":
+                app.press_next()
+            elif event["action"] == "skip":
+                app.skip()
+            else:
+                app.abort()
+        if self.end is not None and app.cfa.recorder.active:
+            app.run_until(
+                lambda: not app.cfa.recorder.active,
+                max(self._started + self.end["t"] - app.clock(), 0) + SCREEN_SLACK,
+                raise_timeout=False,
+            )
+
+    def close(self):
+        self.app.close()
+        self.app.cfa.START_STEP = self._start_step
+        self._tmp.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("recording", help="run recording to replay")
+    parser.add_argument(
+        "--output", default=None, help="keep the recording of the replay here"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    replay = RunReplay(args.recording)
+    try:
+        summary = replay.run()
+        if args.output and summary["replayed"]:
+            Path(args.output).write_bytes(Path(summary["replayed"]).read_bytes())
+    finally:
+        replay.close()
+    print(json.dumps(summary, indent=4))
+    return 0 if not summary["divergences"] and summary["error"] is None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+"""
+Physical simulation of the V0 pump network and limit switches for dry runs.
+
+Unlike the test stubs these keep track of where every plunger is on a shared
+(usually simulated) clock: pumps move at their set rate until their volume is
+dispensed or they are stopped, and the Nano switches open and close from the
+plunger positions. Pumps and switches can be used with the ProtocolExecutor
+in accelerated time.
+"""
+
+# Plunger positions are in ml of travel from the home switch
+PURGE_RATE_MH = 300.0
+HOME_POSITION_ML = 0.0
+START_POSITION_ML = 2.0
+SYRINGE_CONTACT_ML = 1.0
+
+HOME_SWITCHES = {"d2": 1, "d3": 2}
+GRAB_SWITCHES = {"d4": 1, "d5": 2}
+
+
+class SimulatedPump:
+
+    __slots__ = (
+        "addr",
+        "diameter_mm",
+        "rate_mh",
+        "direction",
+        "target_ml",
+        "running_since",
+        "position_ml",
+        "infused_ml",
+        "withdrawn_ml",
+        "purging",
+        "volume_unit",
+    )
+
+    def __init__(self, addr, position_ml=START_POSITION_ML):
+        self.addr = addr
+        self.diameter_mm = None
+        self.rate_mh = 0.0
+        self.direction = "INF"
+        self.target_ml = 0.0
+        self.running_since = None
+        self.position_ml = position_ml
+        self.infused_ml = 0.0
+        self.withdrawn_ml = 0.0
+        self.purging = False
+        self.volume_unit = "ML"
+
+    def moved_ml(self, now):
+        if self.running_since is None:
+            return 0.0
+        rate = PURGE_RATE_MH if self.purging else self.rate_mh
+        moved = rate * (now - self.running_since) / 3600
+        if not self.purging:
+            moved = min(moved, self.target_ml)
+        return moved
+
+    def position(self, now):
+        sign = 1 if self.direction == "INF" else -1
+        return self.position_ml + sign * self.moved_ml(now)
+
+    def is_running(self, now):
+        if self.running_since is None:
+            return False
+        return self.purging or self.moved_ml(now) < self.target_ml
+
+    def settle(self, now):
+        """Fold the movement so far into the position and totals."""
+        if self.running_since is None:
+            return
+        moved = self.moved_ml(now)
+        if self.direction == "INF":
+            self.position_ml += moved
+            self.infused_ml += moved
+        else:
+            self.position_ml -= moved
+            self.withdrawn_ml += moved
+        if not self.purging:
+            self.target_ml = max(self.target_ml - moved, 0.0)
+        if self.purging or self.target_ml > 0:
+            self.running_since = now
+        else:
+            self.running_since = None
+
+    def stop(self, now):
+        self.settle(now)
+        self.running_since = None
+        self.purging = False
+
+
+class SimulatedPumpNetwork:
+    """Drop-in replacement for NewEraPumps.PumpNetwork on a simulated clock."""
+
+    FLOW_RATE_UNITS = ["MM", "MH", "UM", "UH", ""]
+
+    def __init__(self, clock, addrs=(1, 2)):
+        self.clock = clock
+        self.pumps = {addr: SimulatedPump(addr) for addr in addrs}
+        self.commands = 0
+
+    def _pump(self, addr):
+        self.commands += 1
+        try:
+            return self.pumps[int(addr)]
+        except (KeyError, ValueError) as err:
+            raise IOError(f"No pump at address {addr!r}") from err
+
+    def run(self, addr=""):
+        pump = self._pump(addr)
+        now = self.clock()
+        pump.settle(now)
+        pump.running_since = now
+        pump.purging = False
+
+    def purge(self, direction=1, addr=""):
+        pump = self._pump(addr)
+        now = self.clock()
+        pump.settle(now)
+        pump.direction = "INF" if direction == 1 else "WDR"
+        pump.running_since = now
+        pump.purging = True
+
+    def stop(self, addr):
+        self._pump(addr).stop(self.clock())
+        return "S"
+
+    def stop_all_pumps(self, list_of_pumps=[1, 2]):
+        for addr in list_of_pumps:
+            self.stop(addr)
+
+    def set_diameter(self, diameter_mm, addr=""):
+        self._pump(addr).diameter_mm = diameter_mm
+
+    def set_rate(self, rate, unit, addr=""):
+        if unit not in self.FLOW_RATE_UNITS:
+            raise TypeError(f"Flow rate unit {unit} is not among the allowed units")
+        pump = self._pump(addr)
+        pump.settle(self.clock())
+        flow_rate = float(rate) * {"MM": 60, "MH": 1, "UM": 0.06, "UH": 0.001, "": 1}[unit]
+        pump.direction = "WDR" if flow_rate < 0 else "INF"
+        pump.rate_mh = abs(flow_rate)
+
+    def set_volume(self, volume, unit, addr=""):
+        pump = self._pump(addr)
+        pump.settle(self.clock())
+        pump.volume_unit = unit
+        pump.target_ml = float(volume) / (1000 if unit == "UL" else 1)
+
+    def status(self, addr=""):
+        pump = self._pump(addr)
+        if not pump.is_running(self.clock()):
+            return "S"
+        return "I" if pump.direction == "INF" else "W"
+
+    def buzz(self, addr="", repetitions=1):
+        self._pump(addr)
+
+    def volumes(self):
+        """Infused and withdrawn ml per pump address."""
+        now = self.clock()
+        for pump in self.pumps.values():
+            pump.settle(now)
+        return {
+            addr: {"infused_ml": p.infused_ml, "withdrawn_ml": p.withdrawn_ml}
+            for addr, p in self.pumps.items()
+        }
+
+
+class SimulatedNano:
+    """Limit switches read from the simulated plunger positions. A switch
+    reads False (closed) when its pump reached it, like the real Nano."""
+
+    def __init__(self, pumps):
+        self.pumps = pumps
+        self.d2 = self.d3 = self.d4 = self.d5 = True
+        self.reads = 0
+
+    def update(self):
+        self.reads += 1
+        now = self.pumps.clock()
+        for switch, addr in HOME_SWITCHES.items():
+            pump = self.pumps.pumps.get(addr)
+            homed = pump is not None and pump.position(now) <= HOME_POSITION_ML
+            setattr(self, switch, not homed)
+        for switch, addr in GRAB_SWITCHES.items():
+            pump = self.pumps.pumps.get(addr)
+            grabbed = pump is not None and pump.position(now) >= SYRINGE_CONTACT_ML
+            setattr(self, switch, not grabbed)
+
+    def close(self):
+        pass
@@ -0,0 +1,52 @@
+import unittest
+
+from cd_alpha.benchmarks.suite import compare, result
+
+
+def results(reference_ms, quick=False, **values):
+    units = {
+        "parse": ("ms", "lower"),
+        "serial": ("cmd/s", "higher"),
+        "rasterised": ("count", "lower"),
+    }
+    return {
+        "quick": quick,
+        "results": {
+            name: dict(result(value, *units[name]), reference_ms=reference_ms)
+            for name, value in values.items()
+        },
+    }
+
+
+class CompareTestCase(unittest.TestCase):
+    def setUp(self):
+        self.baseline = results(5.0, parse=1.0, serial=1000.0, rasterised=600)
+
+    def test_slower_host_is_no_regression(self):
+        # Everything twice as slow, like the reference loop
+        current = results(10.0, parse=2.0, serial=500.0, rasterised=600)
+        self.assertEqual(compare(current, self.baseline), [])
+
+    def test_regression_on_the_same_host(self):
+        current = results(5.0, parse=1.5, serial=500.0, rasterised=700)
+        regressions = {name for name, _, _ in compare(current, self.baseline)}
+        self.assertEqual(regressions, {"parse", "serial"})
+        # Counts are not timings, a faster host does not hide them
+        current = results(2.5, parse=0.5, serial=2000.0, rasterised=900)
+        regressions = {name for name, _, _ in compare(current, self.baseline)}
+        self.assertEqual(regressions, {"rasterised"})
+
+    def test_per_result_tolerance(self):
+        current = results(5.0, parse=1.5, serial=1000.0, rasterised=600)
+        self.assertEqual(compare(current, self.baseline, tolerances={"par*": 0.6}), [])
+
+    def test_modes_are_not_compared(self):
+        current = results(5.0, quick=True, parse=1.0, serial=1000.0, rasterised=100)
+        with self.assertRaises(ValueError):
+            compare(current, self.baseline)
+        with self.assertRaises(ValueError):
+            compare(self.baseline, current)
+
+
+if __name__ == "__main__":
+    unittest.main()
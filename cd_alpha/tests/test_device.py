@@ -0,0 +1,34 @@
+import json
+import os
+import tempfile
+import unittest
+
+from pkg_resources import resource_filename
+
+from cd_alpha.Device import Device
+
+
+class DeviceTestCase(unittest.TestCase):
+    def _device(self, config):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "device_config.json")
+            with open(path, "w") as f:
+                json.dump(config, f)
+            return Device(path)
+
+    def test_template(self):
+        device = Device(resource_filename("cd_alpha", "device_config_template.json"))
+        self.assertEqual(device.PUMP_SERIAL_ADDR, "/dev/ttyUSB0")
+        self.assertEqual(device.PUMP_ADDR, [1, 2])
+
+    def test_empty_serial_address_is_unset(self):
+        config = {"DEVICE_TYPE": "V0", "DEFAULT_PROTOCOL": "a.json"}
+        self.assertEqual(self._device(config).PUMP_SERIAL_ADDR, "/dev/ttyUSB0")
+        config["PUMP_SERIAL_ADDR"] = ""
+        self.assertEqual(self._device(config).PUMP_SERIAL_ADDR, "/dev/ttyUSB0")
+        config["PUMP_SERIAL_ADDR"] = "/dev/pts/4"
+        self.assertEqual(self._device(config).PUMP_SERIAL_ADDR, "/dev/pts/4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from cd_alpha.FrameWatchdog import FrameWatchdog
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+class FrameWatchdogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.watchdog = FrameWatchdog(threshold_s=0.1, sample_interval=0.01).start()
+        self.addCleanup(self.watchdog.stop)
+
+    def test_stall_attributed_to_call_site(self):
+        self.watchdog.tick()
+        blocking_call()
+        self.watchdog.tick()
+        sites = self.watchdog.report()
+        self.assertEqual(len(sites), 1)
+        self.assertTrue(sites[0].site.endswith("in blocking_call"), sites[0].site)
+        self.assertEqual(sites[0].count, 1)
+        self.assertGreaterEqual(sites[0].max_s, 0.3)
+        self.assertIn("blocking_call", self.watchdog.format_report())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self.watchdog.dump(os.path.join(tmp, "stalls", "run.json"))
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual(data["frames"], 2)
+        self.assertEqual(data["stalls"][0]["site"], sites[0].site)
+        self.watchdog.reset()
+        self.assertEqual(self.watchdog.report(), [])
+
+    def test_short_frames(self):
+        for _ in range(20):
+            self.watchdog.tick()
+            time.sleep(0.01)
+        self.watchdog.tick()
+        self.assertEqual(self.watchdog.report(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import unittest
+
+from cd_alpha.software_testing.HeadlessApp import HeadlessApp
+
+from cd_alpha.GlyphAtlas import DIGITS, DigitLabel, GlyphAtlas
+from kivy.uix.label import Label
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class DigitLabelTestCase(unittest.TestCase):
+    def setUp(self):
+        # Kivy needs a running app for the text provider
+        self.app = HeadlessApp(os.path.join(TEST_DIR, "v0-protocol-16v1.json"))
+        self.addCleanup(self.app.close)
+
+    def _label(self, **kwargs):
+        label = DigitLabel(size=(300, 100), **kwargs)
+        self.app.frame()
+        return label
+
+    def test_composed_from_glyphs(self):
+        label = self._label(text="12:05", font_size=24)
+        atlas = GlyphAtlas.get(label.font_name, 24)
+        textures = [rect.texture for rect in label._rects]
+        self.assertEqual(textures, [atlas.glyph(c) for c in "12:05"])
+        self.assertEqual(label.texture_size[0], sum(t.width for t in textures))
+        # Centered, side by side
+        first, last = label._rects[0], label._rects[-1]
+        self.assertAlmostEqual(first.pos[0], 150 - label.texture_size[0] / 2, delta=1)
+        self.assertEqual(last.pos[0] + last.size[0], first.pos[0] + label.texture_size[0])
+
+    def test_no_texture_per_value(self):
+        label = self._label(text="00:00", font_size=25)
+        atlas = GlyphAtlas.get(label.font_name, 25)
+        self.assertEqual(atlas.textures_created, len(DIGITS))
+        for n in range(300):
+            label.text = "{:02d}:{:02d}%".format(*divmod(n, 60))
+            self.app.frame()
+        self.assertEqual(atlas.textures_created, len(DIGITS))
+        # Other characters are rendered once when first shown
+        label.text = "1:00 left"
+        self.app.frame()
+        self.assertEqual(atlas.textures_created, len(DIGITS) + 4)
+        self.assertEqual(len(label._rects), 9)
+        label.text = "5%"
+        self.app.frame()
+        self.assertEqual(len(label._rects), 2)
+        self.assertEqual(len([i for i in label.canvas.children if i in label._rects]), 2)
+
+    def test_alignment(self):
+        label = self._label(text="42", halign="right", valign="top")
+        last = label._rects[-1]
+        self.assertEqual(last.pos[0] + last.size[0], label.right)
+        self.assertEqual(last.pos[1] + last.size[1], label.top)
+        label.halign = "left"
+        self.app.frame()
+        self.assertEqual(label._rects[0].pos[0], label.x)
+
+    def test_step_timer(self):
+        self.app.run_to_screen("incubate_1")
+        self.app.advance(65)
+        readouts = {
+            label.text
+            for label in self.app.current_screen.walk()
+            if isinstance(label, DigitLabel)
+        }
+        screen = self.app.current_screen
+        self.assertIn(screen.countdown_text, readouts)
+        self.assertIn("{:0.0f}%".format(screen.progress), readouts)
+        # The time left of the protocol is a caption, on a Label
+        captions = {
+            label.text for label in screen.walk() if isinstance(label, Label)
+        }
+        self.assertIn(screen.protocol_remaining_text, captions)
+        self.assertNotIn(screen.protocol_remaining_text, readouts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from cd_alpha.software_testing.HeadlessApp import HeadlessApp
+
+TEST_DIR = os.path.dirname(__file__)
+PROTOCOL_DIR = os.path.join(TEST_DIR, "..", "protocols")
+HEADLESS_RUN = f"""
+from cd_alpha.software_testing.HeadlessApp import HeadlessApp
+app = HeadlessApp({os.path.join(TEST_DIR, "v0-protocol-16v1.json")!r})
+app.run_to_screen("incubate_1")
+app.abort()
+app.screen_manager.show("protocol_chooser")
+app.current_screen.index_thread.join()
+app.close()
+"""
+
+
+class HeadlessAppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = HeadlessApp(os.path.join(TEST_DIR, "v0-protocol-16v1.json"))
+        self.addCleanup(self.app.close)
+
+    def _outcomes(self):
+        return self.app.telemetry.db.execute("SELECT outcome FROM runs").fetchall()
+
+    def test_walks_the_whole_protocol(self):
+        self.app.run_protocol()
+        entered = [name for name, _ in self.app.screens]
+        sequence = self.app.screen_manager.sequence
+        self.assertEqual(entered, sequence + [sequence[0]])
+        # Machine steps take at least their planned time
+        self.assertGreaterEqual(self.app.clock(), self.app.root.timeline.total)
+        self.assertEqual(self._outcomes(), [("finished",)])
+        self.assertEqual(self.app.cfa.scheduler.queue(), [])
+
+    def test_progress(self):
+        self.app.run_to_screen("incubate_1")
+        screen = self.app.current_screen
+        self.app.advance(screen.time_total / 2)
+        self.assertAlmostEqual(screen.progress, 50, delta=1)
+        self.assertTrue(screen.protocol_remaining_text.endswith("left"))
+        position = self.app.root.progress_screen_names.index("incubate_1")
+        self.assertEqual(self.app.root.overall_progress_bar.position, position)
+
+    def test_timer_renders(self):
+        self.app.run_to_screen("incubate_1")
+        screen = self.app.current_screen
+        renders = []
+        screen.bind(
+            progress=lambda *args: renders.append("progress"),
+            countdown_text=lambda *args: renders.append("countdown"),
+        )
+        self.app.advance(600)
+        # Ticked twice a second, the countdown shows once a second and the
+        # bar moves by its resolution
+        self.assertLessEqual(renders.count("countdown"), 601)
+        step = 0.2 / 100 * screen.time_total
+        self.assertLessEqual(renders.count("progress"), 600 / step + 1)
+        # At most a tick and a render behind
+        minutes, seconds = map(int, screen.countdown_text.split(":"))
+        lag = minutes * 60 + seconds - (screen.step_deadline - self.app.clock())
+        self.assertLess(abs(lag), 1.5)
+        position = self.app.root.progress_screen_names.index("incubate_1")
+        dots = [dot.status for dot in self.app.root.overall_progress_bar.steps]
+        self.assertEqual(dots[position], "present")
+        self.assertEqual(set(dots[:position]), {"past"})
+        self.assertEqual(set(dots[position + 1 :]), {"future"})
+
+    def test_abort_stops_everything(self):
+        self.app.run_to_screen("flush_1")
+        self.app.advance(10)
+        self.assertNotEqual(self.app.pumps.status(1), "S")
+        self.app.abort()
+        self.assertEqual(self.app.current, "home")
+        self.assertEqual(self.app.root.overall_progress_bar.position, 0)
+        for addr in self.app.cfa.list_of_pumps:
+            self.assertEqual(self.app.pumps.status(addr), "S")
+        self.assertEqual(self.app.cfa.scheduler.queue(), [])
+        self.assertEqual(self.app.cfa.boundary_scheduler.queue(), [])
+        self.assertEqual(self._outcomes(), [("aborted",)])
+
+    def test_updates_between_runs(self):
+        refresh_btn = self.app.root.refresh_btn
+        self.assertIn(refresh_btn, self.app.root.ids.top_bar.children)
+        self.assertFalse(refresh_btn.disabled)
+        self.app.run_to_screen("incubate_1")
+        self.assertTrue(refresh_btn.disabled)
+        self.app.abort()
+        self.assertFalse(refresh_btn.disabled)
+
+
+class SummaryScreenTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = HeadlessApp(os.path.join(PROTOCOL_DIR, "v0-protocol-24v0.json"))
+        self.addCleanup(self.app.close)
+
+    def _settle(self):
+        # The layout takes a few frames to size the view and fill it
+        for _ in range(10):
+            self.app.frame()
+
+    def test_recycled_rows(self):
+        self.app.run_to_screen("summary")
+        view = self.app.current_screen.ids.summary_view
+        self.app.run_until(lambda: view.data, 1)
+        self._settle()
+        rows = self.app.root.timeline.summary_rows()
+        self.assertEqual(len(view.data), len(rows) + 1)
+        self.assertEqual(view.data[0]["material"], rows[0][1])
+        self.assertTrue(view.data[-1]["bold"])
+        # Only the visible rows have widgets, however long the table
+        widgets = len(view.layout_manager.children)
+        self.assertLess(widgets, len(view.data))
+        self.app.current_screen.show_table(view.data * 50)
+        self._settle()
+        self.assertEqual(len(view.layout_manager.children), widgets)
+
+
+class HeadlessHomeTestCase(unittest.TestCase):
+    def test_leaves_the_device_data_alone(self):
+        # Imported and run with a home of its own
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home)
+            subprocess.run(
+                [sys.executable, "-c", HEADLESS_RUN],
+                env=env,
+                cwd=os.path.join(TEST_DIR, "..", ".."),
+                capture_output=True,
+                check=True,
+            )
+            data = os.path.join(home, ".local", "share", "cd_alpha")
+            self.assertFalse(os.path.exists(os.path.join(data, "telemetry.sqlite")))
+            self.assertFalse(os.path.exists(os.path.join(data, "logs", "cd_alpha.log")))
+            cache = os.path.join(home, ".cache", "cd_alpha")
+            self.assertFalse(os.path.exists(os.path.join(cache, "protocols")))
+            self.assertFalse(os.path.exists(os.path.join(cache, "protocol_index.sqlite")))
+
+
+if __name__ == "__main__":
+    unittest.main()
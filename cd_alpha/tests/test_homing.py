@@ -0,0 +1,152 @@
+import unittest
+
+from cd_alpha.Homing import (
+    SWITCH_UPDATE_INTERVAL,
+    Homing,
+    HomingCycle,
+    HomingState,
+    SyringeGrab,
+)
+from cd_alpha.ProtocolExecutor import VirtualClock
+from cd_alpha.StepScheduler import StepScheduler
+from cd_alpha.software_testing.SimulatedHardware import (
+    HOME_POSITION_ML,
+    PURGE_RATE_MH,
+    SYRINGE_CONTACT_ML,
+    SimulatedNano,
+    SimulatedPumpNetwork,
+)
+
+# Furthest a plunger can travel between two switch reads
+MAX_OVERTRAVEL_ML = PURGE_RATE_MH / 3600 * SWITCH_UPDATE_INTERVAL
+
+
+class StuckSwitchNano(SimulatedNano):
+    """The home switch of pump 2 and the grab switch of pump 1 never close."""
+
+    def update(self):
+        super().update()
+        self.d3 = True
+        self.d4 = True
+
+
+class HomingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.scheduler = StepScheduler(clock=self.clock)
+        self.pumps = SimulatedPumpNetwork(self.clock)
+        self.nano = SimulatedNano(self.pumps)
+        self.done = []
+
+    def _run(self, cycle):
+        cycle.on_done = self.done.append
+        cycle.start()
+        while cycle.active:
+            self.clock.sleep(max(self.scheduler.next_deadline() - self.clock(), 0))
+            self.scheduler.run_due()
+        return cycle
+
+    def _position(self, addr):
+        return self.pumps.pumps[addr].position(self.clock())
+
+    def test_homing_drives_both_pumps_at_once(self):
+        self.pumps.pumps[1].position_ml = 2.0
+        self.pumps.pumps[2].position_ml = 1.0
+        homing = self._run(
+            Homing(self.pumps, self.nano, self.scheduler, ["d2", "d3"], [1, 2])
+        )
+        self.assertEqual(homing.state, HomingState.DONE)
+        self.assertEqual(self.done, [homing])
+        # Only as long as the furthest pump needs, not the sum of both
+        purge_ml_s = PURGE_RATE_MH / 3600
+        furthest_s = homing.clear_time + (2.0 + homing.clear_time * purge_ml_s) / purge_ml_s
+        self.assertLess(homing.elapsed, furthest_s + 2 * SWITCH_UPDATE_INTERVAL)
+        self.assertLess(homing.axes[1].seek_s, homing.axes[0].seek_s)
+        for addr in (1, 2):
+            self.assertEqual(self.pumps.status(addr), "S")
+            overtravel = HOME_POSITION_ML - self._position(addr)
+            self.assertGreaterEqual(overtravel, 0)
+            self.assertLessEqual(overtravel, MAX_OVERTRAVEL_ML + 1e-9)
+        self.assertEqual(self.scheduler.queue(), [])
+
+    def test_homing_timeout_stops_pumps(self):
+        self.nano = StuckSwitchNano(self.pumps)
+        homing = self._run(
+            Homing(self.pumps, self.nano, self.scheduler, ["d2", "d3"], [1, 2], timeout=40)
+        )
+        self.assertEqual(homing.state, HomingState.TIMEOUT)
+        self.assertEqual([a.addr for a in homing.failed_axes], [2])
+        self.assertAlmostEqual(homing.elapsed, homing.clear_time + 40)
+        self.assertEqual(self.pumps.status(2), "S")
+        self.assertEqual(self.done, [homing])
+        self.assertEqual(self.scheduler.queue(), [])
+
+    def test_grab_stops_at_syringe_and_grasps(self):
+        for pump in self.pumps.pumps.values():
+            pump.position_ml = HOME_POSITION_ML
+        grab = self._run(
+            SyringeGrab(
+                self.pumps,
+                self.nano,
+                self.scheduler,
+                ["d4", "d5"],
+                [1, 2],
+                rate_mm=0.5,
+                vol_ml=0.1,
+            )
+        )
+        self.assertEqual(grab.state, HomingState.DONE)
+        for axis in grab.axes:
+            contact_s = SYRINGE_CONTACT_ML / (PURGE_RATE_MH / 3600)
+            self.assertLessEqual(axis.seek_s - contact_s, SWITCH_UPDATE_INTERVAL + 1e-9)
+            # Grasping after the stop
+            self.assertEqual(self.pumps.status(axis.addr), "I")
+        self.clock.sleep(60)
+        for addr in (1, 2):
+            position = self._position(addr)
+            self.assertGreaterEqual(position, SYRINGE_CONTACT_ML + 0.1)
+            self.assertLessEqual(position, SYRINGE_CONTACT_ML + 0.1 + MAX_OVERTRAVEL_ML)
+
+    def test_grab_overrun(self):
+        self.nano = StuckSwitchNano(self.pumps)
+        stopped = []
+        stop = self.pumps.stop
+        self.pumps.stop = lambda addr: stopped.append(addr) or stop(addr)
+        grab = self._run(
+            SyringeGrab(
+                self.pumps,
+                self.nano,
+                self.scheduler,
+                ["d4", "d5"],
+                [1, 2],
+                rate_mm=0.5,
+                vol_ml=0.1,
+            )
+        )
+        self.assertEqual(grab.state, HomingState.OVERRUN)
+        self.assertEqual([a.addr for a in grab.failed_axes], [1])
+        self.assertEqual(self.pumps.status(1), "S")
+        # Only the pump still seeking is stopped, the other one grasps its
+        # syringe
+        self.assertEqual(stopped, [2, 1])
+
+    def test_cancelled_with_its_group(self):
+        homing = Homing(
+            self.pumps, self.nano, self.scheduler, ["d2", "d3"], [1, 2], group="reset"
+        ).start()
+        self.assertEqual(homing.state, HomingState.CLEARING)
+        self.scheduler.cancel_group("reset")
+        self.assertEqual(self.scheduler.queue(), [])
+        with self.assertRaises(IOError):
+            Homing(self.pumps, None, self.scheduler, ["d2"], [1]).start()
+
+    def test_cycle_without_phases(self):
+        class NoPhases(HomingCycle):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoPhases(self.pumps, self.nano, self.scheduler, ["d2"], [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
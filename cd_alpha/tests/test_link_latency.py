@@ -0,0 +1,129 @@
+import time
+import unittest
+
+import serial
+
+from cd_alpha import Metrics
+from cd_alpha.LinkLatency import LinkLatency, percentile
+from cd_alpha.NewEraPumps import PumpNetwork
+from cd_alpha.software_testing.PumpEmulator import PumpEmulator
+
+
+class LinkLatencyTestCase(unittest.TestCase):
+    def setUp(self):
+        Metrics.REGISTRY.reset()
+        self.latency = LinkLatency(min_samples=10, recent=5, window=50)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile([3], 0.99), 3)
+
+    def test_timeout_from_round_trips(self):
+        # Nothing known yet
+        self.assertEqual(self.latency.timeout("RUN", 1), 2.0)
+        for n in range(10):
+            self.latency.observe("RUN", 1, 0.02 + n * 0.001)
+        self.assertAlmostEqual(self.latency.timeout("RUN", 1), 0.029 * 3)
+        # Retries back off, the last one waits the ceiling
+        self.assertAlmostEqual(self.latency.timeout("RUN", 1, attempt=2), 0.029 * 12)
+        self.assertEqual(self.latency.timeout("RUN", 1, attempt=9), 2.0)
+        self.assertEqual(self.latency.timeout("RUN", 1, attempt=1, last=True), 2.0)
+        # Borrowed from the other pump, then from all commands
+        self.assertAlmostEqual(self.latency.timeout("RUN", 2), 0.029 * 3)
+        self.assertAlmostEqual(self.latency.timeout("STP", 2), 0.029 * 3)
+
+    def test_floor_and_ceiling(self):
+        for _ in range(10):
+            self.latency.observe("", 1, 0.001)
+            self.latency.observe("DIA", 1, 1.5)
+        self.assertEqual(self.latency.timeout("", 1), 0.05)
+        self.assertEqual(self.latency.timeout("DIA", 1), 2.0)
+
+    def test_drift_is_flagged(self):
+        for _ in range(20):
+            self.latency.observe("RUN", 1, 0.01)
+        self.assertEqual(self.latency.anomalies, [])
+        for _ in range(5):
+            self.latency.observe("RUN", 1, 0.05)
+        self.assertEqual(len(self.latency.anomalies), 1)
+        self.assertEqual(self.latency.anomalies[0]["pump"], 1)
+        self.assertEqual(self.latency.anomalies[0]["recent_s"], 0.05)
+        self.assertEqual(Metrics.serial_latency_anomalies.labels("RUN", 1).value, 1)
+        # The timeout followed the slower link
+        self.assertAlmostEqual(self.latency.timeout("RUN", 1), 0.15)
+        self.assertTrue(self.latency.summary()["RUN/1"]["drifting"])
+        for _ in range(5):
+            self.latency.observe("RUN", 1, 0.01)
+        self.assertFalse(self.latency.summary()["RUN/1"]["drifting"])
+        self.assertEqual(len(self.latency.anomalies), 1)
+
+
+class AdaptiveTimeoutTestCase(unittest.TestCase):
+    """A lost reply on the emulated link at 19200 baud."""
+
+    def setUp(self):
+        self.emulator = PumpEmulator().start()
+        self.addCleanup(self.emulator.close)
+        ser = serial.Serial(self.emulator.path, 19200, timeout=2)
+        self.addCleanup(ser.close)
+        self.pumps = PumpNetwork(ser)
+        for n in range(40):
+            self.pumps.status(n % 2 + 1)
+
+    def test_lost_reply(self):
+        timeout = self.pumps.latency.timeout("STATUS", 1)
+        self.assertLess(timeout, 0.1)
+        self.emulator.lost_replies = 1
+        started = time.perf_counter()
+        self.assertEqual(self.pumps.status(1), "S")
+        self.assertLess(time.perf_counter() - started, timeout + 0.05)
+
+    def test_late_reply_is_dropped(self):
+        self.pumps.set_rate(1, "MM", 1)
+        # Later than the first retries
+        self.emulator.turnaround = 0.3
+        self.assertEqual(self.pumps.get_volume_ml(1), "01S0.000ML")
+        self.emulator.turnaround = 0
+        # The replies of the attempts that timed out are not taken for the
+        # reply to the next command
+        time.sleep(1)
+        self.assertEqual(self.pumps.status(1), "S")
+        self.assertEqual(self.pumps._send_command("RAT", 1), "01S1.00MM")
+
+    def test_link_slows_down_in_a_run(self):
+        self.emulator.turnaround = 0.25
+        # Not taken for the replies of the commands after them
+        self.assertEqual(self.pumps.purge(1, 1), ("01S", "01X"))
+        sent = [command for _, addr, command in self.emulator.history if addr == 1]
+        self.assertEqual(sent.count("PUR"), 1)
+        # Learned from the replies that came in late
+        self.emulator.turnaround = 0.2
+        before = len(self.emulator.history)
+        for _ in range(30):
+            self.assertEqual(self.pumps.status(1), "X")
+        sends = len(self.emulator.history) - before
+        self.assertLess(sends, 36)
+        self.assertGreater(self.pumps.latency.timeout("STATUS", 1), 0.2)
+
+    def test_lost_reply_of_run(self):
+        self.pumps.set_rate(1, "MM", 1)
+        self.pumps.set_volume(1, "ML", 1)
+        self.emulator.lost_replies = 1
+        # The status shows the pump runs, RUN is not sent again
+        self.assertEqual(self.pumps.run(1), "01I")
+        sent = [command for _, addr, command in self.emulator.history if addr == 1]
+        self.assertEqual(sent.count("RUN"), 1)
+
+    def test_lost_pump(self):
+        self.emulator.lost_replies = 10
+        started = time.perf_counter()
+        with self.assertRaises(Exception):
+            self.pumps.status(2)
+        # Three short attempts and the ceiling, not four times the ceiling
+        self.assertLess(time.perf_counter() - started, 2.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import io
+import logging
+import unittest
+
+from cd_alpha.LogPipeline import LogPipeline, LogSink, RateLimitFilter, set_levels
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LogPipelineTestCase(unittest.TestCase):
+    def start(self, name, **kwargs):
+        self.stream = io.StringIO()
+        pipeline = LogPipeline(
+            sinks=[LogSink(self.stream, formatter=logging.Formatter("%(message)s"))],
+            interval=0.01,
+            **kwargs,
+        ).start(name)
+        log = logging.getLogger(name)
+        log.setLevel(logging.DEBUG)
+        self.addCleanup(log.setLevel, logging.NOTSET)
+        return pipeline, log
+
+    def test_lazy_batched_write(self):
+        pipeline, log = self.start("cd_alpha.test_lazy", rate_limits={})
+        calls = []
+
+        class Value:
+            def __str__(self):
+                calls.append(1)
+                return "formatted"
+
+        log.debug("value %s", Value())
+        # Formatting happens on the writer thread
+        self.assertEqual(calls, [])
+        for n in range(100):
+            log.info("record %d", n)
+        pipeline.stop()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(lines[0], "value formatted")
+        self.assertEqual(lines[-1], "record 99")
+        self.assertEqual(len(lines), 101)
+
+    def test_rate_limit(self):
+        clock = FakeClock()
+        limit = RateLimitFilter({"cd_alpha.switches": (1.0, 2)}, clock=clock)
+        record = lambda level=logging.DEBUG: logging.LogRecord(
+            "cd_alpha.switches.d2", level, __file__, 0, "poll", (), None
+        )
+        passed = [limit.filter(record()) for _ in range(5)]
+        self.assertEqual(passed, [True, True, False, False, False])
+        clock.now = 0.5
+        self.assertFalse(limit.filter(record()))
+        clock.now = 1.0
+        allowed = record()
+        self.assertTrue(limit.filter(allowed))
+        self.assertEqual(allowed.suppressed, 4)
+        # Warnings always go through
+        self.assertFalse(limit.filter(record()))
+        self.assertTrue(limit.filter(record(logging.WARNING)))
+        other = logging.LogRecord("cd_alpha.pumps", logging.DEBUG, __file__, 0, "x", (), None)
+        self.assertTrue(all(limit.filter(other) for _ in range(10)))
+
+    def test_subsystem_levels(self):
+        pipeline, log = self.start("cd_alpha", rate_limits={})
+        self.addCleanup(logging.getLogger("cd_alpha.pumps").setLevel, logging.NOTSET)
+        set_levels("pumps=WARNING")
+        logging.getLogger("cd_alpha.pumps").info("hidden")
+        logging.getLogger("cd_alpha.device").info("shown")
+        set_levels("pumps=DEBUG")
+        logging.getLogger("cd_alpha.pumps").debug("shown again")
+        pipeline.stop()
+        self.assertEqual(self.stream.getvalue().splitlines(), ["shown", "shown again"])
+        with self.assertRaises(ValueError):
+            set_levels("pumps=LOUD")
+
+    def test_full_queue_drops(self):
+        pipeline, log = self.start("cd_alpha.test_full", rate_limits={}, queue_size=5)
+        pipeline.writer.stopped.set()
+        pipeline.writer.join()
+        for n in range(10):
+            log.info("record %d", n)
+        self.assertEqual(pipeline.dropped, 5)
+        pipeline.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
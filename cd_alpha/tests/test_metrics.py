@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from cd_alpha import Metrics
+from cd_alpha.NewEraPumps import PumpNetwork
+from cd_alpha.ProtocolExecutor import VirtualClock
+from cd_alpha.StepScheduler import StepScheduler
+
+
+class ScriptedSerial:
+    """Answers every command with the next scripted reply, b"" times out."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.pending = b""
+
+    def write(self, data):
+        self.pending = self.replies.pop(0)
+
+    def readline(self, size):
+        chunk, self.pending = self.pending[:size], self.pending[size:]
+        return chunk
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = Metrics.Registry()
+
+    def test_exposition(self):
+        retries = self.registry.counter("retries", "Retries.", ("command",))
+        retries.labels(command="RUN").inc()
+        retries.labels("RUN").inc(2)
+        latency = self.registry.histogram("rtt_seconds", "RTT.", buckets=(0.01, 0.1))
+        for value in (0.005, 0.01, 0.05, 3):
+            latency.observe(value)
+        text = self.registry.exposition()
+        self.assertIn("# TYPE retries counter", text)
+        self.assertIn('retries_total{command="RUN"} 3', text)
+        self.assertIn('rtt_seconds_bucket{le="0.01"} 2', text)
+        self.assertIn('rtt_seconds_bucket{le="0.1"} 3', text)
+        self.assertIn('rtt_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn("rtt_seconds_count 4", text)
+        with self.assertRaises(ValueError):
+            retries.labels("RUN", "extra")
+        with self.assertRaises(ValueError):
+            self.registry.histogram("retries", "Not a histogram.")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = self.registry.dump(os.path.join(tmp, "run.prom"))
+            self.assertEqual(path.read_text(), text)
+        self.registry.reset()
+        self.assertNotIn("retries_total", self.registry.exposition())
+
+    def test_endpoint(self):
+        self.registry.counter("runs", "Runs.").inc()
+        server = Metrics.MetricsServer(self.registry, port=0).start()
+        self.addCleanup(server.stop)
+        url = f"http://127.0.0.1:{server.port}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            self.assertIn("text/plain", response.headers["Content-Type"])
+            self.assertIn("runs_total 1", response.read().decode())
+
+    def test_pump_network(self):
+        Metrics.REGISTRY.reset()
+        ser = ScriptedSerial(
+            [b"\x0201S\x03", b"", b"\x0201S\x03", b"\x0201S?NA\x03", b"\x0201S?NA\x03"]
+        )
+        pumps = PumpNetwork(ser, max_noof_retries=1)
+        pumps.run(1)
+        # Times out once, then answers
+        pumps.set_diameter(12.55, 1)
+        # Refused twice
+        with self.assertRaises(Exception):
+            pumps._send_command("STP", 1)
+        self.assertEqual(Metrics.serial_rtt.labels("RUN", 1).count, 1)
+        self.assertEqual(Metrics.serial_rtt.labels("DIA", 1).count, 1)
+        self.assertEqual(Metrics.serial_timeouts.labels("DIA", 1).value, 1)
+        self.assertEqual(Metrics.serial_retries.labels("DIA", 1).value, 1)
+        self.assertEqual(Metrics.serial_retries.labels("STP", 1).value, 1)
+        self.assertEqual(Metrics.serial_timeouts.labels("STP", 1).value, 0)
+
+    def test_scheduler_lag_after_reset(self):
+        clock = VirtualClock()
+        # Lives for the whole process like the schedulers of the app
+        scheduler = StepScheduler(clock=clock, name="test_reset")
+        scheduler.call_later(1, lambda dt: None)
+        clock.sleep(1.5)
+        scheduler.run_due()
+        # A new run
+        Metrics.REGISTRY.reset()
+        scheduler.call_later(1, lambda dt: None)
+        clock.sleep(1.25)
+        scheduler.run_due()
+        text = Metrics.REGISTRY.exposition()
+        self.assertIn('cd_alpha_scheduler_lag_seconds_count{scheduler="test_reset"} 1', text)
+        self.assertIn('cd_alpha_scheduler_lag_seconds_sum{scheduler="test_reset"} 0.25', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
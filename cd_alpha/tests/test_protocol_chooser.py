@@ -1,31 +1,51 @@
+import json
+import os
+import tempfile
 import unittest
-from cd_alpha.ChipFlowApp import ProcessWindow
+
+from cd_alpha.software_testing.HeadlessApp import HeadlessApp
+
+TEST_DIR = os.path.dirname(__file__)
 
 
 class ProtocolChooserTestCase(unittest.TestCase):
     def setUp(self):
         # import class and prepare everything here.
-        self.test_window = ProcessWindow(protocol_file_name="v0-protocol-16v1.json")
-        self.test_protocol_location = "v0-protocol-16v1.json"
+        self.test_protocol_location = os.path.join(TEST_DIR, "v0-protocol-16v1.json")
+        self.app = HeadlessApp(self.test_protocol_location)
+        self.addCleanup(self.app.close)
+        self.test_window = self.app.root
 
     # Test a standard protocol load, make sure all steps are present and in the right order
     def test_protocol_load_basic(self):
-        # create a test window and check that all of the required screens are added
+        # create a test window and check that all of the required screens are described
         self.test_window.load_protocol(self.test_protocol_location)
 
-        # For 16v1 there should be 35 screens. {'protocol_chooser': 1, 'home': 1, 'reset_start': 1, 'reset_start_done': 1,
-        # 'insert_syringes': 1, 'grab_syringes': 1, 'grab_syringes_done': 1, 'insert_chip': 1, 'f127': 1, 'flush_1': 1,
-        # 'incubate_1': 1, 'incubate_1_done': 1, 'pbs_1': 1, 'flush_2': 1, 'flush_2_done': 1, 'add_sample': 1, 'flush_3': 1,
-        # 'flush_3_done': 1, 'pbs_2': 1, 'wash_1': 1, 'wash_1_done': 1, 'pbs_3': 1, 'flush_5': 1, 'flush_5_done': 1, 'pbs_4': 1,
-        # 'flush_6': 1, 'flush_6_done': 1, 'qiazol': 1, 'extract_1': 1, 'extract_1_done': 1, 'PBSchase': 1, 'chase_1': 1,
-        # 'remove_kit': 1, 'reset_end': 1, 'reset_end_done': 1}
-        self.assertEqual(len(self.test_window.process_sm.screens), 35)
+        # For 16v1 there should be 34 protocol screens. ['home', 'reset_start', 'reset_start_done',
+        # 'insert_syringes', 'grab_syringes', 'grab_syringes_done', 'insert_chip', 'f127', 'flush_1',
+        # 'incubate_1', 'incubate_1_done', 'pbs_1', 'flush_2', 'flush_2_done', 'add_sample', 'flush_3',
+        # 'flush_3_done', 'pbs_2', 'wash_1', 'wash_1_done', 'pbs_3', 'flush_5', 'flush_5_done', 'pbs_4',
+        # 'flush_6', 'flush_6_done', 'qiazol', 'extract_1', 'extract_1_done', 'PBSchase', 'chase_1',
+        # 'remove_kit', 'reset_end', 'reset_end_done']
+        self.assertEqual(len(self.test_window.process_sm.sequence), 34)
 
         # Check that there are no duplicate steps
-        self.assertFalse(
-            self._find_duplicates(self.test_window.process_sm.screen_names)
+        self.assertFalse(self._find_duplicates(self.test_window.process_sm.sequence))
+
+        # Only the home screen is built on load, next to the protocol chooser
+        self.assertEqual(
+            sorted(self.test_window.process_sm.screen_names), ["home", "protocol_chooser"]
         )
 
+    # Test that walking through a protocol keeps the number of built screens bounded
+    def test_screen_cache_is_bounded(self):
+        self.test_window.load_protocol(self.test_protocol_location)
+        process_sm = self.test_window.process_sm
+        for name in process_sm.sequence:
+            process_sm.show(name)
+            self.assertEqual(process_sm.current, name)
+            self.assertLessEqual(len(process_sm.built_screens), process_sm.cache_size)
+
     # Test that loading protocols multiple times in a row doesn't cause duplicate steps
     def test_protocol_load_multiple(self):
         # create a test window and check that all of the required screens are added
@@ -40,6 +60,33 @@ class ProtocolChooserTestCase(unittest.TestCase):
             self._find_duplicates(self.test_window.process_sm.screen_names)
         )
 
+    # Test that the progress bar follows the protocol that was loaded
+    def test_progress_bar_is_rebuilt(self):
+        previous = self.test_window.overall_progress_bar
+        with open(self.test_protocol_location) as f:
+            protocol = json.load(f)
+        short = {name: protocol[name] for name in list(protocol)[:5]}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "short.json")
+            with open(path, "w") as f:
+                json.dump(short, f)
+            self.test_window.load_protocol(path)
+        progress_bar = self.test_window.overall_progress_bar
+        # The dots that are too many are removed from the same bar
+        self.assertIs(progress_bar, previous)
+        self.assertEqual(len(progress_bar.steps), 5)
+        self.assertEqual(len(progress_bar.children), 5)
+        self.assertEqual(len(self.test_window.progress_screen_names), 5)
+        top_bar = self.test_window.ids.top_bar
+        self.assertIn(progress_bar, top_bar.children)
+        self.assertEqual(
+            len([w for w in top_bar.children if hasattr(w, "set_position")]), 1
+        )
+        self.test_window.process_sm.show("insert_syringes")
+        self.test_window.next_step()
+        self.assertEqual(self.test_window.process_sm.current, "grab_syringes")
+        self.assertEqual(progress_bar.position, 3)
+
     # Test that loading an invalid file raises an error
     def test_load_invalid_file(self):
         with self.assertRaises(FileNotFoundError):
@@ -48,12 +95,12 @@ class ProtocolChooserTestCase(unittest.TestCase):
     # Test that loading an invalid protocol raises an error
     def test_load_invalid_protocol(self):
         with self.assertRaises(TypeError):
-            self.test_window.load_protocol("invalid_protocol.json")
+            self.test_window.load_protocol(os.path.join(TEST_DIR, "invalid_protocol.json"))
 
     def _find_duplicates(self, list_of_values):
         # Check that there are no duplicate steps
         for value in list_of_values:
-            if self.test_window.process_sm.screen_names.count(value) > 1:
+            if list_of_values.count(value) > 1:
                 return True
         return False
 
@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from cd_alpha.protocols.protocol_compiler import (
+    Action,
+    ProtocolError,
+    StepKind,
+    compile_file,
+    compile_protocol,
+)
+
+TEST_DIR = os.path.dirname(__file__)
+PROTOCOL = os.path.join(TEST_DIR, "v0-protocol-16v1.json")
+
+
+class ProtocolCompilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_records_are_resolved(self):
+        compiled = compile_file(PROTOCOL, {"waste": 3, "lysate": 4})
+        self.assertEqual(compiled["home"].kind, StepKind.HOME)
+        flush = compiled["flush_1"].actions[0]
+        self.assertEqual(flush.action, Action.PUMP)
+        self.assertEqual(flush.addrs, (3,))
+        self.assertAlmostEqual(
+            flush.duration, abs(flush.vol_ml / flush.rate) * 3600 + flush.time_s
+        )
+        grab = compiled["grab_syringes"].actions[0]
+        self.assertEqual(grab.switches, ("d4", "d5"))
+        self.assertEqual(grab.addrs, (3, 4))
+        with self.assertRaises(AttributeError):
+            flush.rate = 1
+
+    def test_invalid_protocols(self):
+        with self.assertRaises(TypeError):
+            compile_file(os.path.join(TEST_DIR, "invalid_protocol.json"))
+        step = {"type": "MachineActionScreen", "header": "x"}
+        with self.assertRaises(KeyError):
+            compile_protocol({"a": step})
+        step["action"] = {"PUMP": {"target": "lysate", "vol_ml": 1, "rate_mh": 1}}
+        with self.assertRaises(ProtocolError):
+            compile_protocol({"a": step}, {"waste": 1})
+        step["action"] = {"SHAKE": {}}
+        with self.assertRaises(ProtocolError):
+            compile_protocol({"a": step})
+
+    def test_cache_is_keyed_by_file_hash(self):
+        path = self.tmp / "protocol.json"
+        shutil.copy(PROTOCOL, path)
+        cache = self.tmp / "cache"
+        first = compile_file(path, cache_dir=cache)
+        self.assertEqual(len(list(cache.glob("*.pickle"))), 1)
+        again = compile_file(path, cache_dir=cache)
+        self.assertEqual(again.steps, first.steps)
+        self.assertEqual(again.source_hash, first.source_hash)
+
+        with open(path) as f:
+            protocol = json.load(f)
+        protocol["incubate_1"]["action"]["INCUBATE"]["time"] = 10
+        with open(path, "w") as f:
+            json.dump(protocol, f)
+        changed = compile_file(path, cache_dir=cache)
+        self.assertEqual(changed["incubate_1"].actions[0].duration, 10)
+        self.assertEqual(len(list(cache.glob("*.pickle"))), 2)
+
+    def test_corrupt_cache_entry_is_rebuilt(self):
+        cache = self.tmp / "cache"
+        compile_file(PROTOCOL, cache_dir=cache)
+        (entry,) = cache.glob("*.pickle")
+        entry.write_bytes(b"garbage")
+        compiled = compile_file(PROTOCOL, cache_dir=cache)
+        self.assertEqual(compiled.names[0], "home")
+        self.assertNotEqual(entry.read_bytes(), b"garbage")
+
+    def test_concurrent_writers(self):
+        cache = self.tmp / "cache"
+        compile_file(PROTOCOL, cache_dir=cache)
+        (entry,) = cache.glob("*.pickle")
+        # Half a file of another process writing the same entry
+        other = entry.with_suffix(".tmp")
+        other.write_bytes(b"half")
+        entry.unlink()
+        compile_file(PROTOCOL, cache_dir=cache)
+        self.assertEqual(other.read_bytes(), b"half")
+        self.assertEqual(compile_file(PROTOCOL, cache_dir=cache).names[0], "home")
+        self.assertEqual(list(cache.glob("*.tmp")), [other])
+
+    def test_start_at(self):
+        compiled = compile_file(PROTOCOL).start_at("insert_chip")
+        self.assertEqual(compiled.names[0], "insert_chip")
+        self.assertEqual(compiled.timeline.starts[0], 0)
+        self.assertEqual(len(compiled.timeline), len(compiled))
+        with self.assertRaises(KeyError):
+            compiled.start_at("foobar")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import unittest
+from unittest import mock
+
+from cd_alpha.ProtocolExecutor import (
+    ExecutorState,
+    ProtocolExecutor,
+    VirtualClock,
+    load_protocol,
+    prompt_operator,
+)
+from cd_alpha.protocols.protocol_compiler import StepKind
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class RecordingPumps:
+    def __init__(self):
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return "01S"
+
+        return command
+
+
+class FakeNano:
+    """All switches closed, every syringe is detected right away."""
+
+    def __init__(self):
+        self.d2 = self.d3 = self.d4 = self.d5 = False
+
+    def update(self):
+        pass
+
+
+class ProtocolExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = load_protocol(os.path.join(TEST_DIR, "v0-protocol-16v1.json"))
+        self.pumps = RecordingPumps()
+        self.nano = FakeNano()
+        self.clock = VirtualClock()
+
+    def _executor(self):
+        return ProtocolExecutor(
+            self.protocol,
+            self.pumps,
+            self.nano,
+            clock=self.clock,
+            sleep=self.clock.sleep,
+        )
+
+    def test_runs_every_step_in_order(self):
+        executor = self._executor()
+        self.assertEqual(executor.run(), ExecutorState.FINISHED)
+        started = [e.step for e in executor.events if e.kind == "step_started"]
+        self.assertEqual(started, self.protocol.names)
+
+    def test_incubation_takes_its_time(self):
+        executor = self._executor()
+        executor.run()
+        times = {
+            (e.kind, e.step): e.time
+            for e in executor.events
+            if e.kind in ("step_started", "step_finished")
+        }
+        incubation = self.protocol["incubate_1"].actions[0].duration
+        self.assertAlmostEqual(
+            times[("step_finished", "incubate_1")] - times[("step_started", "incubate_1")],
+            incubation,
+        )
+
+    def test_grab_overrun_fails_and_stops_pumps(self):
+        self.nano.d4 = True  # waste syringe never detected
+        executor = self._executor()
+        self.assertEqual(executor.run(), ExecutorState.FAILED)
+        self.assertEqual(executor.current_step, "grab_syringes")
+        self.assertIn("stop_all_pumps", [c[0] for c in self.pumps.commands])
+        self.assertEqual(executor.scheduler.queue(), [])
+
+    def test_operator_steps_wait_for_continue(self):
+        waiting = []
+        executor = self._executor()
+        executor.on_user_action = lambda ex, name, step: waiting.append(name)
+        executor.start()
+        self.assertEqual(executor.state, ExecutorState.WAITING_USER)
+        self.assertEqual(waiting, ["home"])
+        executor.continue_step()
+        self.assertEqual(executor.current_step, "reset_start")
+        executor.abort()
+        self.assertEqual(executor.state, ExecutorState.ABORTED)
+
+    def test_run_idles_until_the_operator_continues(self):
+        waiting = []
+        executor = self._executor()
+        executor.on_user_action = lambda ex, name, step: waiting.append(name)
+
+        def sleep(seconds):
+            # The operator finishes the step while run() idles
+            self.clock.sleep(seconds)
+            if waiting and executor.state == ExecutorState.WAITING_USER:
+                waiting.pop()
+                executor.continue_step()
+
+        executor.sleep = sleep
+        self.assertEqual(executor.run(), ExecutorState.FINISHED)
+
+    def test_prompt_operator(self):
+        executor = self._executor()
+        executor.on_user_action = prompt_operator
+        with mock.patch("builtins.input", return_value="") as prompt, mock.patch(
+            "builtins.print"
+        ):
+            self.assertEqual(executor.run(), ExecutorState.FINISHED)
+        operator_steps = [s for s in self.protocol if s.kind != StepKind.MACHINE]
+        self.assertEqual(prompt.call_count, len(operator_steps))
+
+    def test_prompt_without_operator_aborts(self):
+        executor = self._executor()
+        executor.on_user_action = prompt_operator
+        with mock.patch("builtins.input", side_effect=EOFError), mock.patch(
+            "builtins.print"
+        ):
+            self.assertEqual(executor.run(), ExecutorState.ABORTED)
+        self.assertEqual(executor.current_step, "home")
+        self.assertIn("stop_all_pumps", [c[0] for c in self.pumps.commands])
+
+
+if __name__ == "__main__":
+    unittest.main()
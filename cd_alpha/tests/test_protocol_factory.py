@@ -0,0 +1,123 @@
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from contextlib import redirect_stderr
+from pathlib import Path
+
+from cd_alpha.ProtocolFactory import (
+    Action,
+    ProtocolFactory,
+    ScreenType,
+    StepBuilder,
+    Sweep,
+    Target,
+    main,
+)
+from cd_alpha.protocols.protocol_compiler import compile_file
+
+TEST_DIR = os.path.dirname(__file__)
+PROTOCOL = os.path.join(TEST_DIR, "v0-protocol-16v1.json")
+
+
+class ProtocolFactoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_round_trip(self):
+        factory = ProtocolFactory.from_file(PROTOCOL)
+        with open(PROTOCOL) as f:
+            self.assertEqual(factory.to_json(), json.load(f, object_pairs_hook=OrderedDict))
+        self.assertAlmostEqual(factory.duration(), compile_file(PROTOCOL).timeline.total)
+
+    def test_step_builder(self):
+        builder = StepBuilder("pbs_1")
+        builder.add_type(ScreenType.MachineActionScreen)
+        builder.add_header("PBS rinse")
+        builder.add_actions([Action("PUMP", target=Target.WASTE, vol_ml=0.5, rate_mh=15)])
+        step = builder.getStep()
+        self.assertEqual(step.duration(), 120)
+        self.assertEqual(
+            step.to_json()["action"],
+            {"PUMP": {"target": "waste", "vol_ml": 0.5, "rate_mh": 15, "eq_time": 0}},
+        )
+        with self.assertRaises(TypeError):
+            Action("INCUBATE", rate_mh=1)
+        with self.assertRaises(TypeError):
+            Action("PUMP", target="waste")
+
+    def test_sweep(self):
+        sweep = Sweep(
+            ProtocolFactory.from_file(PROTOCOL).list_of_steps,
+            {
+                "flush_1.PUMP.rate_mh": [10, 15, 30],
+                "flush_1.PUMP.vol_ml": [0.5, 1.0],
+                "incubate_1.INCUBATE.time": [60, 600],
+            },
+        )
+        self.assertEqual(len(sweep), 12)
+        ranked, count = sweep.generate(self.tmp, "sweep", rank=3)
+        self.assertEqual(count, 12)
+        with open(self.tmp / "manifest.csv") as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 12)
+        for row in rows:
+            compiled = compile_file(self.tmp / row["file"])
+            self.assertAlmostEqual(compiled.timeline.total, float(row["duration_s"]), 1)
+            flush = compiled["flush_1"].actions[0]
+            self.assertEqual(flush.rate, float(row["flush_1.PUMP.rate_mh"]))
+            self.assertEqual(flush.vol_ml, float(row["flush_1.PUMP.vol_ml"]))
+            self.assertAlmostEqual(
+                compiled.timeline.volume_totals()["waste"], float(row["waste_ml"])
+            )
+        durations = [duration for _, duration, _ in ranked]
+        self.assertEqual(durations, sorted(durations))
+        self.assertAlmostEqual(durations[0], min(float(row["duration_s"]) for row in rows))
+        self.assertEqual(
+            ranked[0][2],
+            {
+                "flush_1.PUMP.rate_mh": 30,
+                "flush_1.PUMP.vol_ml": 0.5,
+                "incubate_1.INCUBATE.time": 60,
+            },
+        )
+
+    def test_sweep_of_a_missing_parameter(self):
+        steps = ProtocolFactory.from_file(PROTOCOL).list_of_steps
+        for key in ("nope.PUMP.rate_mh", "incubate_1.PUMP.rate_mh", "flush_1.PUMP.time"):
+            with self.assertRaises(ValueError):
+                Sweep(steps, {key: [1, 2]})
+        stderr = io.StringIO()
+        with redirect_stderr(stderr), self.assertRaises(SystemExit) as exit:
+            main([PROTOCOL, str(self.tmp), "--set", "home.PUMP.rate_mh=1,2"])
+        self.assertEqual(exit.exception.code, 2)
+        self.assertIn("flush_1.PUMP.{target,vol_ml,rate_mh,eq_time}", stderr.getvalue())
+        self.assertEqual(list(self.tmp.iterdir()), [])
+
+    def test_sweep_of_invalid_values(self):
+        steps = ProtocolFactory.from_file(PROTOCOL).list_of_steps
+        for key, values in (
+            ("flush_1.PUMP.rate_mh", [0, 5]),
+            ("flush_1.PUMP.vol_ml", [-0.1]),
+            ("flush_1.PUMP.eq_time", ["soon"]),
+            ("flush_1.PUMP.target", ["drain"]),
+            ("incubate_1.INCUBATE.time", [-60]),
+        ):
+            with self.assertRaises(ValueError):
+                Sweep(steps, {key: values})
+        self.assertEqual(len(Sweep(steps, {"flush_1.PUMP.rate_mh": [-5, 5]})), 2)
+        stderr = io.StringIO()
+        with redirect_stderr(stderr), self.assertRaises(SystemExit) as exit:
+            main([PROTOCOL, str(self.tmp), "--set", "flush_1.PUMP.rate_mh=0,5"])
+        self.assertEqual(exit.exception.code, 2)
+        self.assertIn("flush_1.PUMP.rate_mh=0", stderr.getvalue())
+        self.assertEqual(list(self.tmp.iterdir()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
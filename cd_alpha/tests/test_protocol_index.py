@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from cd_alpha.protocols.protocol_index import ProtocolIndex
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class ProtocolIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.library = self.tmp / "protocols"
+        self.library.mkdir()
+        for name in ("v0-protocol-16v1.json", "invalid_protocol.json"):
+            shutil.copy(os.path.join(TEST_DIR, name), self.library / name)
+        self.index = ProtocolIndex(self.tmp / "index.sqlite")
+        self.addCleanup(self.index.close)
+
+    def test_metadata(self):
+        changed, removed = self.index.refresh(self.library)
+        self.assertEqual(len(changed), 2)
+        invalid, protocol = self.index.entries(self.library)
+        self.assertEqual(protocol.name, "v0-protocol-16v1")
+        self.assertEqual(protocol.version, "16v1")
+        self.assertEqual(protocol.step_count, 24)
+        self.assertGreater(protocol.duration_s, 3600)
+        self.assertGreater(protocol.waste_ml, 0)
+        self.assertTrue(protocol.valid)
+        self.assertFalse(invalid.valid)
+        self.assertIn("TypeError", invalid.error)
+
+    def test_incremental_refresh(self):
+        self.index.refresh(self.library)
+        self.assertEqual(self.index.refresh(self.library), ([], []))
+
+        # A touched file is hashed again but not recompiled
+        path = self.library / "v0-protocol-16v1.json"
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(self.index.refresh(self.library), ([], []))
+
+        path.write_text(path.read_text().replace('"time": 3600', '"time": 60'))
+        changed, _ = self.index.refresh(self.library)
+        self.assertEqual(changed, [str(path.resolve())])
+
+        path.unlink()
+        _, removed = self.index.refresh(self.library)
+        self.assertEqual(removed, [str(path.resolve())])
+        self.assertEqual(len(self.index.entries(self.library)), 1)
+
+    def test_index_persists(self):
+        self.index.refresh(self.library)
+        reopened = ProtocolIndex(self.tmp / "index.sqlite")
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.entries(self.library), self.index.entries(self.library))
+
+
+if __name__ == "__main__":
+    unittest.main()
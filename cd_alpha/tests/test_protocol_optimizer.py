@@ -0,0 +1,71 @@
+import unittest
+
+from cd_alpha.ProtocolFactory import Action, ProtocolFactory, Step
+from cd_alpha.ProtocolOptimizer import Constraints, ProtocolOptimizer
+from cd_alpha.protocols.protocol_compiler import compile_protocol
+
+
+def pump_step(name, vol_ml, rate_mh, target="waste", eq_time=0):
+    return Step(
+        name,
+        header=f"{name} wash",
+        actions=[Action("PUMP", target=target, vol_ml=vol_ml, rate_mh=rate_mh, eq_time=eq_time)],
+    )
+
+
+class ProtocolOptimizerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.constraints = Constraints(
+            {"waste": 12.55, "lysate": 12.55},
+            {"12.55": 30},
+            min_incubation_s={"incubate_1": 300},
+            max_step_vol_ml=1.5,
+        )
+        self.steps = [
+            Step("home", "UserActionScreen", "Home", "Start"),
+            pump_step("pbs_1", 0.5, 15),
+            pump_step("pbs_2", 0.5, 15, eq_time=10),
+            Step("incubate_1", header="Incubate", actions=[Action("INCUBATE", time=1800)]),
+            pump_step("lysate_1", 1.0, 50, target="lysate"),
+            pump_step("lysate_2", 1.0, 50, target="lysate"),
+            Step("done", "UserActionScreen", "Done", "Finished"),
+        ]
+
+    @staticmethod
+    def volume_totals(steps):
+        protocol = ProtocolFactory(steps).to_json()
+        return compile_protocol(protocol).timeline.volume_totals()
+
+    def test_optimize(self):
+        steps, changes, violations = ProtocolOptimizer(self.constraints).optimize(self.steps)
+        self.assertEqual(
+            [s.name for s in steps], ["home", "pbs_1", "incubate_1", "lysate_1", "lysate_2", "done"]
+        )
+        self.assertEqual(self.volume_totals(steps), self.volume_totals(self.steps))
+        merged = steps[1].actions[0]
+        self.assertEqual((merged.vol_ml, merged.rate_mh, merged.eq_time), (1.0, 30, 10))
+        self.assertEqual(steps[2].actions[0].time, 300)
+        # 2 ml would exceed the step limit, the lysate steps stay apart
+        self.assertEqual(steps[3].actions[0].rate_mh, 30)
+        self.assertEqual(violations, [])
+        self.assertEqual(
+            sorted({c.kind for c in changes}), ["incubation", "merge", "rate"]
+        )
+        before = ProtocolFactory(self.steps).duration()
+        after = ProtocolFactory(steps).duration()
+        self.assertLess(after, before)
+        self.assertAlmostEqual(before - after, sum(c.saved_s for c in changes))
+
+    def test_keep_rates(self):
+        steps, changes, _ = ProtocolOptimizer(self.constraints, keep_rates=True).optimize(
+            self.steps
+        )
+        self.assertEqual(steps[1].actions[0].rate_mh, 15)
+        self.assertEqual(steps[1].actions[0].vol_ml, 1.0)
+        # Only the rates above the limit are lowered
+        self.assertEqual([s.actions[0].rate_mh for s in steps[3:5]], [30, 30])
+        self.assertEqual(len([c for c in changes if c.kind == "rate"]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
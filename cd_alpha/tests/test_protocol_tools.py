@@ -0,0 +1,110 @@
+import json
+import os
+import tempfile
+import unittest
+from collections import OrderedDict
+from pathlib import Path
+
+from cd_alpha.protocols.protocol_tools import (
+    COMPLETION_MSG_TIME,
+    INCUBATE,
+    PUMP,
+    USER,
+    ProcessProtocol,
+    ProtocolTimeline,
+    format_duration,
+    timelines_for_directory,
+)
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+def pump_step(target, vol_ml, rate_mh, eq_time=0, **extra):
+    return {
+        "type": "MachineActionScreen",
+        "header": "PBS rinse",
+        "action": {
+            "PUMP": {
+                "target": target,
+                "vol_ml": vol_ml,
+                "rate_mh": rate_mh,
+                "eq_time": eq_time,
+            }
+        },
+        **extra,
+    }
+
+
+def incubate_step(seconds):
+    return {
+        "type": "MachineActionScreen",
+        "header": "Incubate",
+        "action": {"INCUBATE": {"time": seconds}},
+    }
+
+
+class ProtocolTimelineTestCase(unittest.TestCase):
+    def test_step_times(self):
+        protocol = OrderedDict(
+            home={"type": "UserActionScreen"},
+            flush=pump_step("waste", 0.5, 15, eq_time=1, completion_msg="Done"),
+            wait=incubate_step(600),
+        )
+        timeline = ProtocolTimeline.from_protocol(protocol)
+        self.assertEqual(list(timeline.kinds), [USER, PUMP, INCUBATE])
+        flush = 0.5 / 15 * 3600 + 1 + COMPLETION_MSG_TIME
+        self.assertEqual(list(timeline.durations), [0, flush, 600])
+        self.assertEqual(list(timeline.starts), [0, 0, flush])
+        self.assertEqual(timeline.total, flush + 600)
+        self.assertEqual(timeline.eta("flush"), flush)
+        self.assertEqual(timeline.remaining_after("flush"), 600)
+
+    def test_longer_than_a_day(self):
+        protocol = OrderedDict(
+            flush=pump_step("lysate", 1, 1),
+            wait=incubate_step(30 * 3600),
+        )
+        timeline = ProtocolTimeline.from_protocol(protocol)
+        self.assertEqual(timeline.total, 31 * 3600)
+        self.assertEqual(timeline.summary_rows()[0][4], "31:00:00")
+        self.assertEqual(format_duration(90061), "25:01:01")
+
+    def test_pump_volumes(self):
+        protocol = OrderedDict(
+            a=pump_step("waste", 0.5, 15),
+            b=pump_step("lysate", 1.0, 15),
+            c=pump_step("waste", 0.25, -15),
+        )
+        timeline = ProtocolTimeline.from_protocol(protocol)
+        self.assertEqual(timeline.volume_totals(), {"waste": 0.75, "lysate": 1.0})
+        self.assertEqual(list(timeline.cumulative_volumes()[0]), [0.5, 0.5, 0.25])
+
+    def test_switched_steps_are_estimated(self):
+        timeline = ProcessProtocol(os.path.join(TEST_DIR, "v0-protocol-16v1.json")).timeline
+        reset = timeline.index("reset_start")
+        self.assertTrue(timeline.estimated[reset])
+        self.assertGreater(timeline.durations[reset], 0)
+        self.assertFalse(timeline.estimated[timeline.index("incubate_1")])
+
+    def test_directory_matches_single_protocols(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            protocols = {
+                "a.json": OrderedDict(x=pump_step("waste", 1, 10), y=incubate_step(60)),
+                "b.json": OrderedDict(x=incubate_step(5), y=pump_step("lysate", 2, 30)),
+            }
+            for name, protocol in protocols.items():
+                with open(Path(tmp) / name, "w") as f:
+                    json.dump(protocol, f)
+            with open(Path(tmp) / "broken.json", "w") as f:
+                f.write("{")
+            timelines, errors = timelines_for_directory(tmp)
+        self.assertEqual([p.name for p in errors], ["broken.json"])
+        for path, timeline in timelines.items():
+            single = ProtocolTimeline.from_protocol(protocols[path.name])
+            self.assertEqual(list(timeline.starts), list(single.starts))
+            self.assertEqual(list(timeline.ends), list(single.ends))
+            self.assertEqual(timeline.volume_totals(), single.volume_totals())
+
+
+if __name__ == "__main__":
+    unittest.main()
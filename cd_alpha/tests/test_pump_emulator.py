@@ -0,0 +1,115 @@
+import os
+import time
+import unittest
+
+import serial
+
+from cd_alpha.NewEraPumps import PumpNetwork
+from cd_alpha.ProtocolExecutor import (
+    ExecutorState,
+    ProtocolExecutor,
+    VirtualClock,
+    load_protocol,
+)
+from cd_alpha.software_testing.PumpEmulator import PumpEmulator
+from cd_alpha.software_testing.SimulatedHardware import (
+    HOME_POSITION_ML,
+    SimulatedNano,
+)
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class PumpEmulatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.emulator = self._emulator(byte_time=0, turnaround=0)
+        self.ser = self._serial(self.emulator)
+        self.pumps = PumpNetwork(self.ser, max_noof_retries=0)
+
+    def _emulator(self, **kwargs):
+        emulator = PumpEmulator(clock=self.clock, **kwargs).start()
+        self.addCleanup(emulator.close)
+        return emulator
+
+    def _serial(self, emulator):
+        ser = serial.Serial(emulator.path, 19200, timeout=0.5)
+        self.addCleanup(ser.close)
+        return ser
+
+    def _raw(self, command):
+        self.ser.write(command)
+        return self.ser.read_until(b"\x03")
+
+    def test_dispenses_its_volume(self):
+        self.assertEqual(self.pumps.status(1), "S")
+        self.pumps.set_diameter(12.55, 1)
+        self.pumps.set_rate(0.5, "MM", 1)
+        self.pumps.set_volume(0.25, "ML", 1)
+        self.assertEqual(self.pumps.get_volume_ml(1), "01S0.250ML")
+        self.assertEqual(self._raw(b"1RAT\r"), b"\x0201S0.50MM\x03")
+        self.pumps.run(1)
+        self.assertEqual(self.pumps.status(1), "I")
+        self.assertEqual(self.pumps.status(2), "S")
+        self.clock.sleep(29)
+        self.assertEqual(self.pumps.status(1), "I")
+        self.clock.sleep(2)
+        self.assertEqual(self.pumps.status(1), "S")
+        self.assertEqual(self._raw(b"1DIS\r"), b"\x0201SI0.250W0.000ML\x03")
+
+    def test_purge_and_stop(self):
+        self.pumps.purge(-1, 2)
+        self.assertEqual(self.pumps.status(2), "X")
+        self.clock.sleep(60)
+        self.pumps.stop(2)
+        self.assertEqual(self.pumps.status(2), "S")
+        self.assertLess(self.emulator.pumps[2].position_ml, 2.0)
+        # The SimulatedNano reads the emulated plungers
+        nano = SimulatedNano(self.emulator)
+        self.pumps.purge(-1, 2)
+        self.clock.sleep(60)
+        nano.update()
+        self.assertFalse(nano.d3)
+        self.assertLess(self.emulator.pumps[2].position(self.clock()), HOME_POSITION_ML)
+
+    def test_errors(self):
+        self.pumps.purge(1, 1)
+        self.assertEqual(self._raw(b"1PUR\r"), b"\x0201X?NA\x03")
+        self.assertEqual(self._raw(b"1DIA20\r"), b"\x0201X?NA\x03")
+        self.assertEqual(self._raw(b"2DIA99\r"), b"\x0202S?OOR\x03")
+        self.assertEqual(self._raw(b"2FOO\r"), b"\x0202S?\x03")
+        with self.assertRaises(Exception):
+            self.pumps.purge(1, 1)
+        # No pump at 3, nobody answers
+        self.assertEqual(self._raw(b"3\r"), b"")
+        with self.assertRaises(Exception):
+            self.pumps.status(3)
+
+    def test_reply_latency(self):
+        emulator = self._emulator(byte_time=0.002, turnaround=0.05)
+        pumps = PumpNetwork(self._serial(emulator))
+        pumps.status(1)
+        started = time.perf_counter()
+        pumps.status(1)
+        rtt = time.perf_counter() - started
+        # "1\r" in, "\x0201S\x03" out
+        self.assertGreaterEqual(rtt, 0.05 + 7 * 0.002)
+        self.assertLess(rtt, 1)
+
+    def test_protocol_over_serial(self):
+        protocol = load_protocol(os.path.join(TEST_DIR, "v0-protocol-16v1.json"))
+        executor = ProtocolExecutor(
+            protocol,
+            PumpNetwork(self.ser),
+            SimulatedNano(self.emulator),
+            clock=self.clock,
+            sleep=self.clock.sleep,
+        )
+        self.assertEqual(executor.run(), ExecutorState.FINISHED)
+        self.assertGreater(self.emulator.commands, 50)
+        for addr in (1, 2):
+            self.assertLessEqual(self.emulator.pumps[addr].position_ml, HOME_POSITION_ML)
+
+
+if __name__ == "__main__":
+    unittest.main()
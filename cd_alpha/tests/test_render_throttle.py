@@ -0,0 +1,96 @@
+import unittest
+
+from cd_alpha.ProtocolExecutor import VirtualClock
+from cd_alpha.RenderThrottle import ThrottledProperties
+
+
+class Widget:
+    def __init__(self):
+        self.text = ""
+        self.progress = 0
+        self.sets = []
+
+    def __setattr__(self, name, value):
+        if name != "sets" and hasattr(self, "sets"):
+            self.sets.append((name, value))
+        super().__setattr__(name, value)
+
+
+class Call:
+    def __init__(self, callback, delay):
+        self.callback = callback
+        self.delay = delay
+        self.cancelled = False
+
+
+class ThrottledPropertiesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.scheduled = []
+        self.widget = Widget()
+        self.render = ThrottledProperties(
+            self.widget,
+            1.0,
+            self.schedule,
+            self.clock,
+        )
+
+    def schedule(self, delay, callback):
+        call = Call(callback, delay)
+        self.scheduled.append(call)
+        return call
+
+    def test_only_changes_are_pushed(self):
+        self.render.update(text="01:00", progress=0)
+        self.assertEqual(self.widget.sets, [("text", "01:00")])
+        self.clock.sleep(1)
+        self.render.update(text="01:00", progress=0)
+        self.assertEqual(len(self.widget.sets), 1)
+        self.assertEqual(self.render.renders, 1)
+
+    def test_renders_are_capped(self):
+        self.render.update(text="01:00")
+        self.clock.sleep(0.5)
+        self.render.update(text="00:59", progress=1)
+        self.render.update(text="00:59", progress=2)
+        # Due in half a second, scheduled once
+        self.assertEqual(len(self.scheduled), 1)
+        call = self.scheduled[0]
+        self.assertAlmostEqual(call.delay, 0.5)
+        self.assertEqual(self.widget.text, "01:00")
+        self.clock.sleep(call.delay)
+        call.callback(call.delay)
+        self.assertEqual(self.widget.text, "00:59")
+        self.assertEqual(self.widget.progress, 2)
+        self.assertEqual(self.render.renders, 2)
+
+    def test_flush(self):
+        self.render.update(text="01:00")
+        self.render.update(text="00:00", progress=100)
+        self.render.flush()
+        self.assertEqual(self.widget.progress, 100)
+        # The scheduled render has nothing left to push
+        self.scheduled[0].callback(0.5)
+        self.assertEqual(self.render.renders, 2)
+
+    def test_value_back_to_shown(self):
+        self.render.update(text="01:00")
+        self.render.update(text="00:59")
+        self.render.update(text="01:00")
+        self.scheduled[0].callback(1)
+        self.assertEqual(self.render.renders, 1)
+
+    def test_cancelled_render(self):
+        self.render.update(text="01:00")
+        self.render.update(text="00:59")
+        # Left the step, its timers are cancelled
+        self.scheduled[0].cancelled = True
+        self.assertFalse(self.render.scheduled)
+        self.clock.sleep(0.5)
+        self.render.update(text="00:58")
+        self.assertEqual(len(self.scheduled), 2)
+        self.assertAlmostEqual(self.scheduled[1].delay, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import serial
+
+from cd_alpha.software_testing.HeadlessApp import HeadlessApp
+from cd_alpha.software_testing.RunReplay import RunReplay
+
+from cd_alpha.NewEraPumps import PumpNetwork
+from cd_alpha.ProtocolExecutor import VirtualClock
+from cd_alpha.RunRecording import RunRecorder, read_recording
+from cd_alpha.software_testing.PumpEmulator import PumpEmulator
+from cd_alpha.software_testing.SimulatedHardware import SimulatedNano
+
+TEST_DIR = os.path.dirname(__file__)
+PROTOCOL = os.path.join(TEST_DIR, "v0-protocol-16v1.json")
+
+
+class StuckGrabNano(SimulatedNano):
+    """The waste syringe is never detected."""
+
+    def update(self):
+        super().update()
+        self.d4 = True
+
+
+class RunRecorderTestCase(unittest.TestCase):
+    def test_written_by_the_writer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            recorder = RunRecorder(interval=60)
+            path = recorder.start(os.path.join(tmp, "run.jsonl"), device="V0")
+            recorder.pump(b"1RUN\r", b"\x0201S\x03", 0.01, t=recorder.clock())
+            recorder.operator("next", "home")
+            # Queued, nothing written by the caller
+            self.assertEqual(os.path.getsize(path), 0)
+            recorder.finish("finished")
+            header, events, end = read_recording(path)
+        self.assertEqual(header["device"], "V0")
+        self.assertEqual(events[0]["rx"], "\x0201S\x03")
+        self.assertEqual(events[1]["action"], "next")
+        self.assertEqual(end["outcome"], "finished")
+
+
+class RunReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="cd_alpha_replay_test_")
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _record(self, operate, nano_class=SimulatedNano):
+        """Run the app on the pump emulator, returns the recording."""
+        clock = VirtualClock()
+        emulator = PumpEmulator(byte_time=0, turnaround=0, clock=clock).start()
+        self.addCleanup(emulator.close)
+        ser = serial.Serial(emulator.path, 19200, timeout=0.5)
+        self.addCleanup(ser.close)
+        app = HeadlessApp(
+            PROTOCOL,
+            data_dir=os.path.join(self.tmp, "field"),
+            clock=clock,
+            pumps=PumpNetwork(ser),
+            nano=nano_class(emulator),
+        )
+        try:
+            app.press_next()
+            operate(app)
+            return app.cfa.recorder.path
+        finally:
+            app.close()
+
+    def _replay(self, recording):
+        replay = RunReplay(recording, data_dir=os.path.join(self.tmp, "replay"))
+        try:
+            return replay.run()
+        finally:
+            replay.close()
+
+    def _hardware(self, path):
+        header, events, end = read_recording(path)
+        return [
+            {k: v for k, v in e.items() if k not in ("t", "rtt")}
+            for e in events
+            if e["kind"] in ("pump", "nano")
+        ]
+
+    def test_replays_a_run_with_a_skip(self):
+        def operate(app):
+            app.run_to_screen("incubate_1")
+            app.advance(30)
+            app.skip()
+            app.run_to_screen(app.screen_manager.sequence[0])
+
+        recording = self._record(operate)
+        header, events, end = read_recording(recording)
+        self.assertEqual(end["outcome"], "finished")
+        actions = [e["action"] for e in events if e["kind"] == "operator"]
+        self.assertIn("skip", actions)
+        self.assertTrue(any(e["kind"] == "nano" for e in events))
+
+        summary = self._replay(recording)
+        self.assertEqual(summary["divergences"], [])
+        self.assertEqual(summary["outcome"], "finished")
+        self.assertAlmostEqual(summary["run_s"], end["t"], delta=1)
+        # The same commands, replies and switch reads as the original
+        replayed = os.path.join(self.tmp, "replay", "recordings")
+        replayed = os.path.join(replayed, os.listdir(replayed)[0])
+        self.assertEqual(self._hardware(replayed), self._hardware(recording))
+
+    def test_reproduces_a_grab_overrun(self):
+        def operate(app):
+            app.run_to_screen("grab_syringes")
+            app.run_until(lambda: not app.cfa.recorder.active, 3600)
+
+        recording = self._record(operate, nano_class=StuckGrabNano)
+        self.assertEqual(read_recording(recording)[2]["outcome"], "failed")
+        # No stuck switch here, the recorded reads are replayed
+        summary = self._replay(recording)
+        self.assertEqual(summary["outcome"], "failed")
+        self.assertEqual(summary["divergences"], [])
+
+    def test_divergence_is_reported(self):
+        recording = self._record(lambda app: app.abort())
+        lines = open(recording).read().splitlines()
+        # Drop the first pump command from the recording
+        first = next(n for n, line in enumerate(lines) if '"kind": "pump"' in line)
+        tampered = os.path.join(self.tmp, "tampered.jsonl")
+        with open(tampered, "w") as f:
+            f.write("\n".join(lines[:first] + lines[first + 1 :]) + "\n")
+        summary = self._replay(tampered)
+        # The command times out, which stops the app like on the device
+        self.assertEqual(summary["outcome"], "crashed")
+        self.assertIsNotNone(summary["error"])
+        self.assertEqual(
+            json.loads(lines[first])["tx"], summary["divergences"][0]["command"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
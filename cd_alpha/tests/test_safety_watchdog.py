@@ -0,0 +1,281 @@
+import io
+import json
+import os
+import time
+import unittest
+
+import serial
+
+from cd_alpha.NewEraPumps import PumpNetwork
+from cd_alpha.ProtocolExecutor import VirtualClock
+from cd_alpha.SafetyWatchdog import SafetyLink, SafetyWatchdog
+from cd_alpha.software_testing.PumpEmulator import PumpEmulator
+
+# Stop latency allowed on top of the fault detection, the watchdog process
+# is polled by select and the stop is two commands at 19200 baud
+STOP_LATENCY = 0.3
+# Until the replies to the stops of the watchdog are in
+STOP_REPLY_WAIT = 0.2
+
+
+class FakeSerial:
+    def __init__(self):
+        self.written = []
+        self.in_waiting = 0
+
+    def write(self, data):
+        self.written.append(data)
+
+    def flush(self):
+        pass
+
+    def read(self, size=1):
+        raise AssertionError("the watchdog read the replies of the app")
+
+
+class FakeStream:
+    """The pipe from an app that died."""
+
+    def __init__(self):
+        self.read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+
+    def fileno(self):
+        return self.read_fd
+
+
+class SafetyWatchdogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.ser = FakeSerial()
+        self.watchdog = SafetyWatchdog(
+            self.ser, [1, 2], heartbeat_timeout=3, grace=5, clock=self.clock
+        )
+
+    def test_heartbeat_loss_stops_all_pumps(self):
+        self.clock.sleep(2)
+        self.watchdog.feed({"hb": 1})
+        self.clock.sleep(2)
+        self.assertEqual(self.watchdog.check(), [])
+        self.assertEqual(self.watchdog.next_deadline(), 5)
+        self.clock.sleep(1.5)
+        self.assertEqual(self.watchdog.check(), [1, 2])
+        self.assertEqual(self.ser.written, [b"1STP\r", b"2STP\r"])
+        # Stopped once, not on every check while the app is hung
+        self.clock.sleep(10)
+        self.assertEqual(self.watchdog.check(), [])
+        self.watchdog.feed({"hb": 1})
+        self.assertFalse(self.watchdog.hung)
+
+    def test_overrun_stops_the_pump(self):
+        self.watchdog.feed({"arm": 2, "for": 10})
+        self.assertEqual(self.watchdog.next_deadline(), 3)
+        for _ in range(13):
+            self.clock.sleep(1)
+            self.watchdog.feed({"hb": 1})
+            self.assertEqual(self.watchdog.check(), [])
+        self.clock.sleep(2.5)
+        self.watchdog.feed({"hb": 1})
+        self.assertEqual(self.watchdog.check(), [2])
+        self.assertEqual(self.ser.written, [b"2STP\r"])
+        self.assertEqual(self.watchdog.trips[0]["reason"], "past the planned end of the step")
+
+    def test_disarm(self):
+        self.watchdog.feed({"arm": 1, "for": 1})
+        self.watchdog.feed({"arm": 2, "for": 1})
+        self.watchdog.feed({"disarm": 1})
+        self.clock.sleep(2.5)
+        self.watchdog.feed({"disarm": None})
+        self.clock.sleep(2.5)
+        self.watchdog.feed({"hb": 1})
+        self.assertEqual(self.watchdog.check(), [])
+        self.assertEqual(self.ser.written, [])
+
+    def test_app_death_stops_all_pumps(self):
+        stream = FakeStream()
+        self.addCleanup(os.close, stream.read_fd)
+        self.assertFalse(self.watchdog.serve(stream))
+        self.assertEqual(self.ser.written, [b"1STP\r", b"2STP\r"])
+        self.assertEqual(self.watchdog.trips[0]["reason"], "the app died")
+
+    def test_stops_are_reported(self):
+        self.watchdog.report = io.StringIO()
+        self.watchdog.feed({"arm": 2, "for": 1})
+        self.clock.sleep(2.5)
+        self.watchdog.check()
+        self.clock.sleep(1)
+        self.watchdog.check()
+        reports = self.watchdog.report.getvalue().splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in reports],
+            [
+                {"trip": [1, 2], "reason": "no heartbeat for 3.5 s"},
+            ],
+        )
+
+
+class SafetyLinkTestCase(unittest.TestCase):
+    def test_armed_past_the_planned_end(self):
+        clock = VirtualClock()
+        # No watchdog process, the messages go nowhere
+        link = SafetyLink("/dev/null", [1, 2], clock=clock)
+        link.arm(1, 10)
+        link.arm(2, 20)
+        clock.sleep(10)
+        self.assertEqual(link.poll(), [])
+        # Only disarmed once the app read the pump as stopped
+        self.assertEqual(link.overdue(), [1])
+        self.assertEqual(sorted(link.planned), [1, 2])
+        link.disarm(1)
+        self.assertEqual(link.overdue(), [])
+        link.disarm()
+        self.assertEqual(link.planned, {})
+
+
+class FaultToStopTestCase(unittest.TestCase):
+    """The watchdog process against the pump emulator at 19200 baud."""
+
+    def setUp(self):
+        self.emulator = PumpEmulator().start()
+        self.addCleanup(self.emulator.close)
+        ser = serial.Serial(self.emulator.path, 19200, timeout=0.5)
+        self.addCleanup(ser.close)
+        # The app, on a handle of its own
+        self.pumps = PumpNetwork(ser)
+
+    def _link(self, **kwargs):
+        link = SafetyLink(self.emulator.path, [1, 2], **kwargs).start()
+        self.addCleanup(link.close)
+        return link
+
+    def _run_pumps(self):
+        for addr in (1, 2):
+            self.pumps.set_rate(1, "MM", addr)
+            self.pumps.set_volume(1, "ML", addr)
+            self.pumps.run(addr)
+        self.assertEqual(self.pumps.status(1), "I")
+
+    def _stopped_after(self, fault, timeout=5):
+        """Seconds from ``fault`` until both pumps got their STP."""
+        deadline = fault + timeout
+        while time.perf_counter() < deadline:
+            stops = {
+                addr: t
+                for t, addr, command in list(self.emulator.history)
+                if command == "STP" and t > fault
+            }
+            if len(stops) == 2:
+                # The replies to the stops are on the port of the app
+                time.sleep(STOP_REPLY_WAIT)
+                self.pumps.discard_replies()
+                return max(stops.values()) - fault
+            time.sleep(0.01)
+        self.fail("the pumps were not stopped")
+
+    def _trips(self, link, timeout=2):
+        """The stops of both pumps reported to the app, polled like its main
+        loop does."""
+        trips = []
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            trips += link.poll()
+            if sorted(addr for trip in trips for addr in trip["trip"]) == [1, 2]:
+                return trips
+            time.sleep(0.05)
+        self.fail("the stops were not reported")
+
+    def test_app_crash(self):
+        link = self._link()
+        link.heartbeat()
+        self._run_pumps()
+        # The app dies without a goodbye
+        fault = time.perf_counter()
+        link.process.stdin.close()
+        self.assertLess(self._stopped_after(fault), STOP_LATENCY)
+        self.assertEqual(self.pumps.status(1), "S")
+        self.assertEqual(self.pumps.status(2), "S")
+        link.process.wait(5)
+        link.process.stdout.close()
+        link.process = None
+
+    def test_app_hang(self):
+        link = self._link(heartbeat_timeout=0.5)
+        # The last heartbeat
+        fault = time.perf_counter()
+        link.heartbeat()
+        self._run_pumps()
+        self.assertLess(self._stopped_after(fault), 0.5 + STOP_LATENCY)
+        self.assertEqual(self.pumps.status(2), "S")
+        # Reported once the main loop is back
+        [trip] = self._trips(link)
+        self.assertEqual(trip["trip"], [1, 2])
+        self.assertTrue(trip["reason"].startswith("no heartbeat"))
+
+    def test_overrun(self):
+        link = self._link(grace=0)
+        self._run_pumps()
+        fault = time.perf_counter() + 0.3
+        link.arm(1, 0.3)
+        link.arm(2, 0.3)
+        for _ in range(5):
+            link.heartbeat()
+            time.sleep(0.1)
+        self.assertLess(self._stopped_after(fault), STOP_LATENCY)
+        self.assertTrue(link.alive)
+        self.assertEqual(self.pumps.status(1), "S")
+        for trip in self._trips(link):
+            self.assertEqual(trip["reason"], "past the planned end of the step")
+
+    def _confirm_stopped(self, link, seconds):
+        """The main loop of a responsive app, it disarms the overdue pumps it
+        reads as stopped. Returns the stops reported meanwhile."""
+        trips = []
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            polled = link.poll()
+            if polled:
+                time.sleep(STOP_REPLY_WAIT)
+                self.pumps.discard_replies()
+            trips += polled
+            for addr in link.overdue():
+                if self.pumps.status(addr) == "S":
+                    link.disarm(addr)
+            time.sleep(0.05)
+        return trips
+
+    def test_pump_running_past_its_end(self):
+        # The pump does not stop on a skip, the app keeps its heartbeat
+        link = self._link(grace=0.3)
+        self._run_pumps()
+        fault = time.perf_counter() + 0.2 + 0.3
+        link.arm(1, 0.2)
+        link.arm(2, 0.2)
+        trips = self._confirm_stopped(link, 1)
+        self.assertLess(self._stopped_after(fault), STOP_LATENCY)
+        # Armed one after the other, the pumps may be stopped apart
+        self.assertEqual(sorted(addr for trip in trips for addr in trip["trip"]), [1, 2])
+        for trip in trips:
+            self.assertEqual(trip["reason"], "past the planned end of the step")
+        self.assertEqual(self.pumps.status(1), "S")
+
+    def test_stopped_pump_is_disarmed(self):
+        link = self._link(grace=0.3)
+        for addr in (1, 2):
+            self.pumps.set_rate(60, "MM", addr)
+            self.pumps.set_volume(0.1, "ML", addr)
+            self.pumps.run(addr)
+            link.arm(addr, 0.2)
+        self.assertEqual(self._confirm_stopped(link, 0.8), [])
+        self.assertEqual(link.planned, {})
+        self.assertFalse(any(c == "STP" for _, _, c in self.emulator.history))
+
+    def test_clean_exit_leaves_the_pumps(self):
+        link = self._link()
+        self._run_pumps()
+        link.close()
+        self.assertEqual(self.pumps.status(1), "I")
+        self.assertFalse(any(c == "STP" for _, _, c in self.emulator.history))
+
+
+if __name__ == "__main__":
+    unittest.main()
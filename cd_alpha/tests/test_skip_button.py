@@ -1,15 +1,35 @@
+import os
 import unittest
-from cd_alpha.ChipFlowApp import ProcessWindow
+
+from cd_alpha.software_testing.HeadlessApp import HeadlessApp
+
+TEST_DIR = os.path.dirname(__file__)
 
 
 class SkipButtonTestCase(unittest.TestCase):
     def setUp(self):
-        # import class and prepare everything here.
-        self.test_window = ProcessWindow(protocol_file_name="v0-protocol-16v1.json")
-        self.test_protocol_location = "v0-protocol-16v1.json"
+        self.app = HeadlessApp(os.path.join(TEST_DIR, "v0-protocol-16v1.json"))
+        self.addCleanup(self.app.close)
 
     def test_skip_and_reschedule(self):
-        pass
+        self.app.run_to_screen("incubate_1")
+        deadline = self.app.current_screen.step_deadline
+        self.app.advance(10)
+        self.app.skip()
+        self.assertEqual(self.app.current, "incubate_1_done")
+        # The timer of the skipped step does not fire later on
+        self.app.run_to_screen("flush_2")
+        self.app.advance(deadline - self.app.clock() + 1)
+        entered = [name for name, _ in self.app.screens]
+        self.assertEqual(entered.count("incubate_1_done"), 1)
+        self.assertEqual(entered.count("pbs_1"), 1)
+        self.assertNotIn("incubate_1", self.app.cfa.boundary_scheduler.groups())
+
+    def test_no_skip_while_pumping(self):
+        self.app.run_to_screen("flush_1")
+        self.app.advance(1)
+        self.app.skip()
+        self.assertEqual(self.app.current, "flush_1")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+import threading
+import time
+import unittest
+
+from cd_alpha.StepScheduler import StepScheduler, ThreadWaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class StepSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.armed = []
+        self.scheduler = StepScheduler(clock=self.clock, waker=self.armed.append)
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        return self.scheduler.run_due()
+
+    def test_one_shot_runs_once(self):
+        calls = []
+        self.scheduler.call_later(1.0, calls.append)
+        self.assertEqual(self.armed[-1], 1.0)
+        self.advance(0.5)
+        self.assertEqual(calls, [])
+        self.advance(0.5)
+        self.assertEqual(calls, [1.0])
+        self.advance(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.scheduler.queue(), [])
+
+    def test_interval_stops_when_returning_false(self):
+        ticks = []
+
+        def poll(dt):
+            ticks.append(dt)
+            return False if len(ticks) == 3 else None
+
+        self.scheduler.call_every(0.1, poll, group="reset")
+        for _ in range(10):
+            self.advance(0.1)
+        self.assertEqual(len(ticks), 3)
+        self.assertEqual(self.scheduler.queue(), [])
+
+    def test_interval_deadlines_do_not_drift(self):
+        call = self.scheduler.call_every(0.5, lambda dt: None)
+        start = call.deadline
+        # A stalled frame skips the missed ticks instead of shifting the grid
+        self.advance(0.5)
+        self.advance(1.7)
+        self.assertAlmostEqual(call.deadline, start + 2.0)
+
+    def test_cancel_group(self):
+        calls = []
+        self.scheduler.call_every(0.1, calls.append, group="grab")
+        self.scheduler.call_later(20, calls.append, group="grab")
+        other = self.scheduler.call_later(1, calls.append, group="done")
+        self.scheduler.cancel_group("grab")
+        self.assertEqual(self.scheduler.queue(), [other])
+        self.assertEqual(self.scheduler.groups(), {"done"})
+
+    def test_cancel_all_leaves_nothing(self):
+        for n in range(5):
+            self.scheduler.call_every(0.1 * (n + 1), lambda dt: None, group=n)
+        self.scheduler.cancel_all()
+        self.assertEqual(self.scheduler.queue(), [])
+        self.assertEqual(self.advance(10), 0)
+        self.assertIsNone(self.armed[-1])
+
+    def test_coalesces_calls_due_together(self):
+        calls = []
+        self.scheduler.call_every(0.1, lambda dt: calls.append("d2"))
+        self.clock.now += 0.002
+        self.scheduler.call_every(0.1, lambda dt: calls.append("d3"))
+        wakeups = self.scheduler.wakeups
+        self.advance(0.1)
+        self.assertEqual(calls, ["d2", "d3"])
+        self.assertEqual(self.scheduler.wakeups, wakeups + 1)
+
+    def test_callback_can_cancel_its_group(self):
+        calls = []
+
+        def first(dt):
+            calls.append("first")
+            self.scheduler.cancel_group("step")
+
+        self.scheduler.call_later(1, first, group="step")
+        self.scheduler.call_later(1, lambda dt: calls.append("second"), group="step")
+        self.advance(1)
+        self.assertEqual(calls, ["first"])
+
+    def test_interval_can_cancel_its_own_group(self):
+        calls = []
+
+        def poll(dt):
+            calls.append(dt)
+            self.scheduler.cancel_group("step")
+
+        self.scheduler.call_every(0.1, poll, group="step")
+        self.advance(0.1)
+        self.advance(0.1)
+        self.assertEqual(len(calls), 1)
+
+
+class ThreadWakerTestCase(unittest.TestCase):
+    def test_deadline_fires_from_timing_thread(self):
+        scheduler = StepScheduler()
+        waker = ThreadWaker(scheduler)
+        self.addCleanup(waker.stop)
+        fired = threading.Event()
+        fired_at = []
+
+        def boundary(dt):
+            fired_at.append(time.monotonic())
+            fired.set()
+
+        deadline = time.monotonic() + 0.05
+        scheduler.call_at(deadline, boundary)
+        # A stalled main thread does not delay the boundary
+        time.sleep(0.2)
+        self.assertTrue(fired.wait(1))
+        self.assertLess(fired_at[0] - deadline, 0.05)
+        self.assertGreaterEqual(fired_at[0], deadline - scheduler.coalesce_window)
+
+
+if __name__ == "__main__":
+    unittest.main()
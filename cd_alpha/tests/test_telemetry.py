@@ -0,0 +1,76 @@
+import os
+import unittest
+
+from cd_alpha.ProtocolExecutor import ProtocolExecutor, VirtualClock, load_protocol
+from cd_alpha.Telemetry import TelemetryRecorder, command_statistics, step_statistics
+from cd_alpha.software_testing.NanoControllerTestStub import Nano
+from cd_alpha.software_testing.NewEraPumpsTestStub import PumpNetwork
+from cd_alpha.software_testing.SerialStub import SerialStub
+
+TEST_DIR = os.path.dirname(__file__)
+PROTOCOL = os.path.join(TEST_DIR, "v0-protocol-16v1.json")
+
+
+class TelemetryTestCase(unittest.TestCase):
+    def record_run(self, recorder, abort_at=None):
+        clock = VirtualClock()
+        recorder.clock = clock
+        protocol = load_protocol(PROTOCOL)
+        pumps = PumpNetwork(SerialStub())
+        pumps.command_listener = recorder.pump_command
+        executor = ProtocolExecutor(
+            protocol, pumps, Nano(8, 7), clock=clock, sleep=clock.sleep
+        )
+        if abort_at is not None:
+            executor.subscribe(
+                lambda event: event.kind == "step_started"
+                and event.step == abort_at
+                and executor.abort("test")
+            )
+        recorder.start_run(protocol, "16v1", "V0", t=clock())
+        executor.subscribe(recorder.on_executor_event)
+        return executor.run()
+
+    def test_runs(self):
+        recorder = TelemetryRecorder(":memory:")
+        self.record_run(recorder)
+        self.record_run(recorder)
+        self.record_run(recorder, abort_at="flush_2")
+        self.assertFalse(recorder.active)
+
+        outcomes = recorder.db.execute(
+            "SELECT outcome, abort_cause FROM runs ORDER BY id"
+        ).fetchall()
+        self.assertEqual(
+            outcomes, [("finished", None), ("finished", None), ("aborted", "test")]
+        )
+
+        stats = step_statistics(recorder.db, protocol="16v1")
+        self.assertEqual(stats["incubate_1"]["runs"], 3)
+        self.assertEqual(stats["flush_3"]["runs"], 2)
+        # Simulated time runs exactly to plan
+        self.assertAlmostEqual(stats["incubate_1"]["overrun_mean_s"], 0)
+        self.assertLess(stats["reset_start"]["overrun_mean_s"], 0)
+
+        commands = command_statistics(recorder.db)
+        self.assertIn("RUN", commands)
+        self.assertEqual(commands["RUN"]["errors"], 0)
+        switches = recorder.db.execute(
+            "SELECT step, switch FROM switches WHERE run_id = 1 ORDER BY time"
+        ).fetchall()
+        self.assertEqual(set(switches[:2]), {("reset_start", "d2"), ("reset_start", "d3")})
+
+    def test_command_names(self):
+        # Named like the pump metrics
+        recorder = TelemetryRecorder(":memory:")
+        recorder.start_run(load_protocol(PROTOCOL), "16v1", "V0", t=0)
+        for command in ("*RESET", "RAT15.00MH", "RAT1.00MM", ""):
+            recorder.pump_command(1, command, 0.01, t=1)
+        recorder.finish("aborted", "test", t=2)
+        commands = command_statistics(recorder.db)
+        self.assertEqual(sorted(commands), ["*RESET", "RAT", "STATUS"])
+        self.assertEqual(commands["RAT"]["count"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from cd_alpha import Device
+from cd_alpha.Updater import (
+    LocalUpdateSource,
+    UpdateError,
+    Updater,
+    UpdateThread,
+    publish_release,
+    OBJECTS_DIR,
+)
+
+
+class UpdaterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        base = Path(self.tmp.name)
+        self.tree = base / "tree"
+        self.source_dir = base / "source"
+        self.root = base / "root"
+        self._write("__init__.py", "")
+        self._write("ChipFlowApp.py", "print('v1')\n")
+        self._write("gui-elements/label.kv", "#:kivy 1.11.0\n")
+        self.source = LocalUpdateSource(self.source_dir)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, rel, text):
+        path = self.tree / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+    def _updater(self, progress=None):
+        return Updater(self.source, self.root, progress=progress)
+
+    def test_first_install(self):
+        publish_release(self.tree, self.source_dir, "1.0")
+        self.assertEqual(self._updater().update(), "1.0")
+        current = self.root / "current"
+        self.assertTrue(current.is_symlink())
+        self.assertEqual((current / "cd_alpha/ChipFlowApp.py").read_text(), "print('v1')\n")
+
+    def test_up_to_date(self):
+        publish_release(self.tree, self.source_dir, "1.0")
+        self._updater().update()
+        self.assertIsNone(self._updater().update())
+
+    def test_only_changed_files_are_fetched(self):
+        publish_release(self.tree, self.source_dir, "1.0")
+        self._updater().update()
+        self._write("ChipFlowApp.py", "print('v2')\n")
+        publish_release(self.tree, self.source_dir, "1.1")
+
+        fetched = []
+        updater = self._updater(progress=lambda *args: fetched.append(args))
+        self.assertEqual(updater.update(), "1.1")
+        self.assertIn(("fetch", 1, 1), fetched)
+        current = self.root / "current"
+        self.assertEqual((current / "cd_alpha/ChipFlowApp.py").read_text(), "print('v2')\n")
+        self.assertEqual(
+            os.stat(current / "cd_alpha/gui-elements/label.kv").st_ino,
+            os.stat(self.root / "releases/1.0/cd_alpha/gui-elements/label.kv").st_ino,
+        )
+
+    def test_corrupt_object_keeps_old_release(self):
+        publish_release(self.tree, self.source_dir, "1.0")
+        self._updater().update()
+        self._write("ChipFlowApp.py", "print('v2')\n")
+        manifest = publish_release(self.tree, self.source_dir, "1.1")
+        digest = manifest["files"]["cd_alpha/ChipFlowApp.py"]["sha256"]
+        (self.source_dir / OBJECTS_DIR / digest).write_text("tampered")
+
+        with self.assertRaises(UpdateError):
+            self._updater().update()
+        current = self.root / "current"
+        self.assertEqual(os.readlink(current), os.path.join("releases", "1.0"))
+        self.assertEqual((current / "cd_alpha/ChipFlowApp.py").read_text(), "print('v1')\n")
+
+    def test_device_config_is_not_released(self):
+        self._write("device_config.json", '{"DEVICE_TYPE": "V0"}')
+        manifest = publish_release(self.tree, self.source_dir, "1.0")
+        self.assertNotIn("cd_alpha/device_config.json", manifest["files"])
+        self._updater().update()
+        self.assertFalse((self.root / "current/cd_alpha/device_config.json").exists())
+
+    def test_mode_change_keeps_old_release(self):
+        publish_release(self.tree, self.source_dir, "1.0")
+        self._updater().update()
+        old = self.root / "releases/1.0/cd_alpha/ChipFlowApp.py"
+        old_mode = old.stat().st_mode & 0o777
+        os.chmod(self.tree / "ChipFlowApp.py", 0o700)
+        publish_release(self.tree, self.source_dir, "1.1")
+        self._updater().update()
+        new = self.root / "releases/1.1/cd_alpha/ChipFlowApp.py"
+        self.assertEqual(new.stat().st_mode & 0o777, 0o700)
+        self.assertEqual(old.stat().st_mode & 0o777, old_mode)
+        self.assertNotEqual(new.stat().st_ino, old.stat().st_ino)
+
+    def test_switched_release_is_imported(self):
+        self._write("Version.py", "VERSION = '1.0'\n")
+        publish_release(self.tree, self.source_dir, "1.0")
+        self._updater().update()
+        self._write("Version.py", "VERSION = '1.1'\n")
+        publish_release(self.tree, self.source_dir, "1.1")
+        self._updater().update()
+        # Started like the device starts the app, with the installed
+        # cd_alpha package importable as well
+        env = dict(os.environ, PYTHONPATH=str(self.root / "current"))
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import cd_alpha.Version as v; print(v.VERSION, v.__file__)",
+            ],
+            env=env,
+            cwd=self.tmp.name,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        self.assertEqual(out[0], "1.1")
+        self.assertTrue(out[1].startswith(str(self.root / "current")))
+
+    def test_device_config_copy_fails(self):
+        # The copy runs in the update thread and is reported like any failure
+        config = Path(self.tmp.name) / "device_config.json"
+        config.write_text('{"DEVICE_TYPE": "V0"}')
+        blocked = Path(self.tmp.name) / "file"
+        blocked.write_text("")
+        publish_release(self.tree, self.source_dir, "1.0")
+        updater = Updater(self.source, self.root, prepare=Device.keep_device_config)
+        results = []
+        thread = UpdateThread(updater, on_done=lambda *args: results.append(args))
+        with mock.patch.dict(os.environ, clear=False) as env, mock.patch.object(
+            Device, "DEVICE_CONFIG_PATH", str(blocked / "device_config.json")
+        ), mock.patch.object(Device, "device_config_path", return_value=str(config)):
+            env.pop(Device.DEVICE_CONFIG_ENV, None)
+            thread.start()
+            thread.join()
+        (version, error), = results
+        self.assertIsNone(version)
+        self.assertIsInstance(error, UpdateError)
+        self.assertFalse((self.root / "current").exists())
+
+    def test_missing_source(self):
+        with self.assertRaises(UpdateError):
+            self._updater().update()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import unittest
+
+from cd_alpha.ValidationFarm import validate_all, validate_protocol
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class ValidationFarmTestCase(unittest.TestCase):
+    def test_valid_protocol_passes(self):
+        result = validate_protocol(os.path.join(TEST_DIR, "v0-protocol-16v1.json"))
+        self.assertTrue(result["passed"], result["error"])
+        # Two syringes homed, grabbed and run through a 1.5 h protocol
+        self.assertGreater(result["simulated_s"], 3600)
+        self.assertGreater(result["volumes_ml"]["waste"]["infused_ml"], 0)
+        self.assertGreater(result["volumes_ml"]["lysate"]["infused_ml"], 0)
+
+    def test_invalid_protocol_fails(self):
+        result = validate_protocol(os.path.join(TEST_DIR, "invalid_protocol.json"))
+        self.assertFalse(result["passed"])
+        self.assertIn("type", result["error"])
+
+    def test_pool_keeps_file_order(self):
+        files = [
+            os.path.join(TEST_DIR, name)
+            for name in ("invalid_protocol.json", "v0-protocol-16v1.json", "foobar.json")
+        ]
+        results = validate_all(files, workers=2)
+        self.assertEqual([r["path"] for r in results], files)
+        self.assertEqual([r["passed"] for r in results], [False, True, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
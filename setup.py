@@ -8,13 +8,28 @@ setup(
     author="Will Brown",
     author_email="will.brown@chip-diagnostics.com",
     url="https://www.chip-diagnostics.com/",
-    packages=["cd_alpha", "cd_alpha.tests", "cd_alpha.software_testing"],
+    packages=[
+        "cd_alpha",
+        "cd_alpha.tests",
+        "cd_alpha.software_testing",
+        "cd_alpha.benchmarks",
+    ],
     include_package_data=True,
-    package_data={"": ["gui-elements/*.kv", "device_config.json"]},
+    package_data={
+        "": ["gui-elements/*.kv", "device_config.json", "benchmarks/baseline*.json"]
+    },
     entry_points={
         "console_scripts": [
             "chip = cd_alpha.ChipFlowApp:main",
             "update = cd_alpha.Device:get_updates",
+            "chip-run = cd_alpha.ProtocolExecutor:main",
+            "chip-validate = cd_alpha.ValidationFarm:main",
+            "chip-sweep = cd_alpha.ProtocolFactory:main",
+            "chip-optimize = cd_alpha.ProtocolOptimizer:main",
+            "chip-telemetry = cd_alpha.Telemetry:main",
+            "chip-pump-emulator = cd_alpha.software_testing.PumpEmulator:main",
+            "chip-replay = cd_alpha.software_testing.RunReplay:main",
+            "chip-safety-watchdog = cd_alpha.SafetyWatchdog:main",
         ],
     },
 )
@@ -1,2 +1,6 @@
- #!/bin/bash
-git pull origin master --no-edit
\ No newline at end of file
+#!/bin/bash
+# Install the latest release from UPDATE_SOURCE, see cd_alpha/Updater.py.
+# The updater of the active release is run, the installed package otherwise.
+UPDATE_ROOT="${UPDATE_ROOT:-/home/pi/cd_alpha_releases}"
+export PYTHONPATH="$UPDATE_ROOT/current${PYTHONPATH:+:$PYTHONPATH}"
+exec python3 -c "from cd_alpha.Device import get_updates; get_updates()"